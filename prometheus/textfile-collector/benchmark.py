@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for the textfile collectors against synthetic data, no hardware or CLI tools needed
+#
+# Synthetic smartctl, secli and lvs output (and a sysfs tree for osdinfo) is written to a --replay directory
+# (see collectorlib.py) and each collector's collect() is run against it in this process.  For every size
+# the first (cold, caches empty) run and the following warm runs are timed separately, along with CPU time,
+# peak python memory (tracemalloc) and the number of series in the output.
+#
+# smartinfo:      --sizes is the number of disks, a mix of SAS HDD, SATA SSD and NVMe with --namespaces each
+#                 NVMe devices are read through the fake log pages of nvmehealth.FileBackend, --smartctl-nvme
+#                 runs them through the smartctl fixtures instead.  --megaraid adds that many SATA disks behind a
+#                 MegaRAID controller, each pass-through query taking --megaraid-delay seconds
+# enclosureinfo:  --sizes is the number of MD3060e style enclosures with 60 slots each
+# osdinfo:        --sizes is the number of OSDs, block LV on a multipath device over two sd paths and
+#                 a DB LV on a multipath NVMe device shared by 12 OSDs
+# diskinfo:       --sizes is the number of OSDs in the same sysfs tree as osdinfo
+# sysfs:          compares the old per-device recursive glob of osdinfo.py with the sysfsindex BlockGraph
+# all:            smartinfo, enclosureinfo, osdinfo and diskinfo with their default sizes
+#
+# 'fixtures' writes the synthetic replay directory for one collector and size, to use with --replay by hand
+#
+# Examples:  benchmark.py smartinfo --sizes 10,100,1000
+#            benchmark.py fixtures /tmp/smart60 --collector smartinfo --size 60
+#            smartinfo.py --replay /tmp/smart60 --topology-cache '' --full-interval 0
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+from glob import glob
+from os.path import basename
+
+from nvmehealth import pack_smart_log
+from sysfsindex import BlockGraph
+
+
+# make /sys/block/<name> with slaves/<slave> entries and dm/name for dm devices
+def add_block(root, name, slaves=(), dm_name=None):
+    devdir = os.path.join(root, 'block', name)
+    os.makedirs(os.path.join(devdir, 'slaves'))
+    for slave in slaves:
+        open(os.path.join(devdir, 'slaves', slave), 'w').close()
+    if dm_name:
+        os.makedirs(os.path.join(devdir, 'dm'))
+        with open(os.path.join(devdir, 'dm', 'name'), 'w') as fh:
+            fh.write(dm_name + '\n')
+
+def sd_name(n):
+    name = ''
+    n += 1
+    while n:
+        n, r = divmod(n - 1, 26)
+        name = chr(ord('a') + r) + name
+    return 'sd' + name
+
+# returns the list of LV paths (block and db for every OSD) in the synthetic tree
+def build_osd_sysfs(root, osds, osds_per_db=12):
+    lvpaths = []
+    dm = 0
+    sd = 0
+    db_mpath = None
+
+    for osd in range(osds):
+        if osd % osds_per_db == 0:
+            # shared NVMe DB device, multipathed over two paths
+            nvme = osd // osds_per_db
+            paths = ['nvme{}n1'.format(nvme * 2), 'nvme{}n1'.format(nvme * 2 + 1)]
+            for p in paths:
+                add_block(root, p)
+            db_mpath = 'dm-{}'.format(dm)
+            add_block(root, db_mpath, paths, 'db_mpath{}'.format(nvme))
+            dm += 1
+
+        paths = [sd_name(sd), sd_name(sd + 1)]
+        sd += 2
+        for p in paths:
+            add_block(root, p)
+        mpath = 'dm-{}'.format(dm)
+        add_block(root, mpath, paths, 'mpath{}'.format(osd))
+        dm += 1
+
+        vg = 'ceph-block-{}'.format(osd)
+        add_block(root, 'dm-{}'.format(dm), [mpath], '{}-osd--block--{}'.format(vg.replace('-', '--'), osd))
+        lvpaths.append('/dev/{}/osd-block-{}'.format(vg, osd))
+        dm += 1
+
+        vg = 'ceph-db-{}'.format(osd // osds_per_db)
+        add_block(root, 'dm-{}'.format(dm), [db_mpath], '{}-osd--db--{}'.format(vg.replace('-', '--'), osd))
+        lvpaths.append('/dev/{}/osd-db-{}'.format(vg, osd))
+        dm += 1
+
+    return lvpaths
+
+
+# synthetic command output, each returns { command key: { 'rc': int, 'stdout': str } } as in commands.json
+
+def record(data, rc=0):
+    return { 'rc': rc, 'stdout': json.dumps(data) }
+
+def smartctl_disk(n, namespaces):
+    kind = ('nvme', 'sat', 'scsi', 'scsi', 'scsi', 'scsi', 'scsi', 'scsi', 'scsi', 'scsi')[n % 10]
+    common = { 'smartctl': { 'exit_status': 0 }, 'serial_number': 'SN{:06d}'.format(n) }
+
+    if kind == 'nvme':
+        name = '/dev/nvme{}'.format(n)
+        info = dict(common, device={ 'name': name, 'info_name': name }, model_name='Dell Express Flash NVMe',
+            firmware_version='1.0', temperature={ 'current': 35 },
+            nvme_namespaces=[ { 'id': i + 1 } for i in range(namespaces) ],
+            nvme_smart_health_information_log={ 'critical_warning': 0, 'available_spare': 100,
+                'available_spare_threshold': 10, 'percentage_used': 2, 'media_errors': 0 })
+        full = health = info
+    elif kind == 'sat':
+        name = '/dev/{}'.format(sd_name(n))
+        table = [ { 'name': attr, 'value': value, 'raw': { 'value': raw } } for attr, value, raw in [
+            ('Reallocated_Sector_Ct', 100, 0), ('Current_Pending_Sector_Count', 100, 0),
+            ('Offline_Uncorrectable', 100, 0), ('Command_Timeout', 100, 0), ('Temperature_Celsius', 30, 30),
+            ('Media_Wearout_Indicator', 98, 0), ('Uncorrectable_Error_Cnt', 100, 0) ] ]
+        info = dict(common, device={ 'name': name, 'info_name': name }, model_name='INTEL SSDSC2KG96',
+            firmware_version='XCV1', ata_smart_attributes={ 'table': table })
+        full = health = info
+    else:
+        name = '/dev/{}'.format(sd_name(n))
+        health = dict(common, device={ 'name': name, 'info_name': name }, product='ST8000NM0075',
+            revision='E004', temperature={ 'current': 31 }, scsi_grown_defect_list=0)
+        full = dict(health, scsi_error_counter_log={ op: { 'total_uncorrected_errors': 0 } for op in ('read', 'write', 'verify') })
+        kind = 'scsi'
+
+    return { 'name': name, 'type': kind }, full, health
+
+# a SATA disk behind the first MegaRAID controller, as 'smartctl --scan-open -d megaraid' lists it
+def megaraid_disk(n):
+    entry = { 'name': '/dev/bus/0', 'type': 'sat+megaraid,{}'.format(n) }
+    table = [ { 'name': attr, 'value': value, 'raw': { 'value': raw } } for attr, value, raw in [
+        ('Reallocated_Sector_Ct', 100, 0), ('Current_Pending_Sector_Count', 100, 0), ('Offline_Uncorrectable', 100, 0),
+        ('Command_Timeout', 100, 0), ('Temperature_Celsius', 29, 29) ] ]
+    info = { 'smartctl': { 'exit_status': 4 }, 'serial_number': 'MR{:06d}'.format(n), 'model_name': 'ST4000NM0033',
+        'firmware_version': 'GA0A', 'ata_smart_attributes': { 'table': table },
+        'device': { 'name': '/dev/bus/0', 'info_name': '/dev/bus/0 [megaraid_disk_{:02d}] [SAT]'.format(n) } }
+    return entry, info
+
+def smartinfo_fixture(disks, namespaces=1, megaraid=0, delay=0):
+    commands = {}
+    scan = []
+    for n in range(disks):
+        entry, full, health = smartctl_disk(n, namespaces)
+        scan.append(entry)
+        commands['smartctl --json --all {} -d {}'.format(entry['name'], entry['type'])] = record(full)
+        commands['smartctl --json --info --health --attributes {} -d {}'.format(entry['name'], entry['type'])] = record(health)
+
+    if megaraid:
+        # the virtual disk the controller exports can't be opened, the physical ones are listed separately
+        scan.append({ 'name': '/dev/sd{}'.format('z' * 3), 'type': 'scsi',
+            'open_error': "DELL or MegaRaid controller, please try adding '-d megaraid,N'" })
+        listed = []
+        for n in range(megaraid):
+            entry, info = megaraid_disk(n)
+            listed.append(entry)
+            for query in ('--all', '--info --health --attributes'):
+                commands['smartctl --json {} {} -d {}'.format(query, entry['name'], entry['type'])] = dict(record(info), delay=delay)
+        commands['smartctl --json --scan-open -d megaraid'] = record({ 'devices': listed })
+    commands['smartctl --json --scan-open'] = record({ 'devices': scan })
+    return commands
+
+# sysfs entries and log pages for the nvme devices of smartinfo_fixture, for the native path
+def nvme_fixture(path, disks, namespaces=1):
+    os.makedirs(os.path.join(path, 'nvme'), exist_ok=True)
+    for n in range(disks):
+        entry, full, _ = smartctl_disk(n, namespaces)
+        if entry['type'] != 'nvme':
+            continue
+        name = basename(entry['name'])
+        ctrl = os.path.join(path, 'sys', 'class', 'nvme', name)
+        for ns in full['nvme_namespaces']:
+            os.makedirs(os.path.join(ctrl, '{}n{}'.format(name, ns['id'])))
+        for attr, value in [('serial', full['serial_number']), ('model', full['model_name']), ('firmware_rev', full['firmware_version'])]:
+            with open(os.path.join(ctrl, attr), 'w') as fh:
+                fh.write(value + '\n')
+        log = full['nvme_smart_health_information_log']
+        with open(os.path.join(path, 'nvme', name + '.smart-log'), 'wb') as fh:
+            fh.write(pack_smart_log(temperature=full['temperature']['current'], **log))
+
+def secli_response(top, sub, items):
+    # two EMMs report the same components, enclosureinfo.py only looks at the first
+    return record({ 'Responses': { 'Response': { top: [ { sub: items }, { sub: items } ] } } })
+
+def enclosureinfo_fixture(enclosures, slots=60):
+    commands = {}
+    encs = []
+    for e in range(enclosures):
+        wwid = '500C0FF0{:08X}'.format(e)
+        encs.append({ 'EnclosureWWID': wwid, 'ServiceTag': 'TAG{:04d}'.format(e), 'ProductName': 'MD3060e', 'AlarmCount': '0' })
+
+        def key(listing):
+            return 'secli list {} -outputformat=json -enc={}'.format(listing, wwid)
+
+        driveslots = []
+        for s in range(slots):
+            driveslots.append({ 'Status': 'OK', 'EnclosureSlot': str(s), 'Drawer': str(s // 12), 'DrawerSlot': str(s % 12),
+                'Drive': { 'SerialNumber': 'ZA{:04d}{:04d}'.format(e, s),
+                    'DeviceIds': { 'Descriptor': [ { '@association': 'ADDRESSED_LOGICAL_UNIT', '#text': '5000C500{:04X}{:04X}'.format(e, s) } ] } } })
+        commands[key('drive slots')] = secli_response('DriveSlots', 'DriveSlot', driveslots)
+        commands[key('power supplies')] = secli_response('PowerSupplies', 'PowerSupply',
+            [ { 'Name': 'PS{}'.format(i), 'Status': 'OK', 'ACFail': 'FALSE', 'DCFail': 'FALSE' } for i in range(2) ])
+        commands[key('fans')] = secli_response('Fans', 'Fan',
+            [ { 'Name': 'Fan{}'.format(i), 'Status': 'OK', 'RPM': '5400' } for i in range(5) ])
+        commands[key('temp sensors')] = secli_response('TemperatureSensors', 'TemperatureSensor',
+            [ { 'Name': 'Temp{}'.format(i), 'Status': 'OK', 'TemperatureCel': '27' } for i in range(14) ])
+        commands[key('voltage sensors')] = secli_response('VoltageSensors', 'VoltageSensor',
+            [ { 'Name': 'Volt{}'.format(i), 'Status': 'OK', 'CritOver': 'FALSE', 'WarnOver': 'FALSE',
+                'CritUnder': 'FALSE', 'WarnUnder': 'FALSE' } for i in range(4) ])
+
+    commands['secli list physical enclosures -outputformat=json'] = record(
+        { 'Responses': { 'Response': { 'Enclosures': { 'Enclosure': encs if len(encs) != 1 else encs[0] } } } })
+    return commands
+
+# lvs output for the OSDs in build_osd_sysfs
+def osdinfo_fixture(osds, osds_per_db=12):
+    lvs = []
+    for osd in range(osds):
+        block = '/dev/ceph-block-{0}/osd-block-{0}'.format(osd)
+        db = '/dev/ceph-db-{}/osd-db-{}'.format(osd // osds_per_db, osd)
+        tags = 'ceph.block_device={},ceph.cluster_name=ceph,ceph.db_device={},ceph.osd_id={},ceph.type=block'.format(block, db, osd)
+        lvs.append({ 'lv_tags': tags, 'lv_path': block, 'lv_dm_path': dm_path(block) })
+        lvs.append({ 'lv_tags': 'ceph.db_device={},ceph.osd_id={},ceph.type=db'.format(db, osd), 'lv_path': db, 'lv_dm_path': dm_path(db) })
+    return { 'lvs -o lv_tags,lv_path,lv_dm_path --reportformat=json': record({ 'report': [ { 'lv': lvs } ] }) }
+
+# /dev/vg/lv -> /dev/mapper/vg-lv like lvs has it in lv_dm_path
+def dm_path(path):
+    vg, lv = path.split('/')[-2:]
+    return '/dev/mapper/{}-{}'.format(vg.replace('-', '--'), lv.replace('-', '--'))
+
+# write a replay directory for one collector and size
+def write_fixture(path, collector, size, namespaces=1, megaraid=0, delay=0):
+    os.makedirs(path, exist_ok=True)
+    if collector == 'smartinfo':
+        commands = smartinfo_fixture(size, namespaces, megaraid, delay)
+        nvme_fixture(path, size, namespaces)
+    elif collector == 'enclosureinfo':
+        commands = enclosureinfo_fixture(size)
+    elif collector == 'osdinfo':
+        commands = osdinfo_fixture(size)
+        build_osd_sysfs(os.path.join(path, 'sys'), size)
+    else:
+        commands = {}
+        build_osd_sysfs(os.path.join(path, 'sys'), size)
+
+    with open(os.path.join(path, 'commands.json'), 'w') as fh:
+        json.dump(commands, fh)
+
+
+# collector arguments for a replay run, caches go in the scratch directory so every size starts cold
+def replay_argv(collector, replay, scratch, args):
+    argv = ['ceph', '--replay', replay]
+    if collector != 'diskinfo':
+        argv += ['--snapshots', os.path.join(scratch, 'snapshots.bin')]
+    if collector in ('osdinfo', 'enclosureinfo'):
+        # every run decodes the command output again like a separate process would
+        argv += ['--command-max-age', '0']
+    if collector == 'smartinfo':
+        argv += ['--topology-cache', os.path.join(scratch, 'topology.json'), '--full-cache', os.path.join(scratch, 'full.json'),
+            '--history', os.path.join(scratch, 'history.json'), '--megaraid-cache', os.path.join(scratch, 'megaraid.json')]
+        if args.smartctl_nvme:
+            argv += ['--no-nvme-native']
+    elif collector in ('osdinfo', 'diskinfo'):
+        # every run walks sysfs like a separate process would
+        argv += ['--sysfs-max-age', '0']
+    return argv
+
+def series_count(registry):
+    return sum(len(fam.samples) for fam in registry.families.values())
+
+def bench_collector(collector, sizes, args):
+    module = importlib.import_module(collector)
+    print('{:<14} {:>6} {:>10} {:>10} {:>10} {:>10} {:>8}'.format(collector, 'size', 'cold s', 'warm s', 'cpu s', 'peak MiB', 'series'))
+
+    for size in sizes:
+        scratch = tempfile.mkdtemp(prefix='bench-{}-'.format(collector))
+        try:
+            replay = os.path.join(scratch, 'replay')
+            write_fixture(replay, collector, size, args.namespaces, args.megaraid, args.megaraid_delay)
+            cargs = module.build_parser().parse_args(replay_argv(collector, replay, scratch, args))
+
+            walls = []
+            cpus = []
+            for _ in range(max(2, args.repeat + 1)):
+                wall = time.perf_counter()
+                cpu = time.process_time()
+                registry = module.collect(cargs)
+                cpus.append(time.process_time() - cpu)
+                walls.append(time.perf_counter() - wall)
+
+            # separate run for memory, tracemalloc slows everything down
+            tracemalloc.start()
+            module.collect(cargs)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print('{:<14} {:>6} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.2f} {:>8}'.format('', size, walls[0],
+                statistics.median(walls[1:]), statistics.median(cpus[1:]), peak / 2**20, series_count(registry)))
+        finally:
+            shutil.rmtree(scratch)
+
+default_sizes = {
+    'smartinfo': [10, 100, 1000],
+    'enclosureinfo': [1, 4, 16],
+    'osdinfo': [10, 100, 1000],
+    'diskinfo': [10, 100, 1000],
+}
+
+
+# the way osdinfo.py used to do it, one glob per device per OSD
+def glob_slaves(root, bd):
+    for sdev in glob('{}/block/{}/slaves/*'.format(root, bd[-1])):
+        bd.append(basename(sdev))
+        bd = glob_slaves(root, bd)
+    return bd
+
+# what osdinfo.py does now, one walk of /sys/block and memoized lookups
+def graph_slaves(root, dms):
+    graph = BlockGraph.from_sysfs(root)
+    return [ graph.below(dm) for dm in dms ]
+
+def bench_sysfs(sizes, args):
+    for osds in sizes:
+        root = tempfile.mkdtemp(prefix='bench-sysfs-')
+        try:
+            start = time.perf_counter()
+            lvpaths = build_osd_sysfs(root, osds)
+            print('built synthetic sysfs with {} OSDs, {} block devices in {:.2f}s'.format(
+                osds, len(os.listdir(os.path.join(root, 'block'))), time.perf_counter() - start))
+
+            # lv path -> dm name is looked up the same way for both, readlink is not part of the comparison
+            graph = BlockGraph.from_sysfs(root)
+            dms = [ graph.lv_kernel_name(p) for p in lvpaths ]
+
+            for name, fn in [('recursive glob', lambda: [ glob_slaves(root, [dm]) for dm in dms ]),
+                             ('BlockGraph', lambda: graph_slaves(root, dms))]:
+                times = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    result = fn()
+                    times.append(time.perf_counter() - start)
+                print('{:<16} best {:.4f}s  mean {:.4f}s  ({} device entries)'.format(
+                    name, min(times), sum(times) / len(times), sum(len(r) for r in result)))
+        finally:
+            shutil.rmtree(root)
+
+def parse_sizes(text):
+    return [ int(s) for s in text.split(',') if s ]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the textfile collectors against synthetic data')
+    parser.add_argument('benchmark', choices=sorted(default_sizes) + ['all', 'sysfs', 'fixtures'], help='What to run')
+    parser.add_argument('path', nargs='?', help='Output directory for fixtures')
+    parser.add_argument('--sizes', type=parse_sizes, help='Comma separated sizes to run (default depends on the collector)')
+    parser.add_argument('--namespaces', type=int, default=1, help='Namespaces per NVMe device for smartinfo (default: 1)')
+    parser.add_argument('--smartctl-nvme', action='store_true', help='Query NVMe devices with smartctl in the smartinfo benchmark')
+    parser.add_argument('--megaraid', type=int, default=0, help='SATA disks behind a MegaRAID controller for smartinfo (default: 0)')
+    parser.add_argument('--megaraid-delay', type=float, default=0.05,
+        help='Seconds each query of a disk behind the MegaRAID controller takes (default: 0.05)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed warm runs (default: 3)')
+    parser.add_argument('--collector', choices=sorted(default_sizes), help='Collector to write fixtures for')
+    parser.add_argument('--size', type=int, default=60, help='Size of the fixtures written (default: 60)')
+    args = parser.parse_args()
+
+    if args.benchmark == 'fixtures':
+        if not args.path or not args.collector:
+            parser.error('fixtures needs a path and --collector')
+        write_fixture(args.path, args.collector, args.size, args.namespaces, args.megaraid, args.megaraid_delay)
+    elif args.benchmark == 'sysfs':
+        bench_sysfs(args.sizes or [1000], args)
+    elif args.benchmark == 'all':
+        for collector in sorted(default_sizes):
+            bench_collector(collector, args.sizes or default_sizes[collector], args)
+    else:
+        bench_collector(args.benchmark, args.sizes or default_sizes[args.benchmark], args)
+
+if __name__ == '__main__':
+    main()
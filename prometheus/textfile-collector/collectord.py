@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+#
+# Long running host for the textfile collectors in this directory
+# (smartinfo.py, osdinfo.py, enclosureinfo.py, diskinfo.py, diskidentity.py)
+# Instead of metrics.sh starting a new interpreter for every script on every cron run, this imports the
+# collectors once and runs each on its own interval in a thread.  The latest output of every collector
+# is served on a local /metrics endpoint which prometheus (or node_exporter's neighbour scrape job) can scrape.
+#
+# The textfile output is still available with --textfile-dir, each collector is written to <dir>/<name>.prom
+# after every run (only if it changed, see collectorlib.TextfileWriter).  Use --no-http to only write text files.
+#
+# Collectors and their intervals are set with --collector name=seconds, by default all of them run every 300s
+# Collectors whose CLI tool is not installed on the host are skipped.
+# Collectors that join the output of others (diskidentity.py, see 'inputs' there) get the last output of those
+# handed over in memory.
+#
+# Series describing the daemon itself:
+# collectord_collector_success{collector="smartinfo"} 1 if the last run of the collector finished without error
+# collectord_collector_last_success_timestamp_seconds{collector="smartinfo"} time the collector last finished without error
+# and the textfile_collector_* instrumentation series of every collector (see collectorlib.RunStats), where
+# the command latency histogram and counts add up over the lifetime of the daemon.
+# With --profile-threshold every collector run that takes longer is profiled to stderr or --profile-output.
+#
+# Example:  collectord.py --cluster ceph --listen 127.0.0.1:9199 --collector smartinfo=600 --collector osdinfo=300
+
+import argparse
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from collectorlib import CollectorError, RunStats, TextfileWriter, profiled, remove_replaced
+from exposition import Labels, Registry
+
+default_collectors = {
+    'smartinfo': 300,
+    'enclosureinfo': 300,
+    'osdinfo': 300,
+    'diskinfo': 300,
+    'diskidentity': 300,
+}
+
+log = logging.getLogger('collectord')
+
+# one imported collector module with its own schedule and the output of its last successful run
+class Collector:
+    def __init__(self, name, interval, argv, textfile_dir=None, writer=None):
+        self.name = name
+        self.interval = interval
+        self.module = importlib.import_module(name)
+        self.args = self.module.build_parser().parse_args(argv)
+        self.textfile_dir = textfile_dir
+        self.writer = writer
+        self.registry = None
+        # collectors this one joins the output of, by name
+        self.peers = {}
+        self.success = 0
+        self.last_success = 0
+        # command stats of all runs so far
+        self.stats = RunStats(name)
+        self.lock = threading.Lock()
+
+    def available(self):
+        return self.module.available()
+
+    def run_once(self):
+        stats = RunStats(self.name)
+        try:
+            registry = profiled(self.args, lambda: self.module.collect(self.args, stats, **self.inputs()), stats)
+        except CollectorError as err:
+            for msg in err.messages:
+                log.error('%s: %s', self.name, msg)
+            self.success = 0
+            self.stats.add(stats)
+            return
+        except Exception:
+            log.exception('%s: collector failed', self.name)
+            self.success = 0
+            self.stats.add(stats)
+            return
+
+        stats.finish(registry)
+        text = registry.render()
+        with self.lock:
+            self.registry = registry
+            self.success = 1
+            self.last_success = time.time()
+        self.stats.add(stats)
+
+        if self.textfile_dir:
+            self.writer.write_collector(os.path.join(self.textfile_dir, self.name + '.prom'), self.name, text, self.stats)
+
+        log.debug('%s: %d bytes in %.2fs', self.name, len(text), stats.duration)
+
+    # run forever on our interval, the time a run takes counts against the interval
+    def loop(self, stop):
+        while not stop.is_set():
+            start = time.monotonic()
+            self.run_once()
+            stop.wait(max(0, self.interval - (time.monotonic() - start)))
+
+    # extra collect() arguments for collectors with inputs, the last output of every peer that has one
+    def inputs(self):
+        if not hasattr(self.module, 'inputs'):
+            return {}
+        registries = {}
+        for name, peer in self.peers.items():
+            with peer.lock:
+                if peer.registry is not None:
+                    registries[name] = peer.registry
+        return { 'registries': registries }
+
+# the last output of every collector and the daemon's own series in one registry, so a family that more than one
+# collector has (storage_disk_changed_total) gets one HELP and TYPE with the series of all of them
+def render(collectors):
+    registry = Registry()
+    success = registry.family('collectord_collector_success', 'Last run of the collector finished without error')
+    last = registry.family('collectord_collector_last_success_timestamp_seconds', 'Time the collector last finished a run without error')
+    for c in collectors:
+        labels = Labels(collector=c.name)
+        success.add(labels, c.success)
+        last.add(labels, int(c.last_success))
+        with c.lock:
+            if c.registry is not None:
+                registry.merge(c.registry)
+        registry.merge(c.stats.registry())
+    return registry.render()
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+def make_handler(collectors):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render(collectors).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # requests are logged at debug level instead of to stderr for every scrape
+        def log_message(self, format, *args):
+            log.debug(format, *args)
+
+    return MetricsHandler
+
+# parse name=seconds, interval is optional
+def parse_collector(spec):
+    name, _, interval = spec.partition('=')
+    if name not in default_collectors:
+        raise argparse.ArgumentTypeError('unknown collector {}'.format(name))
+    return name, float(interval) if interval else default_collectors[name]
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Run the textfile collectors in one long running process')
+    parser.add_argument('--cluster', default='ceph', help='Cluster name passed to osdinfo (default: ceph)')
+    parser.add_argument('--collector', type=parse_collector, action='append', dest='collectors',
+        help='Collector to run as name or name=interval_seconds, may be repeated (default: all collectors)')
+    parser.add_argument('--listen', default='127.0.0.1:9199', help='Address and port for /metrics (default: 127.0.0.1:9199)')
+    parser.add_argument('--no-http', action='store_true', help='Do not serve /metrics, only write text files')
+    parser.add_argument('--textfile-dir', help='Also write <collector>.prom files into this directory')
+    parser.add_argument('--debug', action='store_true', help='Log every collector run')
+    parser.add_argument('--profile-threshold', type=float, metavar='SECONDS',
+        help='Profile collector runs and write a summary for any that take longer than this')
+    parser.add_argument('--profile-output', metavar='FILE', help='Append profile summaries to FILE instead of stderr')
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    if args.no_http and not args.textfile_dir:
+        log.error('nothing to do with --no-http and no --textfile-dir')
+        sys.exit(1)
+
+    specs = args.collectors or sorted(default_collectors.items())
+    writer = TextfileWriter()
+    collectors = []
+    for name, interval in specs:
+        argv = [args.cluster]
+        if args.profile_threshold is not None:
+            argv += ['--profile-threshold', str(args.profile_threshold)]
+            if args.profile_output:
+                argv += ['--profile-output', args.profile_output]
+        c = Collector(name, interval, argv, args.textfile_dir, writer)
+        if not c.available():
+            log.info('%s: CLI tool not found, skipping', name)
+            continue
+        if args.textfile_dir:
+            remove_replaced(args.textfile_dir, name)
+        collectors.append(c)
+
+    for c in collectors:
+        for name in getattr(c.module, 'inputs', ()):
+            c.peers.update({ p.name: p for p in collectors if p.name == name })
+
+    stop = threading.Event()
+    for c in collectors:
+        threading.Thread(target=c.loop, args=(stop,), name=c.name, daemon=True).start()
+
+    try:
+        if args.no_http:
+            while True:
+                time.sleep(3600)
+        else:
+            host, _, port = args.listen.rpartition(':')
+            server = ThreadingHTTPServer((host, int(port)), make_handler(collectors))
+            log.info('serving /metrics on %s', args.listen)
+            server.serve_forever()
+    except KeyboardInterrupt:
+        stop.set()
+
+if __name__ == '__main__':
+    main()
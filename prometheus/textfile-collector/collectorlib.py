@@ -0,0 +1,597 @@
+# Shared helpers for the textfile collector scripts in this directory
+# (smartinfo.py, enclosureinfo.py, osdinfo.py).  Install it next to the scripts, they import it from there.
+#
+# CommandRunner runs the CLI tools the collectors depend on (smartctl, secli, lvs) with a per-command
+# timeout and an overall budget for the whole run.  A single hung command raises CommandTimeout
+# so the collector can report it and carry on with everything else instead of blocking forever, one that
+# doesn't even go away when it's killed is left behind (CommandAbandoned, a CommandTimeout as well).
+#
+# The runner hands commands to a transport.  LocalTransport runs them with subprocess.  For testing and
+# benchmarking without the hardware, --record DIR saves every command and its output while running for real
+# and --replay DIR answers commands from such a recording (or a synthetic one, see benchmark.py) instead:
+# DIR/commands.json  { "smartctl --json --scan-open": { "rc": 0, "stdout": "...", "delay": 0 }, ... }
+# Commands are keyed by the basename of the tool and the arguments.  'delay' is optional and simulates a slow
+# command, so timeouts can be tested too.  DIR/sys, if present, is a sysfs tree to use instead of /sys.
+#
+# SshTransport runs the commands on another host instead, for remotepoll.py which runs the collectors centrally
+# for hosts that can't run them themselves.  A collector run for another host has args.remote set to the host
+# name and no local sysfs or /dev to look at (sysfs_root() is None), see is_remote().
+#
+# CommandRunner.check_json() decodes the JSON most of the tools print (with orjson if it is installed, it is several
+# times faster than the json module on big smartctl and lvs output) and can share the decoded output through
+# ResultCache: a command run again within --command-max-age seconds, by the same collector or another one in the
+# same process (collectord.py, remotepoll.py), gets the answer of the first run instead of running again.
+# textfile_collector_commands_cached_total{collector,kind} counts the commands answered that way.
+#
+# TextfileWriter writes collector output for the node_exporter textfile collector.  Files are replaced
+# atomically and only when the content actually changed, so node_exporter isn't re-reading identical files
+# and the directory isn't churned every cycle.  Because an unchanged file keeps its old mtime, every
+# successful run also updates a small <name>.status.prom file with the time of the run:
+# textfile_collector_last_success_timestamp_seconds{collector="smartinfo"} 1.6e9
+#
+# The status file also gets the collector's own instrumentation from RunStats, so the main .prom file
+# still only changes when the data does:
+# textfile_collector_duration_seconds{collector}  wall clock time of the run
+# textfile_collector_cpu_seconds{collector}  CPU time of the collector process during the run
+# textfile_collector_series{collector}  number of series in the output
+# textfile_collector_command_duration_seconds{collector,kind}  histogram of command latency by kind of command
+#   (smartctl 'disk' or 'list', secli 'driveslot', 'lvs' and so on)
+# textfile_collector_commands_total{collector,kind,exit_status}  commands run by exit status, 'timeout' if they hung
+# textfile_collector_commands_cached_total{collector,kind}  commands answered from ResultCache without running
+# Collectors can add series of their own about the run to RunStats.extra (smartinfo's per controller probe cost),
+# they go in the status file too.
+# For the scripts these cover the one run, in collectord.py the histogram and counts add up over the process lifetime.
+#
+# --profile-threshold SECONDS runs the collector under cProfile and, if the run took longer than that,
+# writes the top functions and the slowest commands to --profile-output (or stderr).
+
+import cProfile
+import hashlib
+import io
+import json
+import os
+import pstats
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+from exposition import Labels, Registry
+
+# faster JSON decoding if it's installed, everything works without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# raised by a collector when its CLI tool reports an error that makes the whole run useless
+# messages are printed by the script (or logged by collectord.py) instead of the metrics
+class CollectorError(Exception):
+    def __init__(self, messages):
+        self.messages = messages
+        super().__init__('; '.join(messages))
+
+
+# raised by SshTransport when ssh can't get to the host at all, there is no point running anything else there
+class HostUnreachable(CollectorError):
+    pass
+
+
+class CommandTimeout(Exception):
+    def __init__(self, cmd, timeout):
+        self.cmd = cmd
+        self.timeout = timeout
+        super().__init__('{} timed out after {:.1f}s'.format(' '.join(cmd), timeout))
+
+
+# a timed out command that was still there after SIGKILL, like a smartctl stuck in the kernel (D state) on a
+# dying disk, it is left behind instead of waited for
+class CommandAbandoned(CommandTimeout):
+    def __init__(self, cmd, timeout, pid):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.pid = pid
+        Exception.__init__(self, '{} timed out after {:.1f}s and did not exit when killed, pid {} left behind'.format(' '.join(cmd), timeout, pid))
+
+
+# tracks the overall time budget for a collector run
+# budget of None means no limit
+class Deadline:
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.expires = None if budget is None else time.monotonic() + budget
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.expires is not None and time.monotonic() >= self.expires
+
+
+# key for a command in a recording, tool paths differ between hosts so only the basename is kept
+def command_key(cmd):
+    return ' '.join([os.path.basename(cmd[0])] + list(cmd[1:]))
+
+
+# decode JSON command output (bytes or str), with orjson if it is there
+# orjson is stricter than json about some output (like NaN), that is decoded again with json,
+# which also raises the usual json.JSONDecodeError if it really is bad
+def loads(data):
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+# Transports have a scope, commands with the same scope and key give the same answer (see ResultCache)
+class LocalTransport:
+    scope = 'local'
+    # seconds to wait for a killed command to exit, a process in D state doesn't until the kernel lets go of it
+    kill_wait = 5
+
+    # run a command and return (returncode, stdout bytes), stderr is discarded
+    def run(self, cmd, env=None, timeout=None):
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
+        try:
+            output, _ = p.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            try:
+                p.wait(self.kill_wait)
+            except subprocess.TimeoutExpired:
+                raise CommandAbandoned(cmd, timeout, p.pid)
+            finally:
+                p.stdout.close()
+            raise CommandTimeout(cmd, timeout)
+
+        return p.returncode, output
+
+
+class ReplayTransport:
+    def __init__(self, path):
+        self.scope = 'replay:' + os.path.abspath(path)
+        with open(os.path.join(path, 'commands.json')) as fh:
+            self.commands = json.load(fh)
+
+    def run(self, cmd, env=None, timeout=None):
+        key = command_key(cmd)
+        if key not in self.commands:
+            raise CollectorError(['No recorded output for: {}'.format(key)])
+        rec = self.commands[key]
+
+        delay = rec.get('delay', 0)
+        if delay:
+            if timeout is not None and delay > timeout:
+                time.sleep(timeout)
+                raise CommandTimeout(cmd, timeout)
+            time.sleep(delay)
+        return rec.get('rc', 0), rec['stdout'].encode('utf-8')
+
+
+# runs commands for real and saves the output to DIR/commands.json for --replay
+class RecordingTransport(LocalTransport):
+    def __init__(self, path):
+        self.path = path
+        self.scope = 'record:' + os.path.abspath(path)
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        # several collectors (or runs) can record into the same directory
+        try:
+            with open(os.path.join(path, 'commands.json')) as fh:
+                self.commands = json.load(fh)
+        except (OSError, ValueError):
+            self.commands = {}
+
+    def run(self, cmd, env=None, timeout=None):
+        rc, output = super().run(cmd, env, timeout)
+        with self.lock:
+            self.commands[command_key(cmd)] = { 'rc': rc, 'stdout': output.decode('utf-8', 'replace') }
+            # rewritten after every command, recording is not something that happens often
+            with open(os.path.join(self.path, 'commands.json'), 'w') as fh:
+                json.dump(self.commands, fh, indent=1, sort_keys=True)
+        return rc, output
+
+
+# runs commands on another host over ssh
+# Every command for the host goes over one connection: the first one starts a master (ControlMaster=auto)
+# and the others open a session on it, without a TCP connection and key exchange of their own.
+# ControlPersist keeps the master after we are done, so the next run (cron, or --loop in remotepoll.py)
+# starts on a connection that is already up.  sshd allows MaxSessions (10 by default) sessions on one
+# connection, sessions limits the commands running on the host at the same time to stay under that.
+# A timeout kills the local ssh client, which closes the session.  The remote command isn't sent a signal
+# and may keep going until it finishes or notices its output is gone.
+class SshTransport:
+    # exit status of ssh itself when it couldn't connect or authenticate
+    ssh_failed = 255
+
+    def __init__(self, host, control_dir, sessions=4, persist=600, options=(), ssh='ssh'):
+        self.host = host
+        self.scope = 'ssh:' + host
+        self.control_path = os.path.join(control_dir, '%C')
+        self.ssh = [ssh, '-o', 'BatchMode=yes', '-o', 'ControlMaster=auto', '-o', 'ControlPath=' + self.control_path,
+            '-o', 'ControlPersist={}'.format(int(persist))] + list(options)
+        self.sessions = threading.BoundedSemaphore(max(1, sessions))
+
+    # the command as one string for the remote shell
+    # a non-login ssh session usually has no sbin in PATH, secli looks for lspci and friends there
+    def remote_command(self, cmd):
+        return 'PATH=$PATH:/sbin:/usr/sbin exec ' + ' '.join(shlex.quote(arg) for arg in cmd)
+
+    # env is the environment for a local command and doesn't apply here
+    def run(self, cmd, env=None, timeout=None):
+        with self.sessions:
+            try:
+                p = subprocess.run(self.ssh + [self.host, self.remote_command(cmd)], stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                raise CommandTimeout(cmd, timeout)
+
+        if p.returncode == self.ssh_failed:
+            message = p.stderr.decode('utf-8', 'replace').strip().splitlines()
+            raise HostUnreachable(['ssh to {} failed: {}'.format(self.host, message[-1] if message else 'exit status 255')])
+        return p.returncode, p.stdout
+
+    # stop the master connection, only needed when it shouldn't outlive us
+    def close(self):
+        subprocess.run(self.ssh[:1] + ['-o', 'ControlPath=' + self.control_path, '-O', 'exit', self.host],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+# decoded output of commands by (transport scope, command key), kept for whoever runs the same command next
+# The first caller runs the command and the others asking for it at the same time wait for its answer.
+# Only decoded output of commands that exited 0 is kept, a failed or timed out command is run again next time.
+# The environment isn't part of the key, the collectors run a command with the same one every time.
+# What get() returns is shared, callers must not change it.
+class ResultCache:
+    def __init__(self):
+        # key -> (monotonic time it was fetched, decoded output)
+        self.entries = {}
+        # key -> lock held while the command for it runs
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    # returns (value, True if it came from the cache), fetch() gets it if there is nothing younger than max_age
+    def get(self, key, max_age, fetch):
+        with self.lock:
+            lock = self.locks.setdefault(key, threading.Lock())
+        with lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] <= max_age:
+                return entry[1], True
+            value = fetch()
+            self.entries[key] = (time.monotonic(), value)
+            return value, False
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# the one every CommandRunner in the process uses
+results = ResultCache()
+
+
+# upper bounds of the command latency histogram, smartctl on a busy SAS disk is around 1s and secli several
+command_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# timing of a collector run and of every command in it, rendered as the self-instrumentation series
+class RunStats:
+    # number of slowest commands kept for the profile summary
+    slowest_kept = 10
+
+    def __init__(self, collector):
+        self.collector = collector
+        self.start = time.monotonic()
+        self.cpu_start = time.process_time()
+        self.duration = 0.0
+        self.cpu = 0.0
+        self.series = 0
+        # kind -> [cumulative count per bucket, count, sum]
+        self.latency = {}
+        # (kind, exit status) -> count
+        self.exits = {}
+        # kind -> commands answered from ResultCache
+        self.cached = {}
+        # (seconds, command key) of the slowest commands
+        self.slowest = []
+        # smartinfo and enclosureinfo run commands from a thread pool
+        self.lock = threading.Lock()
+        # series the collector adds about the run, rendered with ours
+        self.extra = Registry()
+
+    def command(self, cmd, kind, seconds, status):
+        with self.lock:
+            hist = self.latency.setdefault(kind, [[0] * len(command_buckets), 0, 0.0])
+            for i, le in enumerate(command_buckets):
+                if seconds <= le:
+                    hist[0][i] += 1
+            hist[1] += 1
+            hist[2] += seconds
+            key = (kind, str(status))
+            self.exits[key] = self.exits.get(key, 0) + 1
+            self.slowest = sorted(self.slowest + [(seconds, command_key(cmd))], reverse=True)[:self.slowest_kept]
+
+    def cache_hit(self, kind):
+        with self.lock:
+            self.cached[kind] = self.cached.get(kind, 0) + 1
+
+    # end of the run, registry is the collector output
+    def finish(self, registry=None):
+        self.duration = time.monotonic() - self.start
+        self.cpu = time.process_time() - self.cpu_start
+        if registry is not None:
+            self.series = sum(len(fam.samples) for fam in registry.families.values())
+
+    # add the commands of another run to these, keeping the slowest of both, and add its series to our extra ones
+    # extra is what to add instead of other.extra (remotepoll.py puts the host label on them first)
+    def merge(self, other, extra=None):
+        with self.lock:
+            for kind, (counts, count, total) in other.latency.items():
+                hist = self.latency.setdefault(kind, [[0] * len(command_buckets), 0, 0.0])
+                hist[0] = [ a + b for a, b in zip(hist[0], counts) ]
+                hist[1] += count
+                hist[2] += total
+            for key, count in other.exits.items():
+                self.exits[key] = self.exits.get(key, 0) + count
+            for kind, count in other.cached.items():
+                self.cached[kind] = self.cached.get(kind, 0) + count
+            self.slowest = sorted(self.slowest + other.slowest, reverse=True)[:self.slowest_kept]
+            self.extra.merge(other.extra if extra is None else extra)
+
+    # add the command counts of another run to these and take over its run time, for collectord.py
+    def add(self, other):
+        self.merge(other, Registry())
+        with self.lock:
+            self.slowest = other.slowest
+            self.extra = other.extra
+            self.duration = other.duration
+            self.cpu = other.cpu
+            self.series = other.series
+
+    def registry(self):
+        registry = Registry()
+        labels = Labels(collector=self.collector)
+        registry.family('textfile_collector_duration_seconds', 'Wall clock time of the last collector run').add(labels, round(self.duration, 3))
+        registry.family('textfile_collector_cpu_seconds', 'CPU time used by the collector process during the last run').add(labels, round(self.cpu, 3))
+        registry.family('textfile_collector_series', 'Number of series in the last collector output').add(labels, self.series)
+
+        latency = registry.family('textfile_collector_command_duration_seconds', 'Time taken by the commands the collector runs', 'histogram')
+        exits = registry.family('textfile_collector_commands_total', 'Commands run by the collector by exit status, timeout if it did not finish', 'counter')
+        with self.lock:
+            for kind, (counts, count, total) in self.latency.items():
+                latency.add_histogram(labels.prefixed(kind=kind), command_buckets, counts, count, round(total, 3))
+            for (kind, status), count in self.exits.items():
+                exits.add(labels.prefixed(kind=kind, exit_status=status), count)
+            if self.cached:
+                cached = registry.family('textfile_collector_commands_cached_total',
+                    'Commands answered with the output of an earlier run of the same command', 'counter')
+                for kind, count in self.cached.items():
+                    cached.add(labels.prefixed(kind=kind), count)
+        registry.merge(self.extra)
+        return registry
+
+
+class CommandRunner:
+    # timeout:  seconds allowed for any single command (None for no limit)
+    # budget:  seconds allowed for all commands in this run together (None for no limit)
+    # transport:  what actually runs the commands, LocalTransport by default
+    # stats:  RunStats to record every command in, or None
+    def __init__(self, timeout=None, budget=None, transport=None, stats=None):
+        self.timeout = timeout
+        self.deadline = Deadline(budget)
+        self.transport = transport or LocalTransport()
+        self.stats = stats
+
+    # the effective timeout of the next command is whichever of the per-command timeout
+    # and the remaining run budget is shorter
+    def next_timeout(self):
+        remaining = self.deadline.remaining()
+        if remaining is None:
+            return self.timeout
+        if self.timeout is None:
+            return remaining
+        return min(self.timeout, remaining)
+
+    # run a command and return (returncode, stdout bytes), stderr is discarded
+    # raises CommandTimeout if the command did not finish in time or the run budget is used up
+    # kind labels the command in the instrumentation, the tool name if not given
+    def run(self, cmd, env=None, kind=None):
+        kind = kind or os.path.basename(cmd[0])
+        timeout = self.next_timeout()
+        if timeout is not None and timeout <= 0:
+            if self.stats:
+                self.stats.command(cmd, kind, 0.0, 'timeout')
+            raise CommandTimeout(cmd, 0)
+
+        start = time.monotonic()
+        try:
+            rc, output = self.transport.run(cmd, env, timeout)
+        except CommandTimeout:
+            if self.stats:
+                self.stats.command(cmd, kind, time.monotonic() - start, 'timeout')
+            raise
+        if self.stats:
+            self.stats.command(cmd, kind, time.monotonic() - start, rc)
+        return rc, output
+
+    # like run() but raises subprocess.CalledProcessError on non-zero exit, same as subprocess.check_output
+    def check_output(self, cmd, env=None, kind=None):
+        rc, output = self.run(cmd, env=env, kind=kind)
+        if rc != 0:
+            raise subprocess.CalledProcessError(rc, cmd, output=output)
+        return output
+
+    # check_output() and decode the JSON, raises json.JSONDecodeError (a ValueError) if it isn't
+    # with max_age the decoded output is shared through results and a run of the same command up to max_age
+    # seconds old is used instead of running it again, the caller must not change what it gets back then
+    def check_json(self, cmd, env=None, kind=None, max_age=0):
+        fetch = lambda: loads(self.check_output(cmd, env=env, kind=kind))
+        if not max_age:
+            return fetch()
+        key = (getattr(self.transport, 'scope', None) or id(self.transport), command_key(cmd))
+        value, hit = results.get(key, max_age, fetch)
+        if hit and self.stats:
+            self.stats.cache_hit(kind or os.path.basename(cmd[0]))
+        return value
+
+
+class TextfileWriter:
+    def __init__(self):
+        # path -> digest of what we last wrote there, so a long running process doesn't have to read it back
+        self.digests = {}
+
+    # write text to path through a temp file in the same directory and a rename, unless the file already
+    # has exactly this content.  Returns True if the file was written.
+    def write(self, path, text):
+        data = text.encode('utf-8')
+        digest = hashlib.sha256(data).digest()
+
+        last = self.digests.get(path)
+        if last is None:
+            # first write from this process, compare against whatever an earlier run left there
+            try:
+                with open(path, 'rb') as fh:
+                    last = hashlib.sha256(fh.read()).digest()
+            except OSError:
+                pass
+
+        if last == digest:
+            self.digests[path] = digest
+            return False
+
+        tmp = '{}.{}'.format(path, os.getpid())
+        with open(tmp, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+        self.digests[path] = digest
+        return True
+
+    # write the rendered output of a successful collector run and its status file next to it
+    # stats is the RunStats of the run, its series go in the status file
+    def write_collector(self, path, collector, text, stats=None):
+        changed = self.write(path, text)
+        status = Registry()
+        status.family('textfile_collector_last_success_timestamp_seconds',
+            'Time the collector last finished a run without error').add(Labels(collector=collector), int(time.time()))
+        if stats is not None:
+            status.merge(stats.registry())
+        # always rewritten, this is the one thing that is supposed to change every run
+        self.digests.pop(status_path(path), None)
+        self.write(status_path(path), status.render())
+        return changed
+
+# status file for the output file, smartinfo.prom -> smartinfo.status.prom
+def status_path(path):
+    base = path[:-len('.prom')] if path.endswith('.prom') else path
+    return base + '.status.prom'
+
+# files in the textfile directory written by collectors that were replaced since, diskinfo.sh wrote diskinfo.sh.prom
+# node_exporter keeps exporting a file until it is gone, the old one would duplicate the families of the new one
+replaced_outputs = { 'diskinfo': ('diskinfo.sh.prom',) }
+
+# remove what the collector this one replaced left in directory, for runcollectors.py and collectord.py
+def remove_replaced(directory, collector):
+    for filename in replaced_outputs.get(collector, ()):
+        try:
+            os.unlink(os.path.join(directory, filename))
+        except FileNotFoundError:
+            pass
+
+# shared --output option for the collector scripts
+def add_output_args(parser):
+    parser.add_argument('--output', metavar='FILE',
+        help='Write to this .prom file (only if the content changed) instead of stdout, '
+            'and the last successful run time to the matching .status.prom file')
+
+# shared --record/--replay options for the collector scripts
+def add_replay_args(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--record', metavar='DIR', help='Save every command and its output to DIR/commands.json')
+    group.add_argument('--replay', metavar='DIR',
+        help='Answer commands from DIR/commands.json instead of running them, and use DIR/sys as sysfs if it exists')
+
+# remotepoll.py hands the transport for the host it runs a collector for in args.transport
+def transport_from_args(args):
+    if getattr(args, 'transport', None) is not None:
+        return args.transport
+    if getattr(args, 'replay', None):
+        return ReplayTransport(args.replay)
+    if getattr(args, 'record', None):
+        return RecordingTransport(args.record)
+    return None
+
+# --command-max-age for the collectors that run commands through check_json() with max_age
+def add_command_cache_args(parser, default=30):
+    parser.add_argument('--command-max-age', type=float, default=default,
+        help='Reuse the decoded output of a command run up to this many seconds ago, by this collector or another one '
+            'in the same process (collectord.py, remotepoll.py), 0 to always run it (default: {:g})'.format(default))
+
+# shared --profile-threshold/--profile-output options for the collector scripts
+def add_profile_args(parser):
+    parser.add_argument('--profile-threshold', type=float, metavar='SECONDS',
+        help='Profile the run and write a summary if it takes longer than this')
+    parser.add_argument('--profile-output', metavar='FILE', help='Append the profile summary to FILE instead of stderr')
+
+# call fn() under cProfile if --profile-threshold is set, and write a summary if the run was slow
+# only the calling thread is profiled, for commands run from a thread pool the slowest commands
+# from stats are the useful part
+def profiled(args, fn, stats=None):
+    threshold = getattr(args, 'profile_threshold', None)
+    if threshold is None:
+        return fn()
+
+    profile = cProfile.Profile()
+    start = time.monotonic()
+    profile.enable()
+    try:
+        return fn()
+    finally:
+        profile.disable()
+        elapsed = time.monotonic() - start
+        if elapsed >= threshold:
+            out = io.StringIO()
+            out.write('# {} run took {:.2f}s (threshold {:.2f}s) at {}\n'.format(
+                stats.collector if stats else sys.argv[0], elapsed, threshold, time.strftime('%Y-%m-%d %H:%M:%S')))
+            if stats and stats.slowest:
+                out.write('# slowest commands\n')
+                for seconds, key in stats.slowest:
+                    out.write('{:10.3f}s  {}\n'.format(seconds, key))
+            pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(25)
+            if getattr(args, 'profile_output', None):
+                with open(args.profile_output, 'a') as fh:
+                    fh.write(out.getvalue())
+            else:
+                sys.stderr.write(out.getvalue())
+
+# collector run by remotepoll.py for another host, which has to get everything through commands
+def is_remote(args):
+    return bool(getattr(args, 'remote', None))
+
+# sysfs root for the collector, --sysfs-root wins over the one in a --replay directory
+# None for another host, our /sys is not its /sys
+def sysfs_root(args):
+    if getattr(args, 'sysfs_root', None):
+        return args.sysfs_root
+    if getattr(args, 'replay', None) and os.path.isdir(os.path.join(args.replay, 'sys')):
+        return os.path.join(args.replay, 'sys')
+    if is_remote(args):
+        return None
+    return '/sys'
+
+# print the registry of a collector run or write it to --output
+# with stats the instrumentation series go to the status file, or after the output on stdout
+def emit(args, collector, registry, stats=None):
+    if stats is not None:
+        stats.finish(registry)
+    text = registry.render()
+    if args.output:
+        TextfileWriter().write_collector(args.output, collector, text, stats)
+    else:
+        if stats is not None:
+            text += stats.registry().render()
+        sys.stdout.write(text)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+#
+# Look through the --snapshots files the collectors keep (see snapshotstore.py) without going to prometheus
+#
+# changes:  every disk added, removed or replaced, OSD moved to other devices and drive put in or taken out
+#           of an enclosure slot, oldest first
+# show:     what the collector found at a point in time, the latest run by default
+#
+# Several files can be given at once, like the files of every host remotepoll.py keeps.  --match keeps the rows
+# with the text in the key or one of the values, so the history of one serial or slot is easy to follow.
+# Times are seconds since the epoch, YYYY-MM-DD[THH:MM[:SS]] in local time, or a duration back from now like 7d.
+#
+# Examples:  diskhistory.py changes /var/tmp/smartinfo-snapshots.bin --since 30d
+#            diskhistory.py changes /var/tmp/remotepoll/*/enclosureinfo-snapshots.bin --match 5000c500a1b2c3d4
+#            diskhistory.py show /var/tmp/osdinfo-snapshots.bin --at 2024-03-01
+
+import argparse
+import json
+import sys
+import time
+
+from snapshotstore import SnapshotStore
+
+units = { 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400 }
+
+def parse_time(text):
+    text = text.strip()
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    if text[:-1].isdigit() and text[-1:] in units:
+        return time.time() - int(text[:-1]) * units[text[-1]]
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(text, fmt))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError('not a time: {}'.format(text))
+
+def format_time(seconds):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(seconds))
+
+def matches(match, *texts):
+    return not match or any(match in text for text in texts)
+
+def changes(args):
+    rows = []
+    for path in args.files:
+        for when, key, old, new, change in SnapshotStore.load(path).history():
+            if args.since is not None and when < args.since or args.until is not None and when > args.until:
+                continue
+            if matches(args.match, key, old, new):
+                rows.append({ 'time': when, 'file': path, 'key': key, 'change': change, 'old': old, 'new': new })
+    rows.sort(key=lambda row: row['time'])
+
+    if args.json:
+        json.dump(rows, sys.stdout, indent=1)
+        sys.stdout.write('\n')
+        return
+    for row in rows:
+        line = [ format_time(row['time']), row['change'], row['key'], '{} -> {}'.format(row['old'] or '-', row['new'] or '-') ]
+        if len(args.files) > 1:
+            line.insert(1, row['file'])
+        print('  '.join(line))
+
+def show(args):
+    result = {}
+    for path in args.files:
+        store = SnapshotStore.load(path)
+        result[path] = { key: value for key, value in store.rows_at(args.at).items() if matches(args.match, key, value) }
+
+    if args.json:
+        json.dump(result if len(args.files) > 1 else result[args.files[0]], sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write('\n')
+        return
+    for path, rows in result.items():
+        for key in sorted(rows):
+            line = [ key, rows[key] or '-' ]
+            if len(args.files) > 1:
+                line.insert(0, path)
+            print('  '.join(line))
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Show the disk, OSD and enclosure slot history the collectors keep in --snapshots')
+    parser.add_argument('command', choices=['changes', 'show'], help='What to show')
+    parser.add_argument('files', nargs='+', help='--snapshots file of a collector')
+    parser.add_argument('--since', type=parse_time, help='changes: only the ones at or after this time')
+    parser.add_argument('--until', type=parse_time, help='changes: only the ones at or before this time')
+    parser.add_argument('--at', type=parse_time, help='show: the state at this time instead of the latest')
+    parser.add_argument('--match', help='Only rows with this text in the key or a value (device, serial, WWN, OSD, slot)')
+    parser.add_argument('--json', action='store_true', help='Print JSON instead of text')
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    if args.command == 'changes':
+        changes(args)
+    else:
+        show(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+#
+# Join what the other collectors know about each physical disk into one series, so dashboards and alerts
+# don't have to join smart_disk_info, ceph_osd_device_info, enclosure_drive_info and node_disk_info themselves.
+#
+# storage_disk_identity{device="sdc", serial="ZA12AB34", wwn="5000c500a1b2c3d4", model="ST8000NM0075",
+#     paths="sdc,sdbk", ceph_daemon="osd.12", osd_device_type="block", cluster="ceph",
+#     enclosure_serial="TAG0001", enclosure_slot="17", drawer="1", drawer_slot="5"} 1
+#
+# One series per physical disk, keyed by serial.  device is the kernel name smartinfo.py reports the disk under
+# (the first path of a multipath disk, nvme0n1 for the first namespace) so it joins one-to-one with the smart_disk_*
+# series on (instance, device).  paths are all kernel names of the disk.  Labels we don't know are empty.
+# A disk behind a MegaRAID controller has no kernel name, its device is the name smartinfo.py gives it
+# (megaraid_disk_23) and it is indexed apart from the kernel names, with empty paths.
+# A DB/WAL disk shared by several OSDs has an empty ceph_daemon, ceph_osd_device_info has which ones they are.
+#
+# Sources, indexed by serial, WWN and kernel name in one pass:
+# smartinfo.py output    smart_disk_info: device, serial and model
+# lsblk                  kernel name, serial and WWN of every disk and path, and the model if smartctl had none
+# osdinfo.py output      ceph_osd_device_info: the OSD each kernel name belongs to
+# enclosureinfo.py output  enclosure_drive_info: slot of each serial or WWN
+#
+# Run after the other collectors, it reads their last output from --textfile-dir (<name>.prom as collectord.py
+# writes it, or <name>.py.prom from metrics.sh).  collectord.py hands over the output in memory instead.
+
+import argparse
+import os
+import re
+import sys
+
+from collectorlib import CommandRunner, RunStats, add_command_cache_args, add_output_args, add_profile_args, add_replay_args, emit, profiled, transport_from_args
+from exposition import Labels, Registry, parse
+from summary import samples
+
+lsblk = '/bin/lsblk'
+
+# device name smartinfo.py uses for a disk behind a MegaRAID controller
+megaraid_prefix = 'megaraid_disk_'
+
+# collectors whose output is joined here, collectord.py passes their last output to collect()
+inputs = ('smartinfo', 'osdinfo', 'enclosureinfo')
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Join disk identity from the other storage collectors into one series per disk')
+    # metrics.sh passes the cluster name to every script, we just ignore it
+    parser.add_argument('cluster', nargs='?', help=argparse.SUPPRESS)
+    parser.add_argument('--textfile-dir', default='/var/cache/metrics',
+        help='Directory with the output of the other collectors (default: /var/cache/metrics)')
+    parser.add_argument('--timeout', type=float, default=60,
+        help='Seconds allowed for the lsblk call (default: 60)')
+    add_command_cache_args(parser)
+    add_output_args(parser)
+    add_replay_args(parser)
+    add_profile_args(parser)
+    return parser
+
+# the collector can't do anything without the CLI tool
+def available():
+    return os.path.isfile(lsblk)
+
+# last output of a collector from the textfile directory, an empty Registry if there isn't any
+def read_output(textfile_dir, name):
+    for filename in ['{}.prom'.format(name), '{}.py.prom'.format(name)]:
+        try:
+            with open(os.path.join(textfile_dir, filename)) as fh:
+                return parse(fh.read())
+        except OSError:
+            continue
+    return Registry()
+
+# lsblk and enclosureinfo write WWNs differently (0x5000c500..., 5000C500...)
+def normal_wwn(wwn):
+    wwn = (wwn or '').lower()
+    return wwn[2:] if wwn.startswith('0x') else wwn
+
+# sort key for kernel names with the numbers in them compared as numbers, nvme0n2 before nvme0n10
+def natural_key(name):
+    return [ int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name) ]
+
+# kernel name -> (serial, wwn, model) for every disk lsblk knows about
+def get_lsblk(runner, max_age=0):
+    cmd = [lsblk, '--json', '--nodeps', '--output', 'KNAME,SERIAL,WWN,MODEL']
+    disks = {}
+    for dev in runner.check_json(cmd, kind='lsblk', max_age=max_age)['blockdevices']:
+        if dev.get('serial'):
+            disks[dev['kname']] = (dev['serial'].strip(), normal_wwn(dev.get('wwn')), (dev.get('model') or '').strip())
+    return disks
+
+# index of physical disks, every disk is a dictionary of its labels
+class DiskIndex:
+    labels = ('device', 'serial', 'wwn', 'model', 'paths', 'cluster', 'ceph_daemon', 'osd_device_type',
+        'enclosure_serial', 'enclosure_slot', 'drawer', 'drawer_slot')
+
+    def __init__(self):
+        self.by_serial = {}
+        self.by_wwn = {}
+        self.by_kname = {}
+        self.by_megaraid = {}
+
+    def disk(self, serial):
+        if serial not in self.by_serial:
+            self.by_serial[serial] = { 'serial': serial, 'paths': [] }
+        return self.by_serial[serial]
+
+    # a kernel name belongs to one disk, lsblk is added after smartinfo and has the last word
+    def add_path(self, kname, serial, wwn=''):
+        disk = self.disk(serial)
+        old = self.by_kname.get(kname)
+        if old is not None and old is not disk:
+            old['paths'].remove(kname)
+        if kname not in disk['paths']:
+            disk['paths'].append(kname)
+        self.by_kname[kname] = disk
+        if wwn:
+            disk.setdefault('wwn', wwn)
+            self.by_wwn[wwn] = disk
+
+    def add_smart(self, registry):
+        for labels, _ in samples(registry, 'smart_disk_info'):
+            serial = labels.get('serial')
+            device = labels.get('device')
+            if not serial:
+                continue
+            disk = self.disk(serial)
+            # namespaces of one nvme device all have the serial, the first one is the device
+            if 'device' not in disk or natural_key(device) < natural_key(disk['device']):
+                disk['device'] = device
+            disk['model'] = labels.get('model', '')
+            if device.startswith(megaraid_prefix):
+                self.by_megaraid[device] = disk
+            else:
+                self.add_path(device, serial)
+
+    def add_lsblk(self, disks):
+        for kname, (serial, wwn, model) in sorted(disks.items()):
+            self.add_path(kname, serial, wwn)
+            disk = self.by_kname[kname]
+            if model and not disk.get('model'):
+                disk['model'] = model
+
+    # ceph_osd_device_info has the LV, the dm devices and the physical paths of each OSD device
+    # only the physical ones are in the index by kernel name
+    # a disk can hold the DB/WAL of several OSDs, it gets the OSD only if there is just one
+    def add_osd(self, registry):
+        osds = {}
+        for labels, _ in samples(registry, 'ceph_osd_device_info'):
+            disk = self.by_kname.get(labels.get('device'))
+            if disk is None:
+                continue
+            found = osds.setdefault(disk['serial'], (disk, set(), set(), set()))
+            found[1].add(labels.get('cluster', ''))
+            found[2].add(labels.get('ceph_daemon', ''))
+            found[3].add(labels.get('type', ''))
+
+        for disk, clusters, daemons, types in osds.values():
+            disk['cluster'] = ','.join(sorted(clusters))
+            disk['ceph_daemon'] = daemons.pop() if len(daemons) == 1 else ''
+            disk['osd_device_type'] = ','.join(sorted(types))
+
+    def add_enclosure(self, registry):
+        for labels, _ in samples(registry, 'enclosure_drive_info'):
+            disk = self.by_serial.get(labels.get('serial'))
+            if disk is None:
+                disk = self.by_wwn.get(normal_wwn(labels.get('wwn')))
+            if disk is None:
+                continue
+            for name in ('enclosure_serial', 'enclosure_slot', 'drawer', 'drawer_slot'):
+                disk[name] = labels.get(name, '')
+
+    def add_to(self, family):
+        for serial in sorted(self.by_serial):
+            disk = self.by_serial[serial]
+            values = dict(disk, paths=','.join(sorted(disk['paths'], key=natural_key)))
+            values.setdefault('device', min(disk['paths'], key=natural_key) if disk['paths'] else '')
+            family.add(Labels(**{ name: values.get(name, '') for name in self.labels }), 1)
+
+# run a full collection and return a Registry with the output
+# registries is { collector name: Registry } with the last output of the inputs, read from --textfile-dir if None
+def collect(args, stats=None, registries=None):
+    runner = CommandRunner(timeout=args.timeout, transport=transport_from_args(args), stats=stats)
+    if registries is None:
+        registries = { name: read_output(args.textfile_dir, name) for name in inputs }
+
+    index = DiskIndex()
+    index.add_smart(registries.get('smartinfo', Registry()))
+    index.add_lsblk(get_lsblk(runner, args.command_max_age))
+    index.add_osd(registries.get('osdinfo', Registry()))
+    index.add_enclosure(registries.get('enclosureinfo', Registry()))
+
+    registry = Registry()
+    index.add_to(registry.family('storage_disk_identity',
+        'One series per physical disk joining its kernel names, serial, WWN, OSD and enclosure slot'))
+    return registry
+
+def main():
+    args = build_parser().parse_args()
+
+    if not available() and not args.replay:
+        sys.exit(1)
+
+    stats = RunStats('diskidentity')
+    emit(args, 'diskidentity', profiled(args, lambda: collect(args, stats), stats), stats)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+#
+# associate every block device with human friendly name and mountpoint (mountpoint may be empty string)
+#
+# node_disk_info{mountpoint="/var/lib/ceph", devname="vg0-ceph", device="dm-3"} 1
+#
+# This used to be diskinfo.sh around 'lsblk -ln -o KNAME,NAME,MOUNTPOINT'.  Now the devices come from the
+# sysfs index shared with osdinfo.py (see sysfsindex.py) and the mountpoints from /proc/self/mountinfo
+# and /proc/swaps, without running anything.  Every device is listed once even if it sits below several others
+# (mpath under two sd paths), devname is the device mapper name for dm devices and the kernel name otherwise,
+# and swap shows up as [SWAP] like lsblk has it.
+
+import argparse
+import os
+import sys
+
+from collectorlib import RunStats, add_output_args, add_profile_args, add_replay_args, emit, profiled, sysfs_root
+from exposition import Labels, Registry
+from sysfsindex import shared_graph
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Block device names and mountpoints as prometheus series')
+    # metrics.sh passes the cluster name to every script, we just ignore it
+    parser.add_argument('cluster', nargs='?', help=argparse.SUPPRESS)
+    parser.add_argument('--sysfs-max-age', type=float, default=30,
+        help='Reuse a walk of /sys/block by another collector in the same process (collectord.py) up to this many seconds old (default: 30)')
+    parser.add_argument('--sysfs-root', help=argparse.SUPPRESS)
+    parser.add_argument('--proc-root', help=argparse.SUPPRESS)
+    add_output_args(parser)
+    add_replay_args(parser)
+    add_profile_args(parser)
+    return parser
+
+# nothing to run, sysfs is enough
+def available():
+    return os.path.isdir('/sys/block')
+
+# /proc for mountinfo and swaps, DIR/proc with --replay if it's there
+def proc_root(args):
+    if args.proc_root:
+        return args.proc_root
+    if args.replay and os.path.isdir(os.path.join(args.replay, 'proc')):
+        return os.path.join(args.replay, 'proc')
+    return '/proc'
+
+# mountinfo escapes space, tab, newline and backslash as octal
+def unescape_mount(path):
+    for code, char in (('\\040', ' '), ('\\011', '\t'), ('\\012', '\n'), ('\\134', '\\')):
+        path = path.replace(code, char)
+    return path
+
+# 'major:minor' -> mountpoint, the first mount of the whole filesystem wins over bind mounts of a part of it
+def read_mounts(proc):
+    mounts = {}
+    try:
+        with open(os.path.join(proc, 'self', 'mountinfo')) as fh:
+            lines = fh.readlines()
+    except OSError:
+        return mounts
+
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 5:
+            continue
+        devnum, root, mountpoint = fields[2], fields[3], unescape_mount(fields[4])
+        if devnum not in mounts or (root == '/' and mounts[devnum][0] != '/'):
+            mounts[devnum] = (root, mountpoint)
+    return { devnum: mountpoint for devnum, (root, mountpoint) in mounts.items() }
+
+# kernel names of active swap devices
+def read_swaps(proc):
+    swaps = set()
+    try:
+        with open(os.path.join(proc, 'swaps')) as fh:
+            lines = fh.readlines()[1:]
+    except OSError:
+        return swaps
+    for line in lines:
+        fields = line.split()
+        if fields and fields[0].startswith('/dev/'):
+            # /dev/mapper/vg-swap is a link to ../dm-1
+            swaps.add(os.path.basename(os.path.realpath(fields[0])))
+    return swaps
+
+# run a full collection and return a Registry with the output
+def collect(args, stats=None):
+    graph = shared_graph(sysfs_root(args), args.sysfs_max_age, details=True)
+    proc = proc_root(args)
+    mounts = read_mounts(proc)
+    swaps = read_swaps(proc)
+
+    registry = Registry()
+    series = registry.family('node_disk_info', 'Block device kernel name with its device mapper or kernel name and mountpoint')
+
+    # every device and partition once, by its sysfs name instead of the old substring test which mixed up sda and sdaa
+    # loop devices without a backing file are left out like lsblk does
+    for name in sorted(graph.slaves):
+        for kname in [name] + graph.partitions.get(name, []):
+            if kname in graph.empty and kname.startswith('loop'):
+                continue
+
+            if kname in swaps:
+                mountpoint = '[SWAP]'
+            else:
+                mountpoint = mounts.get(graph.devnums.get(kname), '')
+            series.add(Labels(mountpoint=mountpoint, devname=graph.dm_name(kname) or kname, device=kname), 1)
+
+    return registry
+
+def main():
+    args = build_parser().parse_args()
+
+    if not available() and not args.replay:
+        sys.exit(1)
+
+    stats = RunStats('diskinfo')
+    emit(args, 'diskinfo', profiled(args, lambda: collect(args, stats), stats), stats)
+
+if __name__ == '__main__':
+    main()
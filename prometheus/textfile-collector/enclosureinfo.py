@@ -12,19 +12,62 @@
 # for the enclosure_drive_slot_status a missing drive is a warn, a bad slot status is critical
 # (tools report slot status OK even if a drive is totally dead or dying)
 
-import subprocess
+# enclosure_scrape_timeout is set to 1 for a component listing (or the enclosure listing) which did not return 
+# within --timeout or the --budget for the whole run.  The other components are still reported, and enclosure_status
+# of the enclosure is at least 1 (warn) so a component we couldn't see doesn't look healthy.
+
+# storage_disk_changed_total{collector="enclosureinfo",change} counts drives put into (added), taken out of (removed)
+# or swapped in (replaced) enclosure slots since --snapshots was started, and
+# enclosure_slot_changes_total{enclosure_wwn,enclosure_slot,change="populated"|"removed"|"replaced"} the same per slot,
+# only for slots that had any.  See snapshotstore.py, diskhistory.py shows when and which drive.
+
+# --summary adds per host counts of enclosures and slots by status, the worst status and highest temperature
+# (enclosure_summary_*, see summary.py).  --detail unhealthy keeps only the component series with a non-zero
+# status, enclosure_status is always there.  Without healthy slots diskidentity.py can't place their disks.
+
 import os
 import json
 import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from collectorlib import CommandRunner, CommandTimeout, RunStats, add_command_cache_args, add_output_args, add_profile_args, add_replay_args, emit, profiled, transport_from_args
+from snapshotstore import add_snapshot_args, record
+from summary import add_max, add_status_counts, add_summary_args, drop_healthy, samples, wants_summary
+from exposition import Labels, Registry
+
+# secli has no listing of every component at once, so each component of each enclosure is still its own call.
+# The decoded answers are shared with other runs in the same process (collectord.py) for --command-max-age seconds,
+# see collectorlib.ResultCache.
 
 # Default installation is /opt/dell/StorageEnclosureManagement/StorageEnclosureCLI/bin/secli
 cli = '/opt/dell/StorageEnclosureManagement/StorageEnclosureCLI/bin/secli'
 
-if not os.path.isfile(cli):
-    sys.exit(1)
+def build_parser():
+    parser = argparse.ArgumentParser(description='Collect Dell storage enclosure status as prometheus series')
+    # metrics.sh passes the cluster name to every script, we just ignore it
+    parser.add_argument('cluster', nargs='?', help=argparse.SUPPRESS)
+    parser.add_argument('--timeout', type=float, default=60,
+        help='Seconds allowed for a single secli call before it is reported as timed out (default: 60)')
+    parser.add_argument('--budget', type=float, default=240,
+        help='Seconds allowed for the whole run, components not queried in time are reported as timed out (default: 240)')
+    parser.add_argument('--jobs', type=int, default=5,
+        help='Number of secli calls to run at the same time across all enclosures and components (default: 5)')
+    add_command_cache_args(parser)
+    add_snapshot_args(parser, 'enclosureinfo')
+    add_summary_args(parser)
+    add_output_args(parser)
+    add_replay_args(parser)
+    add_profile_args(parser)
+    return parser
+
+# the collector can't do anything without the CLI tool
+def available():
+    return os.path.isfile(cli)
 
 # secli expects to find utilities in path (lspci, etc) which may be in sbin
-nenv = os.environ
+# (copy so we don't change the environment of everything else running in collectord.py)
+nenv = dict(os.environ)
 nenv['PATH']= nenv['PATH'] + ':/sbin:/usr/sbin'
 
 # three element tuple 
@@ -59,14 +102,16 @@ mapbool = {
 }
 
 # fetch data using command from cli var and return an array of dictionaries as decoded from the JSON results
-def fetch_data(type,enc=None):
+# raises CommandTimeout if secli does not answer in time
+# a comment is added to the registry if the JSON can't be decoded
+# the decoded output is shared for max_age seconds (see collectorlib.ResultCache) and not changed here
+def fetch_data(runner, registry, type, enc=None, max_age=0):
     cmd = [cli, mapcmd[type][0], '-outputformat=json']
     if type != 'enc':
         cmd = cmd + [ '-enc={0}'.format(enc) ]
 
     try:
-        json_data = subprocess.check_output(cmd,env=nenv, stderr=subprocess.DEVNULL)
-        decoded = json.loads(json_data)
+        decoded = runner.check_json(cmd, env=nenv, kind=type, max_age=max_age)
         # print(decoded)
         # many component listings are repeated
         # Ex:  decoded['Responses']['Response']['Fans'][0-1]['Fan'][0...x fans] 
@@ -93,141 +138,257 @@ def fetch_data(type,enc=None):
             return components
     except json.JSONDecodeError as err:
         # continue and try to fetch other outputs
-        print("# Bad JSON returned for {}: {}".format(type, err.msg))
+        registry.comment("Bad JSON returned for {}: {}".format(type, err.msg))
+        return []
     except:
         raise
 
-enclosures = fetch_data('enc')
+# component listings fetched for every enclosure
+# our hardware does not have current sensors so I don't know what fields are in the output
+components = ['driveslot', 'ps', 'fan', 'temp', 'voltage']
+
+# fetch every component list of every enclosure, up to 'jobs' secli calls at a time
+# each call takes about as long as the tool takes to start so the whole thing takes about as long as the slowest one
+# returns { (enclosure wwid, component): [ components ] }
+# a timeout is reported and the component is left empty so the rest of the enclosure (and the other enclosures) still get output
+def fetch_components(runner, registry, enclosures, jobs, max_age=0):
+    fetched = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        futures = {}
+        for enclosure in enclosures:
+            for type in components:
+                key = (enclosure['EnclosureWWID'], type)
+                futures[key] = pool.submit(fetch_data, runner, registry, type, enclosure['EnclosureWWID'], max_age)
+
+        for key, future in futures.items():
+            try:
+                fetched[key] = future.result()
+            except CommandTimeout:
+                timeout_family(registry).add(Labels(component=key[1], enclosure_wwn=key[0]), 1)
+                fetched[key] = []
+    return fetched
+
+def timeout_family(registry):
+    return registry.family('enclosure_scrape_timeout', 'Component listing did not return within the timeout or run budget')
+
+# output metric families
+families = {
+    'drive_info': ('enclosure_drive_info', 'Drive serial and WWN in each enclosure slot'),
+    'slot': ('enclosure_slot_status', 'Drive slot status.  0 = OK, 2 = slot failed or no drive'),
+    'power': ('enclosure_power_status', 'Power supply status.  0 = OK, 1 = WARN, 2 = CRIT'),
+    'power_ac': ('enclosure_power_ac_status', 'Power supply AC failed.  0 = OK, 2 = failed'),
+    'power_dc': ('enclosure_power_dc_status', 'Power supply DC failed.  0 = OK, 2 = failed'),
+    'fan': ('enclosure_fan_status', 'Fan status.  0 = OK, 1 = WARN, 2 = CRIT'),
+    'fan_rpm': ('enclosure_fan_speed_rpm', 'Fan speed'),
+    'temp': ('enclosure_temp_celsius', 'Temperature sensor reading'),
+    'temp_status': ('enclosure_temp_status', 'Temperature sensor status.  0 = OK, 1 = WARN, 2 = CRIT'),
+    'volt': ('enclosure_voltage_status', 'Voltage sensor status.  0 = OK, 1 = WARN, 2 = CRIT'),
+    'volt_over': ('enclosure_voltage_over_status', 'Voltage over threshold.  0 = OK, 1 = WARN, 2 = CRIT'),
+    'volt_under': ('enclosure_voltage_under_status', 'Voltage under threshold.  0 = OK, 1 = WARN, 2 = CRIT'),
+    'status': ('enclosure_status', 'Worst status of any enclosure component, 2 if the enclosure has alarms, at least 1 if a component listing timed out.  0 = OK, 1 = WARN, 2 = CRIT'),
+}
+
+# per host summaries, see summary.py
+summary_families = {
+    'status': ('enclosure_summary_status_max', 'Worst enclosure_status of all enclosures.  0 = OK, 1 = WARN, 2 = CRIT'),
+    'enclosures': ('enclosure_summary_enclosures', 'Number of enclosures by enclosure_status'),
+    'slots': ('enclosure_summary_slots', 'Number of drive slots by enclosure_slot_status'),
+    'temp': ('enclosure_summary_temp_celsius_max', 'Highest temperature sensor reading of all enclosures'),
+}
+
+# component series kept with --detail unhealthy if any of the status series of the component is non-zero
+# enclosure_status and timeouts are per enclosure and always kept
+detail_groups = [
+    (('enclosure_slot_status',), ('enclosure_wwn', 'enclosure_slot'), ('enclosure_slot_status', 'enclosure_drive_info')),
+    (('enclosure_power_status', 'enclosure_power_ac_status', 'enclosure_power_dc_status'), ('enclosure_wwn', 'name'),
+        ('enclosure_power_status', 'enclosure_power_ac_status', 'enclosure_power_dc_status')),
+    (('enclosure_fan_status',), ('enclosure_wwn', 'name'), ('enclosure_fan_status', 'enclosure_fan_speed_rpm')),
+    (('enclosure_temp_status',), ('enclosure_wwn', 'name'), ('enclosure_temp_status', 'enclosure_temp_celsius')),
+    (('enclosure_voltage_status', 'enclosure_voltage_over_status', 'enclosure_voltage_under_status'), ('enclosure_wwn', 'name'),
+        ('enclosure_voltage_status', 'enclosure_voltage_over_status', 'enclosure_voltage_under_status')),
+]
+
+# snapshot changes of a slot as they are called in enclosure_slot_changes_total
+slot_changes = { 'added': 'populated', 'removed': 'removed', 'replaced': 'replaced' }
+
+# '<enclosure wwn> <slot>' -> drive WWN in the snapshot, and the per slot change counts from its history
+# slots of an enclosure whose listing timed out keep what they had
+def record_slots(args, registry, timed_out):
+    rows = { '{} {}'.format(labels.get('enclosure_wwn'), labels.get('enclosure_slot')): labels.get('wwn')
+        for labels, _ in samples(registry, 'enclosure_drive_info') }
+    store = record(args, registry, 'enclosureinfo', rows, lambda key: key.split(' ')[0] in timed_out)
+    if store is None:
+        return
+
+    counts = {}
+    for _, key, _, _, change in store.history():
+        wwn, _, slot = key.partition(' ')
+        counts[(wwn, slot, slot_changes[change])] = counts.get((wwn, slot, slot_changes[change]), 0) + 1
+    family = registry.family('enclosure_slot_changes_total', 'Drives put into, taken out of or swapped in the slot since --snapshots was started', 'counter')
+    for (wwn, slot, change), count in counts.items():
+        family.add(Labels(enclosure_wwn=wwn, enclosure_slot=slot, change=change), count)
+
+def add_summary(registry):
+    summary = { key: registry.family(name, help) for key, (name, help) in summary_families.items() }
+    enclosures = [ v for _, v in samples(registry, 'enclosure_status') ]
+    add_max(summary['status'], enclosures)
+    add_status_counts(summary['enclosures'], enclosures)
+    add_status_counts(summary['slots'], [ v for _, v in samples(registry, 'enclosure_slot_status') ])
+    add_max(summary['temp'], [ v for _, v in samples(registry, 'enclosure_temp_celsius') ])
+
+# run a full collection and return a Registry with the output
+# every secli call is recorded in stats if given
+def collect(args, stats=None):
+    runner = CommandRunner(timeout=args.timeout, budget=args.budget, transport=transport_from_args(args), stats=stats)
+    registry = Registry()
+    series = { key: registry.family(name, help) for key, (name, help) in families.items() }
+
+    try:
+        enclosures = fetch_data(runner, registry, 'enc', max_age=args.command_max_age)
+    except CommandTimeout:
+        timeout_family(registry).add(Labels(component='enc', enclosure_wwn=''), 1)
+        return registry
 
-for enclosure in enclosures:
-    enc_status = {}
+    fetched = fetch_components(runner, registry, enclosures, args.jobs, args.command_max_age)
+    timed_out = { (labels.get('enclosure_wwn'), labels.get('component')) for labels, _ in samples(registry, 'enclosure_scrape_timeout') }
 
-    if int(enclosure['AlarmCount']) > 0:
-        enc_status['ac'] = 2
+    for enclosure in enclosures:
+        enc_status = {}
+
+        if int(enclosure['AlarmCount']) > 0:
+            enc_status['ac'] = 2
     
-    driveslots = fetch_data('driveslot',enclosure['EnclosureWWID'])
-    supplies = fetch_data('ps',enclosure['EnclosureWWID'])
-    fans = fetch_data('fan',enclosure['EnclosureWWID'])
-    temps = fetch_data('temp',enclosure['EnclosureWWID'])
-    volts = fetch_data('voltage', enclosure['EnclosureWWID'])
-
-    # our hardware does not have current sensors so I don't know what fields are in the output
-
-    # drives, fans, supplies, temps all share these labels
-    common_labels = 'enclosure_wwn="{}", enclosure_serial="{}", enclosure_name="{}"'.format(
-        enclosure['EnclosureWWID'],
-        enclosure['ServiceTag'],
-        enclosure['ProductName'])
+        wwid = enclosure['EnclosureWWID']
+        # what we didn't get to see can't count as OK
+        if any((wwid, type) in timed_out for type in components):
+            enc_status['timeout'] = 1
+        driveslots = fetched[(wwid, 'driveslot')]
+        supplies = fetched[(wwid, 'ps')]
+        fans = fetched[(wwid, 'fan')]
+        temps = fetched[(wwid, 'temp')]
+        volts = fetched[(wwid, 'voltage')]
+
+        # drives, fans, supplies, temps all share these labels
+        # escaped once and reused for every series of the enclosure
+        common_labels = Labels(
+            enclosure_wwn=enclosure['EnclosureWWID'],
+            enclosure_serial=enclosure['ServiceTag'],
+            enclosure_name=enclosure['ProductName'])
     
-    enc_status['slot'] = 0
-    enc_status['ps'] = 0
-    enc_status['fan'] = 0
-    enc_status['volt'] = 0
-    enc_status['temp'] = 0
+        enc_status['slot'] = 0
+        enc_status['ps'] = 0
+        enc_status['fan'] = 0
+        enc_status['volt'] = 0
+        enc_status['temp'] = 0
 
-    for slot in driveslots:
+        for slot in driveslots:
 
-        # if a drive is failed there will not be a drive info structure included in the output
-        # slot status will still be OK though 
+            # if a drive is failed there will not be a drive info structure included in the output
+            # slot status will still be OK though 
        
-        drive = slot.get('Drive', None)
+            drive = slot.get('Drive', None)
         
-        wwn = ""
-        serial = ""
+            wwn = ""
+            serial = ""
 
-        if slot['Status'] != 'OK':
-            status = 2
-        elif drive == None:
-            status = 2
-        else:
-            wwn_data = next((item for item in drive['DeviceIds']['Descriptor'] if item['@association'] == 'ADDRESSED_LOGICAL_UNIT'), "")
-            wwn = wwn_data['#text']
-            serial = drive['SerialNumber']
-            status = 0
-
-        print('enclosure_drive_info{{serial="{}", wwn="{}",enclosure_slot="{}",drawer="{}",drawer_slot="{}",{}}} 1'
-            .format(
-                serial, 
-                wwn,
-                slot['EnclosureSlot'],
-                slot['Drawer'],
-                slot['DrawerSlot'],
-                common_labels
-                ))
-
-        print('enclosure_slot_status{{enclosure_slot="{}",drawer="{}",drawer_slot="{}",{}}} {}'
-            .format(
-                slot['EnclosureSlot'],
-                slot['Drawer'],
-                slot['DrawerSlot'],
-                common_labels,
-                status
-                ))
-
-        if status > enc_status['slot']: enc_status['slot'] = status
+            if slot['Status'] != 'OK':
+                status = 2
+            elif drive == None:
+                status = 2
+            else:
+                wwn_data = next((item for item in drive['DeviceIds']['Descriptor'] if item['@association'] == 'ADDRESSED_LOGICAL_UNIT'), "")
+                wwn = wwn_data['#text']
+                serial = drive['SerialNumber']
+                status = 0
+
+            slot_labels = common_labels.prefixed(
+                enclosure_slot=slot['EnclosureSlot'],
+                drawer=slot['Drawer'],
+                drawer_slot=slot['DrawerSlot'])
+
+            series['drive_info'].add(slot_labels.prefixed(serial=serial, wwn=wwn), 1)
+
+            series['slot'].add(slot_labels, status)
+
+            if status > enc_status['slot']: enc_status['slot'] = status
         
-    for supply in supplies:
-        labels = 'name="{}", {}'.format(supply['Name'],common_labels)
-        status = mapstatus.get(supply['Status'], 2)
+        for supply in supplies:
+            labels = common_labels.prefixed(name=supply['Name'])
+            status = mapstatus.get(supply['Status'], 2)
 
-        print('enclosure_power_status{{{0}}} {1}'.format(labels, status))
-        print('enclosure_power_ac_status{{{0}}} {1}'.format(labels, mapbool.get(supply['ACFail'], 2)))
-        print('enclosure_power_dc_status{{{0}}} {1}'.format(labels, mapbool.get(supply['DCFail'], 2)))
+            series['power'].add(labels, status)
+            series['power_ac'].add(labels, mapbool.get(supply['ACFail'], 2))
+            series['power_dc'].add(labels, mapbool.get(supply['DCFail'], 2))
 
-        if status > enc_status['ps']: enc_status['ps'] = status
+            if status > enc_status['ps']: enc_status['ps'] = status
    
-    for fan in fans:
-        status = mapstatus.get(fan['Status'], 2)
-        labels = labels = 'name="{}", {}'.format(fan['Name'],common_labels)
-        print('enclosure_fan_status{{{0}}} {1}'.format(labels, status))
-        print('enclosure_fan_speed_rpm{{{0}}} {1}'.format(labels, fan['RPM']))
-        # we could map to a numeric output if we wanted this information
-        # codes I have seen (there are surely more):  "3rd Highest Speed", "Intermediate Speed"
-        # print('enclosure_fan_speed_step{{{0}}} {1}'.format(labels, fan['SpeedCode']))
-
-        if status > enc_status['fan']: enc_status['fan'] = status
-
-    for temp in temps:
-        # there are 14 total for emm, supply top/bottom, and each drawer
-        labels = labels = 'name="{}", {}'.format(temp['Name'],common_labels)
-        status = mapstatus.get(temp['Status'],2)
-        print('enclosure_temp_celsius{{{0}}} {1}'.format(labels, temp['TemperatureCel']))
-        print('enclosure_temp_status{{{0}}} {1}'.format(labels, status))
-        if status > enc_status['temp']: enc_status['temp'] = status
-
-    for volt in volts:
-        labels = labels = 'name="{}", {}'.format(volt['Name'],common_labels)
-        status = mapstatus.get(volt['Status'], 2)
-        print('enclosure_voltage_status{{{0}}} {1}'.format(labels,status))
-        if status > enc_status['volt']: enc_status['volt'] = status
+        for fan in fans:
+            status = mapstatus.get(fan['Status'], 2)
+            labels = common_labels.prefixed(name=fan['Name'])
+            series['fan'].add(labels, status)
+            series['fan_rpm'].add(labels, fan['RPM'])
+            # we could map to a numeric output if we wanted this information
+            # codes I have seen (there are surely more):  "3rd Highest Speed", "Intermediate Speed"
+            # print('enclosure_fan_speed_step{{{0}}} {1}'.format(labels, fan['SpeedCode']))
+
+            if status > enc_status['fan']: enc_status['fan'] = status
+
+        for temp in temps:
+            # there are 14 total for emm, supply top/bottom, and each drawer
+            labels = common_labels.prefixed(name=temp['Name'])
+            status = mapstatus.get(temp['Status'],2)
+            series['temp'].add(labels, temp['TemperatureCel'])
+            series['temp_status'].add(labels, status)
+            if status > enc_status['temp']: enc_status['temp'] = status
+
+        for volt in volts:
+            labels = common_labels.prefixed(name=volt['Name'])
+            status = mapstatus.get(volt['Status'], 2)
+            series['volt'].add(labels, status)
+            if status > enc_status['volt']: enc_status['volt'] = status
     
-        vos = 0
-        vus = 0
+            vos = 0
+            vus = 0
+
+            if volt['CritOver'] == 'TRUE':
+                vos = 2
+            elif volt['WarnOver'] == 'TRUE':
+                vos = 1
+
+            if volt['CritUnder'] == 'TRUE':
+                vus = 2
+            elif volt['WarnUnder'] == 'TRUE':
+                vus = 1
+
+            series['volt_over'].add(labels, vos)
+            series['volt_under'].add(labels, vus)
+            # print('enclosure_voltage_millivolts{{{0}}} {1}'.format(labels,volt['Millivolts']))
+
+        # create a total status composite
+        # The non-json secli enclosure output includes enclosure status CRIT/WARN but no such key is present in json output
+        # the AlarmCount value may reflect some status but in our experience it will be 0 even if a component is showing failed status 
+        # the max value of all sub system status will be reflected here
+        # A non-zero alarm count also will set a critical status 
+        status = max(enc_status.values())  
+        series['status'].add(common_labels, status)
 
-        if volt['CritOver'] == 'TRUE':
-            vos = 2
-        elif volt['WarnOver'] == 'TRUE':
-            vos = 1
+    record_slots(args, registry, { wwn for wwn, type in timed_out if type == 'driveslot' })
 
-        if volt['CritUnder'] == 'TRUE':
-            vus = 2
-        elif volt['WarnUnder'] == 'TRUE':
-            vus = 1
+    if wants_summary(args):
+        add_summary(registry)
+    if args.detail == 'unhealthy':
+        drop_healthy(registry, detail_groups)
 
-        print('enclosure_voltage_over_status{{{0}}} {1}'.format(labels,vos))
-        print('enclosure_voltage_under_status{{{0}}} {1}'.format(labels,vus))
-        # print('enclosure_voltage_millivolts{{{0}}} {1}'.format(labels,volt['Millivolts']))
+    return registry
 
-    # create a total status composite
-    # The non-json secli enclosure output includes enclosure status CRIT/WARN but no such key is present in json output
-    # the AlarmCount value may reflect some status but in our experience it will be 0 even if a component is showing failed status 
-    # the max value of all sub system status will be reflected here
-    # A non-zero alarm count also will set a critical status 
-    status = max(enc_status.values())  
-    print('enclosure_status{{{0}}} {1}'.format(
-        common_labels,
-        status
-        ))
+def main():
+    args = build_parser().parse_args()
 
+    if not available() and not args.replay:
+        sys.exit(1)
 
+    stats = RunStats('enclosureinfo')
+    emit(args, 'enclosureinfo', profiled(args, lambda: collect(args, stats), stats), stats)
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+# Small model of the prometheus text exposition format shared by the textfile collectors
+#
+# A collector adds samples to metric families in a Registry and renders the registry once at the end.
+# Rendering writes HELP and TYPE for every family, families sorted by name and samples sorted by labels,
+# so the output is deterministic from run to run (which TextfileWriter relies on to skip unchanged files).
+#
+# Label values are escaped once when a Labels is created.  Collectors create one Labels per device or
+# enclosure and reuse it for every series of that device, adding per-series labels in front with prefixed().
+#
+#   registry = Registry()
+#   temp = registry.family('smart_disk_temperature_celsius', 'Disk temperatures')
+#   dev = Labels(device='sda')
+#   temp.add(dev, 31)
+#   registry.family('smart_disk_attr_total', '...').add(dev.prefixed(name='command_timeout'), 0)
+#   text = registry.render()
+#
+# Histograms are added already bucketed, with cumulative counts per upper bound like the text format wants:
+#   registry.family('x_duration_seconds', '...', 'histogram').add_histogram(labels, (0.1, 1), [3, 5], 6, 7.2)
+#
+# parse() reads rendered text back into a Registry, for stages that join the output of several collectors.
+# It handles what render() writes, histogram lines end up in families of their own (x_bucket, x_sum, x_count).
+
+import io
+import math
+import re
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def escape_help(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+# integers print without a decimal point like they always have in our output
+# values from CLI JSON are often strings ("5000") and are converted here
+def format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+# escaped and formatted label pairs, in the order given
+class Labels:
+    __slots__ = ('pairs', 'text')
+
+    def __init__(self, **labels):
+        self.pairs = tuple((name, str(value)) for name, value in labels.items())
+        self.text = ','.join('{}="{}"'.format(name, escape(value)) for name, value in self.pairs)
+
+    # new Labels with more labels in front of these, for one series of a device
+    def prefixed(self, **labels):
+        new = Labels(**labels)
+        if self.pairs:
+            new.pairs += self.pairs
+            new.text = new.text + ',' + self.text if new.text else self.text
+        return new
+
+    def get(self, name, default=None):
+        for n, v in self.pairs:
+            if n == name:
+                return v
+        return default
+
+    def __repr__(self):
+        return '{' + self.text + '}'
+
+no_labels = Labels()
+
+
+class MetricFamily:
+    def __init__(self, name, help, type='gauge'):
+        self.name = name
+        self.help = help
+        self.type = type
+        # list of (Labels, value)
+        self.samples = []
+
+    def add(self, labels, value):
+        self.samples.append((labels or no_labels, value))
+
+    # buckets are the upper bounds without +Inf, counts the cumulative count for each of them
+    # count and total are the number and sum of all observations
+    def add_histogram(self, labels, buckets, counts, count, total):
+        self.add(labels, (tuple(buckets), tuple(counts), count, total))
+
+    def render(self, out):
+        out.write('# HELP {} {}\n'.format(self.name, escape_help(self.help)))
+        out.write('# TYPE {} {}\n'.format(self.name, self.type))
+        name = self.name
+        for labels, value in sorted(self.samples, key=lambda s: s[0].text):
+            if self.type == 'histogram':
+                self.render_histogram(out, labels, value)
+            elif labels.text:
+                out.write('{}{{{}}} {}\n'.format(name, labels.text, format_value(value)))
+            else:
+                out.write('{} {}\n'.format(name, format_value(value)))
+
+    def render_histogram(self, out, labels, value):
+        buckets, counts, count, total = value
+        # le goes last, after the labels of the series
+        pairs = dict(labels.pairs)
+        for le, n in list(zip(buckets, counts)) + [(float('inf'), count)]:
+            bucket = Labels(**dict(pairs, le=format_value(le)))
+            out.write('{}_bucket{{{}}} {}\n'.format(self.name, bucket.text, format_value(n)))
+        suffix = '{' + labels.text + '}' if labels.text else ''
+        out.write('{}_sum{} {}\n'.format(self.name, suffix, format_value(total)))
+        out.write('{}_count{} {}\n'.format(self.name, suffix, format_value(count)))
+
+
+class Registry:
+    def __init__(self):
+        self.families = {}
+        # comments passed through ahead of the series, like the "# Bad JSON" note from enclosureinfo
+        self.comments = []
+
+    # get or create a family, help and type are only used the first time
+    def family(self, name, help, type='gauge'):
+        fam = self.families.get(name)
+        if fam is None:
+            fam = self.families[name] = MetricFamily(name, help, type)
+        return fam
+
+    def comment(self, text):
+        self.comments.append(text)
+
+    # add all families of another registry to this one
+    def merge(self, other):
+        for fam in other.families.values():
+            mine = self.family(fam.name, fam.help, fam.type)
+            mine.samples.extend(fam.samples)
+        self.comments.extend(other.comments)
+
+    # families without samples are left out, a HELP line with nothing under it isn't useful
+    def render(self):
+        out = io.StringIO()
+        for text in self.comments:
+            out.write('# {}\n'.format(text))
+        for name in sorted(self.families):
+            fam = self.families[name]
+            if fam.samples:
+                fam.render(out)
+        return out.getvalue()
+
+
+label_re = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+unescape_re = re.compile(r'\\(.)')
+
+def unescape(value):
+    return unescape_re.sub(lambda m: '\n' if m.group(1) == 'n' else m.group(1), value)
+
+# Registry from exposition text, values are floats
+def parse(text):
+    registry = Registry()
+    helps = {}
+    types = {}
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#'):
+            parts = line.split(None, 3)
+            if len(parts) >= 3 and parts[1] == 'HELP':
+                helps[parts[2]] = unescape(parts[3]) if len(parts) > 3 else ''
+            elif len(parts) >= 4 and parts[1] == 'TYPE':
+                types[parts[2]] = parts[3]
+            continue
+
+        if '{' in line:
+            name, _, rest = line.partition('{')
+            labeltext, _, value = rest.rpartition('}')
+            labels = Labels(**{ n: unescape(v) for n, v in label_re.findall(labeltext) })
+        else:
+            name, _, value = line.partition(' ')
+            labels = no_labels
+        # a timestamp may follow the value
+        value = value.split()[0]
+        registry.family(name, helps.get(name, ''), types.get(name, 'gauge')).add(labels, float(value))
+    return registry
@@ -1,6 +1,11 @@
 #!/bin/bash
 
 # A sample of rolling up various text metric generators in this repository
+# collectord.py can run the python collectors in one resident process instead (see the header there)
+#
+# runcollectors.py runs the collectors in parallel, each with its own interval, timeout and lock, and every
+# collector writes its own .prom file as soon as it is done.  Run this from cron as often as the shortest
+# interval, collectors that aren't due yet or are still running from last time are skipped.
 
 # Set this for node exporter: --collector.textfile.directory="/var/cache/metrics"
 METRICS="/var/cache/metrics"
@@ -10,10 +15,10 @@ SCRIPTS="/usr/local/bin"
 # so you can group the osdinfo.py output on the cluster label 
 CLUSTER='ceph'
 
-RUNMETRICS=('smartinfo.py' 'enclosureinfo.py' 'osdinfo.py' 'diskinfo.sh')
+# name=interval,timeout in seconds for collectors that shouldn't use the defaults in runcollectors.py
+# smartinfo.py and enclosureinfo.py stop querying devices after their own --budget (240s by default)
+# and report what didn't answer, the timeout is only a backstop in case a script itself hangs.
+SCHEDULE=('smartinfo=300,300' 'enclosureinfo=300,300' 'osdinfo=300,120' 'diskinfo=300,60' 'diskidentity=300,60')
 
-for m in ${RUNMETRICS[@]}; do
-    # only osdinfo.py takes the argument, the others just ignore it
-    ${SCRIPTS}/${m} ${CLUSTER} > ${METRICS}/${m}.$$
-    mv ${METRICS}/${m}.$$  ${METRICS}/${m}.prom
-done
+${SCRIPTS}/runcollectors.py --cluster ${CLUSTER} --metrics-dir ${METRICS} --scripts-dir ${SCRIPTS} \
+    $(printf -- '--collector %s ' "${SCHEDULE[@]}")
@@ -0,0 +1,157 @@
+# NVMe health without smartctl, used by smartinfo.py for nvme devices
+#
+# smartctl --json costs a process and a JSON document per device, on all-flash nodes that's most of the run.
+# Everything smartinfo.py reports for NVMe is in the SMART / health information log page (log id 2), which is
+# read here with the admin passthrough ioctl.  Serial, model, firmware and namespaces come from /sys/class/nvme.
+# NvmeReader.read() returns the same structure as the parts of 'smartctl --json' output smartinfo.py looks at,
+# so the rest of the collector doesn't care where the data came from.
+#
+# Backends:
+# IoctlBackend reads the log page from /dev/nvmeN (needs root, like smartctl)
+# FileBackend reads the raw 512 byte log page from DIR/nvmeN.smart-log, for --replay and benchmark.py
+#
+# Anything that goes wrong raises NvmeUnavailable and smartinfo.py falls back to smartctl for that device.
+
+import ctypes
+import fcntl
+import os
+import re
+import struct
+
+# _IOWR('N', 0x41, struct nvme_admin_cmd)
+NVME_IOCTL_ADMIN_CMD = 0xC0484E41
+
+# struct nvme_passthru_cmd from linux/nvme_ioctl.h
+# opcode flags rsvd1 nsid cdw2 cdw3 metadata addr metadata_len data_len cdw10-15 timeout_ms result
+admin_cmd = struct.Struct('<BBHIIIQQII6III')
+
+get_log_page = 0x02
+smart_log_id = 0x02
+smart_log_len = 512
+all_namespaces = 0xFFFFFFFF
+
+# 0 means no timeout to the kernel, which then uses the driver default (60s)
+default_timeout_ms = 0
+
+# critical warning bits are what smartctl calls 'SMART overall-health' for nvme, any of them set fails it
+FAILSTATUS = 2**3
+
+
+class NvmeUnavailable(Exception):
+    pass
+
+
+class IoctlBackend:
+    def __init__(self, dev='/dev'):
+        self.dev = dev
+
+    # raw SMART / health log page of a controller like nvme0
+    def smart_log(self, name, timeout=None):
+        buf = ctypes.create_string_buffer(smart_log_len)
+        numd = smart_log_len // 4 - 1
+        timeout_ms = int(timeout * 1000) if timeout else default_timeout_ms
+        cmd = bytearray(admin_cmd.pack(get_log_page, 0, 0, all_namespaces, 0, 0, 0, ctypes.addressof(buf),
+            0, smart_log_len, smart_log_id | numd << 16, 0, 0, 0, 0, 0, timeout_ms, 0))
+        try:
+            fd = os.open('{}/{}'.format(self.dev, name), os.O_RDONLY)
+        except OSError as err:
+            raise NvmeUnavailable('{}: {}'.format(name, err))
+        try:
+            status = fcntl.ioctl(fd, NVME_IOCTL_ADMIN_CMD, cmd)
+        except OSError as err:
+            raise NvmeUnavailable('{}: get log page failed: {}'.format(name, err))
+        finally:
+            os.close(fd)
+
+        # positive return is an NVMe status code from the controller
+        if status != 0:
+            raise NvmeUnavailable('{}: get log page returned status {:#x}'.format(name, status))
+        return buf.raw
+
+
+class FileBackend:
+    def __init__(self, path):
+        self.path = path
+
+    def smart_log(self, name, timeout=None):
+        try:
+            with open(os.path.join(self.path, name + '.smart-log'), 'rb') as fh:
+                data = fh.read()
+        except OSError as err:
+            raise NvmeUnavailable('{}: {}'.format(name, err))
+        if len(data) != smart_log_len:
+            raise NvmeUnavailable('{}: short smart log'.format(name))
+        return data
+
+
+# little endian 128 bit counters, smartctl reports them as plain integers too
+def u128(data, offset):
+    low, high = struct.unpack_from('<QQ', data, offset)
+    return high << 64 | low
+
+# the fields of the log page smartinfo.py uses, named like smartctl's nvme_smart_health_information_log
+def parse_smart_log(data):
+    critical_warning, temperature, spare, spare_threshold, used = struct.unpack_from('<BHBBB', data, 0)
+    return {
+        'critical_warning': critical_warning,
+        # composite temperature is in kelvin, 0 if the controller doesn't report it
+        'temperature': temperature - 273 if temperature else 0,
+        'available_spare': spare,
+        'available_spare_threshold': spare_threshold,
+        'percentage_used': used,
+        'media_errors': u128(data, 160),
+        'num_err_log_entries': u128(data, 176),
+    }
+
+# opposite of parse_smart_log, for fake devices
+def pack_smart_log(critical_warning=0, temperature=35, available_spare=100, available_spare_threshold=10,
+        percentage_used=0, media_errors=0, num_err_log_entries=0):
+    data = bytearray(smart_log_len)
+    struct.pack_into('<BHBBB', data, 0, critical_warning, temperature + 273 if temperature else 0,
+        available_spare, available_spare_threshold, percentage_used)
+    struct.pack_into('<QQ', data, 160, media_errors & (2**64 - 1), media_errors >> 64)
+    struct.pack_into('<QQ', data, 176, num_err_log_entries & (2**64 - 1), num_err_log_entries >> 64)
+    return bytes(data)
+
+
+# namespace directories under the controller, nvme0n1 or nvme0c0n1 with native multipath
+namespace_re = re.compile(r'^nvme\d+(c\d+)?n(\d+)$')
+
+class NvmeReader:
+    def __init__(self, backend, sysfs='/sys'):
+        self.backend = backend
+        self.sysfs = sysfs
+
+    def sysattr(self, name, attr):
+        try:
+            with open('{}/class/nvme/{}/{}'.format(self.sysfs, name, attr)) as fh:
+                return fh.read().strip()
+        except OSError as err:
+            raise NvmeUnavailable('{}: {}'.format(name, err))
+
+    def namespaces(self, name):
+        try:
+            entries = os.listdir('{}/class/nvme/{}'.format(self.sysfs, name))
+        except OSError as err:
+            raise NvmeUnavailable('{}: {}'.format(name, err))
+        ids = sorted({ int(m.group(2)) for m in map(namespace_re.match, entries) if m })
+        if not ids:
+            raise NvmeUnavailable('{}: no namespaces in sysfs'.format(name))
+        return ids
+
+    # device is the name from the smartctl scan, /dev/nvme0
+    # returns a dictionary shaped like 'smartctl --json --all -d nvme' output
+    def read(self, device, timeout=None):
+        name = os.path.basename(device)
+        log = parse_smart_log(self.backend.smart_log(name, timeout))
+        exit_status = FAILSTATUS if log['critical_warning'] else 0
+        return {
+            'smartctl': { 'exit_status': exit_status },
+            'device': { 'name': device, 'info_name': device, 'type': 'nvme' },
+            'serial_number': self.sysattr(name, 'serial'),
+            'model_name': self.sysattr(name, 'model'),
+            'firmware_version': self.sysattr(name, 'firmware_rev'),
+            'nvme_namespaces': [ { 'id': i } for i in self.namespaces(name) ],
+            'temperature': { 'current': log['temperature'] },
+            'nvme_smart_health_information_log': log,
+        }
@@ -17,43 +17,70 @@
 # metrics will be produced for the top level device (typically LVM) and for any slave devices 
 # there will be another info metric for each device dm- and sdX or nvmeX, etc as reflected in /sys/block/<dev>/slaves/<dev>/slaves 
 
+# storage_disk_changed_total{collector="osdinfo",change} counts OSD devices added, removed or moved to other devices
+# since --snapshots was started, see snapshotstore.py and diskhistory.py
+
+# run by remotepoll.py for another host the slave devices come from lsblk on that host instead of /sys/block
+
+# one lvs call lists the tags and the device mapper path of every LV, so the dm- device of an OSD LV is found
+# by its device mapper name without reading the /dev/vg/lv symlink.  The decoded lvs and lsblk output is shared
+# with other collectors in the same process for --command-max-age seconds (see collectorlib.ResultCache).
+
 import argparse
-import subprocess
-import json
+import sys
 from glob import glob
-from os.path import basename, dirname, exists
-from os import readlink, path
+from os.path import basename, exists, isfile
+from os import readlink
 
-osdpath = '/var/lib/ceph/osd'
-
-parser = argparse.ArgumentParser(description='Map Data and DB/WAL disk devices to Ceph OSD')
-parser.add_argument('cluster', help='Cluster name set in metric label', default='ceph', nargs='?')
-args = parser.parse_args()
-cluster = args.cluster
+from collectorlib import CommandRunner, RunStats, add_command_cache_args, add_output_args, add_profile_args, add_replay_args, emit, profiled, sysfs_root, transport_from_args
+from exposition import Labels, Registry
+from snapshotstore import add_snapshot_args, record
+from sysfsindex import BlockGraph, shared_graph
 
-series = [ '# HELP ceph_osd_device_info LVM names and physical devices correlated to ceph OSD.  Includes sub-devices for mpath.']
+osdpath = '/var/lib/ceph/osd'
+lvs = '/sbin/lvs'
+lsblk = '/bin/lsblk'
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Map Data and DB/WAL disk devices to Ceph OSD')
+    parser.add_argument('cluster', help='Cluster name set in metric label', default='ceph', nargs='?')
+    parser.add_argument('--timeout', type=float, default=60,
+        help='Seconds allowed for the lvs call (default: 60)')
+    parser.add_argument('--sysfs-max-age', type=float, default=30,
+        help='Reuse a walk of /sys/block by another collector in the same process (collectord.py) up to this many seconds old (default: 30)')
+    parser.add_argument('--sysfs-root', help=argparse.SUPPRESS)
+    add_command_cache_args(parser)
+    add_snapshot_args(parser, 'osdinfo')
+    add_output_args(parser)
+    add_replay_args(parser)
+    add_profile_args(parser)
+    return parser
+
+# the collector can't do anything without the CLI tool
+def available():
+    return isfile(lvs)
 
 # find devices from LV tags
 # returns dictionary { osd_id: { block: device, db: device, wal: device} }
+# and { LV path: device mapper path } of every LV, /dev/vg/lv -> /dev/mapper/vg-lv
 # devices not defined will not have a key defined in the osd dictionary
-def get_osd_devices_lvm():
+def get_osd_devices_lvm(runner, max_age=0):
     osdlist = {}
-    cmd = ['/sbin/lvs', '-o', 'lv_tags', '--reportformat=json']
-    lvs_output = subprocess.check_output(cmd,stderr=subprocess.DEVNULL)
-    lv_tags = json.loads(lvs_output)
+    dm_paths = {}
+    cmd = [lvs, '-o', 'lv_tags,lv_path,lv_dm_path', '--reportformat=json']
+    lv_tags = runner.check_json(cmd, kind='lvs', max_age=max_age)
     
     for lv in lv_tags['report'][0]['lv']:
+        if lv.get('lv_path') and lv.get('lv_dm_path'):
+            dm_paths[lv['lv_path']] = lv['lv_dm_path']
+
         # we're only interested in ceph block devices, which will include info on their db/wal devices
         if 'ceph.type=block' not in lv['lv_tags']: 
             continue
 
         # tags are comma separated string of key-value pairs (which probably should have been JSON encoded)
-        taglist = lv['lv_tags'].split(',')
-        tagdict = {}
+        tagdict = dict(tag.split('=', 1) for tag in lv['lv_tags'].split(','))
         osd = {}
-        for tag in taglist:
-            name,value = tag.split('=')
-            tagdict[name] = value
 
         for dt in ['block', 'db', 'wal']:
             tagkey = 'ceph.{}_device'.format(dt)
@@ -62,7 +89,7 @@ def get_osd_devices_lvm():
 
         osdlist[tagdict['ceph.osd_id']] = osd    
 
-    return osdlist
+    return osdlist, dm_paths
 
 # find devices from symlinks in runtime tmp mnt
 # this function is not used but left as an option, it should be interchangeable with the lvm function
@@ -93,33 +120,65 @@ def get_osd_devices_mount():
 
     return osdlist
 
-# find all slave devices starting from a list containing 1 device
-# list returned will include the original device list
-def get_slaves(bd):
-    # fetch slaves for last item on list being passed down
-    sysfs = '/sys/block/{}/slaves/*'.format(bd[-1])
-    for sdev in glob(sysfs):
-        bd.append(basename(sdev)) 
-        bd = get_slaves(bd)
-    return bd
-        
-osd_dev_list = get_osd_devices_lvm()
+# get the dm- device for an LV path (osd are always LV)
+# looked up by the device mapper path lvs gave for it (or the name made from the path) in the sysfs index,
+# readlink of the LV path symlink if it isn't there
+# the symlink is only there to read on the local host, None if the LV isn't in the index of another one
+def get_dm(graph, path, dm_paths=None, local=True):
+    dm = graph.lv_kernel_name((dm_paths or {}).get(path, path))
+    if dm is None and local:
+        dm = basename(readlink(path))
+    return dm
 
-for osdid, devs in osd_dev_list.items():
-    for dt, path in devs.items():
-        labels = 'cluster="{}", ceph_daemon="osd.{}", type="{}"'.format(cluster, osdid, dt)
-        
-        # logical volume name (strip out /dev/vg path)
-        series.append('ceph_osd_device_info{{device="{}", {}}} 1'.format(basename(path), labels))
+# the slave graph of another host, from lsblk there
+def get_graph_lsblk(runner, max_age=0):
+    cmd = [lsblk, '--json', '--inverse', '--output', 'NAME,KNAME']
+    return BlockGraph.from_lsblk(runner.check_json(cmd, kind='lsblk', max_age=max_age))
 
-        # get the dm- device from the LV path symlink  (osd are always LV)
-        dm = basename(readlink(path))
+# run a full collection and return a Registry with the output
+# the lvs call is recorded in stats if given
+def collect(args, stats=None):
+    runner = CommandRunner(timeout=args.timeout, transport=transport_from_args(args), stats=stats)
+    cluster = args.cluster
+
+    registry = Registry()
+    series = registry.family('ceph_osd_device_info', 'LVM names and physical devices correlated to ceph OSD.  Includes sub-devices for mpath.')
+
+    osd_dev_list, dm_paths = get_osd_devices_lvm(runner, args.command_max_age)
+
+    # all slave devices for every OSD come from one walk of /sys/block, shared with diskinfo.py
+    sysfs = sysfs_root(args)
+    graph = shared_graph(sysfs, args.sysfs_max_age) if sysfs else get_graph_lsblk(runner, args.command_max_age)
+
+    # 'osd.12 block' -> devices for the snapshot
+    rows = {}
+
+    for osdid, devs in osd_dev_list.items():
+        for dt, path in devs.items():
+            labels = Labels(cluster=cluster, ceph_daemon='osd.{}'.format(osdid), type=dt)
+            
+            # logical volume name (strip out /dev/vg path)
+            series.add(labels.prefixed(device=basename(path)), 1)
+
+            # the dm- device and everything below it
+            dm = get_dm(graph, path, dm_paths, sysfs is not None)
+            below = graph.below(dm) if dm else []
+            for dev in below:
+                series.add(labels.prefixed(device=dev), 1)
+            rows['osd.{} {}'.format(osdid, dt)] = ','.join([basename(path)] + below)
+
+    record(args, registry, 'osdinfo', rows)
+
+    return registry
+
+def main():
+    args = build_parser().parse_args()
 
-        for dev in get_slaves([dm]):
-            series.append('ceph_osd_device_info{{device="{}", {}}} 1'
-                                    .format(dev, labels))
+    if not available() and not args.replay:
+        sys.exit(1)
 
-series.sort()
-for s in series:
-    print(s)
+    stats = RunStats('osdinfo')
+    emit(args, 'osdinfo', profiled(args, lambda: collect(args, stats), stats), stats)
 
+if __name__ == '__main__':
+    main()
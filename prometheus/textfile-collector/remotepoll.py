@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+#
+# Run the smartinfo, osdinfo and enclosureinfo collectors centrally for hosts that can't run them themselves
+# (appliance heads, staging boxes without node_exporter).  The collectors run here like they always do, only
+# their smartctl, lvs, lsblk and secli calls go to the host over ssh (see collectorlib.SshTransport).
+#
+# Every host gets one ssh master connection that all of its commands share, so polling a host costs one
+# connection setup, or none while ControlPersist keeps the one from the last run around.
+# --jobs hosts are polled at the same time and --ssh-sessions commands run at the same time on each host.
+#
+# The output of every collector for every host goes into one file, with a host label in front of the labels
+# of every series, and
+# remotepoll_up{host,collector}  1 if the collector run for the host finished without error
+# The textfile_collector_* series (see collectorlib.RunStats) cover the whole poll with collector="remotepoll"
+# and go in the status file with --output like they do for the collectors, together with
+# remotepoll_duration_seconds{host,collector}  how long the collector took for the host
+# and the series the collectors add about their runs (smart_controller_probe_*), with the host label.
+# --profile-threshold profiles the whole poll.
+#
+# The caches, counter history and --snapshots of the collectors are kept per host under --state-dir.
+# Other hosts have no sysfs we can read, see the collectors for what they do instead.
+#
+# For testing without the hosts --replay DIR answers the commands of every host from DIR/<host>/commands.json
+# (see collectorlib.ReplayTransport), and DIR/<host>/sys is the sysfs of the host if it is there.
+#
+# Example:  remotepoll.py --cluster ceph --hosts-file /etc/remotepoll.hosts --output /var/cache/metrics/remotepoll.prom
+#           remotepoll.py --host head1 --host head2 --collector enclosureinfo --ssh-option User=monitor
+#           remotepoll.py --host head1 --collector-args 'smartinfo=--full-interval 7200 --jobs 4'
+
+import argparse
+import importlib
+import logging
+import os
+import shlex
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from collectorlib import CollectorError, HostUnreachable, ReplayTransport, RunStats, SshTransport, TextfileWriter, add_output_args, add_profile_args, profiled
+from exposition import Labels, Registry
+
+collectors = ('smartinfo', 'osdinfo', 'enclosureinfo')
+
+# state files of the collectors, moved into the directory of the host
+state_files = {
+    'smartinfo': { 'topology_cache': 'smartinfo-topology.json', 'full_cache': 'smartinfo-full.json', 'history': 'smartinfo-history.json',
+        'megaraid_cache': 'smartinfo-megaraid.json', 'snapshots': 'smartinfo-snapshots.bin' },
+    'osdinfo': { 'snapshots': 'osdinfo-snapshots.bin' },
+    'enclosureinfo': { 'snapshots': 'enclosureinfo-snapshots.bin' },
+}
+
+log = logging.getLogger('remotepoll')
+
+# name=arguments for --collector-args
+def parse_collector_args(spec):
+    name, _, argv = spec.partition('=')
+    if name not in collectors:
+        raise argparse.ArgumentTypeError('unknown collector {}'.format(name))
+    return name, shlex.split(argv)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Run the collectors for other hosts over ssh')
+    parser.add_argument('--cluster', default='ceph', help='Cluster name passed to the collectors (default: ceph)')
+    parser.add_argument('--host', action='append', dest='hosts', default=[], help='Host to poll, may be repeated')
+    parser.add_argument('--hosts-file', help='File with hosts to poll, one per line, # starts a comment')
+    parser.add_argument('--collector', action='append', dest='collectors', choices=collectors,
+        help='Collector to run for every host, may be repeated (default: all of {})'.format(', '.join(collectors)))
+    parser.add_argument('--collector-args', type=parse_collector_args, action='append', default=[], metavar='NAME=ARGS',
+        help="More arguments for a collector, like 'smartinfo=--full-interval 7200'")
+    parser.add_argument('--jobs', type=int, default=16, help='Number of hosts to poll at the same time (default: 16)')
+    parser.add_argument('--ssh-sessions', type=int, default=4,
+        help='Commands to run at the same time on one host, over its one connection (default: 4)')
+    parser.add_argument('--ssh-persist', type=int, default=600,
+        help='Seconds to keep the connection to a host open after the last command (default: 600)')
+    parser.add_argument('--ssh-option', action='append', default=[], metavar='OPTION',
+        help='ssh -o option for every connection, like User=monitor, may be repeated')
+    parser.add_argument('--state-dir', default='/var/tmp/remotepoll',
+        help='Directory for the ssh control sockets and the per host collector caches (default: /var/tmp/remotepoll)')
+    parser.add_argument('--replay', metavar='DIR', help='Answer the commands of each host from DIR/<host>/commands.json instead of ssh')
+    parser.add_argument('--debug', action='store_true', help='Log every collector run')
+    add_output_args(parser)
+    add_profile_args(parser)
+    return parser
+
+def read_hosts(args):
+    hosts = list(args.hosts)
+    if args.hosts_file:
+        with open(args.hosts_file) as fh:
+            for line in fh:
+                line = line.split('#', 1)[0].strip()
+                if line:
+                    hosts.append(line)
+    # keep the order but poll a host only once
+    return list(dict.fromkeys(hosts))
+
+def host_transport(args, host):
+    if args.replay:
+        return ReplayTransport(os.path.join(args.replay, host))
+    # don't wait for the default TCP timeout on a host that is down
+    options = ['-o', 'ConnectTimeout=10']
+    for option in args.ssh_option:
+        options += ['-o', option]
+    return SshTransport(host, os.path.join(args.state_dir, 'ssh'), args.ssh_sessions, args.ssh_persist, options)
+
+# parsed arguments of a collector for one host
+def collector_args(args, module, name, host, transport):
+    extra = [ argv for n, argv in args.collector_args if n == name ]
+    cargs = module.build_parser().parse_args([args.cluster] + sum(extra, []))
+    cargs.remote = host
+    cargs.transport = transport
+    state = os.path.join(args.state_dir, host)
+    for dest, filename in state_files.get(name, {}).items():
+        # an empty string turns the cache off, leave that alone
+        if getattr(cargs, dest):
+            setattr(cargs, dest, os.path.join(state, filename))
+    if args.replay and os.path.isdir(os.path.join(args.replay, host, 'sys')):
+        cargs.sysfs_root = os.path.join(args.replay, host, 'sys')
+    return cargs
+
+# run every collector for one host
+# returns [ (collector, Registry or None if it failed, seconds) ] and the RunStats of the host
+def poll_host(args, modules, host):
+    results = []
+    stats = RunStats('remotepoll')
+    try:
+        transport = host_transport(args, host)
+        os.makedirs(os.path.join(args.state_dir, host), exist_ok=True)
+    except (OSError, ValueError) as err:
+        log.error('%s: %s', host, err)
+        return [ (name, None, 0.0) for name in modules ], stats
+
+    unreachable = False
+    for name, module in modules.items():
+        start = time.monotonic()
+        registry = None
+        if not unreachable:
+            try:
+                cargs = collector_args(args, module, name, host, transport)
+                registry = module.collect(cargs, stats)
+            except HostUnreachable as err:
+                log.error('%s: %s', host, err)
+                unreachable = True
+            except CollectorError as err:
+                for msg in err.messages:
+                    log.error('%s %s: %s', host, name, msg)
+            except Exception:
+                log.exception('%s %s: collector failed', host, name)
+        results.append((name, registry, time.monotonic() - start))
+        log.debug('%s %s: done in %.2fs', host, name, results[-1][2])
+    return results, stats
+
+# poll every host, --jobs at a time
+# returns [ (host, poll_host() results) ] in the order of hosts
+# the command stats of every host are added up in stats, the series the collectors added go in stats.extra with the host label
+def poll(args, modules, hosts, stats):
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = [ (host, pool.submit(poll_host, args, modules, host)) for host in hosts ]
+        polled = [ (host, future.result()) for host, future in futures ]
+
+    for host, (_, host_stats) in polled:
+        extra = Registry()
+        add_host(extra, host, host_stats.extra)
+        stats.merge(host_stats, extra)
+    return [ (host, results) for host, (results, _) in polled ]
+
+# add the series of a collector run for a host to the combined output, with the host label in front
+def add_host(output, host, registry):
+    for fam in registry.families.values():
+        mine = output.family(fam.name, fam.help, fam.type)
+        mine.samples.extend((labels.prefixed(host=host), value) for labels, value in fam.samples)
+    output.comments.extend('{}: {}'.format(host, text) for text in registry.comments)
+
+def main():
+    args = build_parser().parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    hosts = read_hosts(args)
+    if not hosts:
+        log.error('no hosts to poll, use --host or --hosts-file')
+        sys.exit(1)
+
+    # control sockets let anyone who can reach them run commands on the host
+    os.makedirs(os.path.join(args.state_dir, 'ssh'), mode=0o700, exist_ok=True)
+
+    modules = { name: importlib.import_module(name) for name in args.collectors or collectors }
+    stats = RunStats('remotepoll')
+
+    polled = profiled(args, lambda: poll(args, modules, hosts, stats), stats)
+
+    output = Registry()
+    up = output.family('remotepoll_up', 'Collector run for the host finished without error')
+    # the durations change every run, they go in the status file so the output is only written when the data changes
+    duration = stats.extra.family('remotepoll_duration_seconds', 'Time the collector took for the host')
+    for host, results in polled:
+        for name, registry, seconds in results:
+            labels = Labels(host=host, collector=name)
+            up.add(labels, 0 if registry is None else 1)
+            duration.add(labels, round(seconds, 3))
+            if registry is not None:
+                add_host(output, host, registry)
+
+    stats.finish(output)
+    text = output.render()
+    if args.output:
+        TextfileWriter().write_collector(args.output, 'remotepoll', text, stats)
+    else:
+        sys.stdout.write(text + stats.registry().render())
+
+if __name__ == '__main__':
+    main()
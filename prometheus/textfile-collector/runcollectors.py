@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+#
+# Run the textfile collectors in this directory at the same time instead of one after the other (metrics.sh calls this)
+#
+# Each collector runs as its own process with --output, so it writes its .prom file atomically as soon as it
+# is done, and is killed with everything it started (smartctl, secli) if it runs past its timeout.
+# A lock file per collector in the metrics directory keeps a slow run from overlapping with the next cycle,
+# a collector that is still running is skipped and its previous output stays in place.
+#
+# Every collector has its own interval.  Started from cron (the default) a collector only runs if its last
+# run started at least that long ago, so cron can fire every minute while smartinfo runs every 10 minutes.
+# With --loop this keeps running and starts every collector on its own schedule.
+#
+# Collectors which join the output of others (diskidentity.py) wait until those finished in the same cycle.
+#
+# Output files of collectors that were replaced (diskinfo.sh.prom, see collectorlib.replaced_outputs) are removed
+# so node_exporter doesn't keep exporting them next to the new output.
+#
+# Example:  runcollectors.py --cluster ceph --collector smartinfo=600,240 --collector osdinfo=60
+#           name=interval,timeout in seconds, intervals and timeouts not given are the defaults below
+
+import argparse
+import fcntl
+import importlib
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from collectorlib import remove_replaced
+
+# name -> (interval, timeout)
+# smartinfo.py and enclosureinfo.py stop querying devices after their own --budget (240s by default)
+# and report what didn't answer, the timeout here is only a backstop in case a collector itself hangs
+default_collectors = {
+    'smartinfo': (300, 300),
+    'enclosureinfo': (300, 300),
+    'osdinfo': (300, 120),
+    'diskinfo': (300, 60),
+    'diskidentity': (300, 60),
+}
+
+# part of the interval a collector can be early, so cron firing on the same period doesn't skip every other run
+slack = 0.1
+
+log = logging.getLogger('runcollectors')
+
+scripts_dir = os.path.dirname(os.path.abspath(__file__))
+
+class Job:
+    def __init__(self, name, interval, timeout, args):
+        self.name = name
+        self.interval = interval
+        self.timeout = timeout
+        self.script = os.path.join(args.scripts_dir, name + '.py')
+        # same file names metrics.sh always used
+        self.output = os.path.join(args.metrics_dir, name + '.py.prom')
+        self.lockfile = os.path.join(args.metrics_dir, '.{}.lock'.format(name))
+        self.argv = [sys.executable, self.script, args.cluster, '--output', self.output]
+        if name == 'diskidentity':
+            self.argv += ['--textfile-dir', args.metrics_dir]
+        self.inputs = ()
+        self.done = threading.Event()
+
+    # the lock file holds the start time of the last run
+    def last_start(self, fh):
+        fh.seek(0)
+        try:
+            return float(fh.read().strip() or 0)
+        except ValueError:
+            return 0
+
+    # run the collector if it is due and not already running, returns True if it ran successfully
+    def run(self, force=False):
+        try:
+            with open(self.lockfile, 'a+') as fh:
+                try:
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    log.info('%s: previous run still going, skipped', self.name)
+                    return False
+
+                start = time.time()
+                if not force and start - self.last_start(fh) < self.interval * (1 - slack):
+                    return False
+                fh.seek(0)
+                fh.truncate()
+                fh.write('{}\n'.format(start))
+                fh.flush()
+
+                return self.execute()
+        except OSError as err:
+            log.error('%s: %s', self.name, err)
+            return False
+
+    def execute(self):
+        start = time.monotonic()
+        # own session so a timeout kills smartctl and friends too, not just the python process
+        proc = subprocess.Popen(self.argv, stdout=subprocess.DEVNULL, start_new_session=True)
+        try:
+            rc = proc.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+            log.error('%s: killed after %ds', self.name, self.timeout)
+            return False
+
+        if rc != 0:
+            log.error('%s: exited with %d', self.name, rc)
+            return False
+        log.debug('%s: done in %.2fs', self.name, time.monotonic() - start)
+        return True
+
+    # one cycle from cron: wait for the inputs of this collector, then run it if it is due
+    def cycle(self, jobs):
+        try:
+            for name in self.inputs:
+                if name in jobs:
+                    jobs[name].done.wait()
+            self.run()
+        finally:
+            self.done.set()
+
+    # --loop: run on our interval until stopped, the time a run takes counts against the interval
+    def loop(self, stop):
+        while not stop.is_set():
+            start = time.monotonic()
+            self.run(force=True)
+            stop.wait(max(0, self.interval - (time.monotonic() - start)))
+
+# parse name=interval,timeout, both are optional
+def parse_collector(spec):
+    name, _, times = spec.partition('=')
+    if name not in default_collectors:
+        raise argparse.ArgumentTypeError('unknown collector {}'.format(name))
+    interval, timeout = default_collectors[name]
+    if times:
+        first, _, second = times.partition(',')
+        interval = float(first) if first else interval
+        timeout = float(second) if second else timeout
+    return name, interval, timeout
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Run the textfile collectors in parallel, each on its own interval')
+    parser.add_argument('--cluster', default='ceph', help='Cluster name passed to the collectors (default: ceph)')
+    parser.add_argument('--collector', type=parse_collector, action='append', dest='collectors',
+        help='Collector to run as name or name=interval,timeout in seconds, may be repeated (default: all collectors)')
+    parser.add_argument('--metrics-dir', default='/var/cache/metrics',
+        help='node_exporter textfile directory to write to (default: /var/cache/metrics)')
+    parser.add_argument('--scripts-dir', default=scripts_dir,
+        help='Directory with the collector scripts (default: the one this script is in)')
+    parser.add_argument('--loop', action='store_true', help='Keep running and start each collector on its interval')
+    parser.add_argument('--debug', action='store_true', help='Log every collector run')
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    # the collector modules are only imported to see whether their tool is there and what they depend on
+    sys.path.insert(0, args.scripts_dir)
+    jobs = {}
+    for name, interval, timeout in args.collectors or [ (n,) + t for n, t in sorted(default_collectors.items()) ]:
+        module = importlib.import_module(name)
+        if not module.available():
+            log.debug('%s: CLI tool not found, skipping', name)
+            continue
+        job = jobs[name] = Job(name, interval, timeout, args)
+        job.inputs = getattr(module, 'inputs', ())
+        remove_replaced(args.metrics_dir, name)
+
+    if args.loop:
+        stop = threading.Event()
+        threads = [ threading.Thread(target=job.loop, args=(stop,), name=job.name, daemon=True) for job in jobs.values() ]
+        for t in threads:
+            t.start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            stop.set()
+        return
+
+    threads = [ threading.Thread(target=job.cycle, args=(jobs,), name=job.name) for job in jobs.values() ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+if __name__ == '__main__':
+    main()
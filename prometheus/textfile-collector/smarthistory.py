@@ -0,0 +1,93 @@
+# Local history of SMART counters for smartinfo.py, so increases, rates and wear-out estimates are worked out
+# on the host instead of with rate() and offset queries over every disk series on the prometheus server.
+#
+# Every counter is kept in a small ring of (timestamp, value) samples in one JSON file, keyed by disk serial and
+# attribute so a replaced disk starts over.  A sample is added when the value changed or when --history-interval
+# has passed since the last one, the ring keeps --history-samples of them.  Derived values are calculated from
+# the stored samples only, so they stay the same between samples and don't defeat the unchanged-file check.
+#
+# { 'serial name': [ [ timestamp, value ], ... ], ... }
+
+import json
+import os
+
+
+class History:
+    def __init__(self, interval=3600, samples=192):
+        self.interval = interval
+        self.samples = samples
+        self.rings = {}
+
+    @classmethod
+    def load(cls, path, interval=3600, samples=192):
+        history = cls(interval, samples)
+        try:
+            with open(path) as fh:
+                history.rings = json.load(fh)
+        except (OSError, ValueError):
+            pass
+        return history
+
+    def save(self, path):
+        tmp = '{}.{}'.format(path, os.getpid())
+        try:
+            with open(tmp, 'w') as fh:
+                json.dump(self.rings, fh, separators=(',', ':'))
+            os.replace(tmp, path)
+        except OSError:
+            # history starts over next run, the derived series are just missing for a while
+            pass
+
+    # add the value to the ring of key if it changed or the interval has passed, returns the ring
+    # the same key can be updated several times in a run (nvme namespaces), only the first one counts
+    def update(self, key, now, value):
+        ring = self.rings.setdefault(key, [])
+        if not ring or now - ring[-1][0] >= self.interval or (value != ring[-1][1] and now > ring[-1][0]):
+            ring.append([int(now), value])
+            del ring[:-self.samples]
+        return ring
+
+    # forget disks that haven't been seen for longer than the ring covers
+    def prune(self, now):
+        span = self.interval * self.samples
+        for key in [ key for key, ring in self.rings.items() if not ring or now - ring[-1][0] > span ]:
+            del self.rings[key]
+
+
+# increase from the sample at or before window seconds before the newest one (or the oldest there is)
+# None with less than two samples
+def increase(ring, window):
+    if len(ring) < 2:
+        return None
+    newest_time, newest = ring[-1]
+    base = ring[0][1]
+    for t, value in ring:
+        if t > newest_time - window:
+            break
+        base = value
+    # a counter going backwards is a firmware quirk, not a negative number of errors
+    return max(0, newest - base)
+
+# average increase per day over the whole ring, None if it covers less than min_span seconds
+def rate_per_day(ring, min_span=3600):
+    if len(ring) < 2 or ring[-1][0] - ring[0][0] < min_span:
+        return None
+    return (ring[-1][1] - ring[0][1]) / (ring[-1][0] - ring[0][0]) * 86400
+
+# days until a percentage that counts down (SSD lifetime remaining) reaches 0 at the rate it dropped over the ring
+# least squares fit so a single odd sample doesn't swing the estimate
+# None if the ring covers less than min_span seconds or the value isn't going down
+def days_remaining(ring, min_span=86400):
+    if len(ring) < 2 or ring[-1][0] - ring[0][0] < min_span:
+        return None
+    n = len(ring)
+    t0 = ring[0][0]
+    mean_t = sum(t - t0 for t, _ in ring) / n
+    mean_v = sum(v for _, v in ring) / n
+    var = sum((t - t0 - mean_t) ** 2 for t, _ in ring)
+    if var == 0:
+        return None
+    slope = sum((t - t0 - mean_t) * (v - mean_v) for t, v in ring) / var
+    if slope >= 0:
+        return None
+    return ring[-1][1] / -slope / 86400
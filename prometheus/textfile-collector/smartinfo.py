@@ -20,6 +20,56 @@
 # smart_disk_info:  Disk metadata
 # smart_disk_info{device="/dev/nvme3", serial="ABC123", model="Dell Express Flash NVMe SM1715 800GB SFF", firmware="IPV0AD3Q"}
 #
+# smart_disk_scrape_timeout:
+# Set to 1 for a disk which did not answer smartctl within --timeout or before the --budget for the whole run ran out.
+# Other series for that disk are missing from the output, everything else is still reported.
+#
+# smart_disk_data_timestamp_seconds{tier="full"}:
+# Only every --full-interval seconds a disk gets a full 'smartctl --all' which reads the error and self-test logs.
+# Runs in between ask only for health and attributes and reuse the log based values (SCSI error counter log,
+# grown defect list, self-test/error log status bits) from the last full query.  This says how old those are.
+# Everything else is as fresh as the run itself (textfile_collector_last_success_timestamp_seconds with --output).
+# There is no fast tier timestamp because it would change the output on every run, see collectorlib.TextfileWriter.
+#
+# smart_disk_attr_increase{window="1d"|"7d"}, smart_disk_attr_rate_per_day, smart_disk_lifetime_days_remaining:
+# Worked out from a local history of smart_disk_attr_total and smart_disk_lifetime_percent kept in --history
+# (see smarthistory.py), so alerts and dashboards don't need rate() or offset queries over every disk.
+# Increases are from the history sample at or before the window, or the oldest one if the history is shorter.
+# The rate is the average over the whole history.  Days remaining is a linear fit of the lifetime percentage
+# over the history and only shows up once there is a day of it and the percentage is going down.
+#
+# smart_summary_disks{status}, smart_summary_disks_timeout, smart_summary_temperature_celsius_max,
+# smart_summary_lifetime_percent_min:
+# Per host summaries with --summary (see summary.py), disks are counted once per serial.  --detail unhealthy
+# drops every per-device series of disks with status 0, which also leaves diskidentity.py without them.
+#
+# NVMe devices are read directly with the admin get-log-page ioctl and sysfs (see nvmehealth.py) instead of
+# smartctl, which gives the same series without a process and JSON document per device.  If that doesn't work
+# for a device it falls back to smartctl.  --no-nvme-native always uses smartctl.  With --replay the log pages
+# are read from DIR/nvme/<name>.smart-log if that directory exists, --record always uses smartctl.
+#
+# Disks behind a MegaRAID/PERC controller are hidden behind its virtual disks, which smartctl can't open and
+# says to try '-d megaraid,N' for.  When the scan finds one of those, 'smartctl --scan-open -d megaraid' lists the
+# physical disks of every controller once (/dev/bus/0 -d sat+megaraid,8 and so on), and they are queried through
+# the controller like any other disk.  The controller firmware answers one pass-through at a time and that is
+# the slowest part of a run, so:
+# - the disks of a controller are queried one after the other (--megaraid-per-controller), other controllers and
+#   disks go on in parallel, and the controllers with the most disks are started first
+# - what a megaraid disk answered is kept in --megaraid-cache and reused for --megaraid-ttl seconds
+# - the time spent per controller goes in the status file with the instrumentation series (collectorlib.RunStats):
+#   smart_controller_probe_seconds{controller}  time spent querying the disks of the controller
+#   smart_controller_probe_disks{controller,source="smartctl"|"cache"}  disks queried, or answered from the cache
+#
+# The device list from 'smartctl --scan-open' is cached in --topology-cache and reused until the disks
+# under /sys/block change, see the topology cache functions below.
+#
+# Run by remotepoll.py for another host everything comes from smartctl over ssh.  There is no sysfs to tell
+# when disks changed, so the device list is scanned every run, and NVMe devices are always read with smartctl.
+#
+# storage_disk_changed_total{collector="smartinfo",change}:
+# Disks added, removed or replaced (another serial behind the device) since --snapshots was started,
+# see snapshotstore.py.  diskhistory.py shows when and what.
+#
 # Output labels do not necessarily match the names of SMART attributes.
 #
 # scsi_grown_defect_list is mapped to smart_disk_attr_total{name='reallocated_sector_count'} since they are the same thing
@@ -27,24 +77,87 @@
 # scsi_error_counter_log total_uncorrected_errors for read/write/verify are summed and mapped to 
 # smart_disk_attr_total{name='uncorrectable_error_cnt'} (which matches the ATA attribute)
 
-import subprocess
-
-import subprocess
+import os
 import os.path
 import json
 import sys
+import argparse
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from collectorlib import CommandRunner, CommandTimeout, CollectorError, RunStats, add_output_args, add_profile_args, add_replay_args, emit, is_remote, loads, profiled, sysfs_root, transport_from_args
+from exposition import Labels, Registry
+from nvmehealth import FileBackend, IoctlBackend, NvmeReader, NvmeUnavailable
+from smarthistory import History, days_remaining, increase, rate_per_day
+from snapshotstore import add_snapshot_args, record
+from summary import add_max, add_min, add_status_counts, add_summary_args, drop_healthy, samples, wants_summary
 
 cli = '/sbin/smartctl'
 
-
-if not os.path.isfile(cli):
-    sys.exit(1)
+def build_parser():
+    parser = argparse.ArgumentParser(description='Collect SMART info from disks as prometheus series')
+    # metrics.sh passes the cluster name to every script, we just ignore it
+    parser.add_argument('cluster', nargs='?', help=argparse.SUPPRESS)
+    parser.add_argument('--jobs', type=int, default=8,
+        help='Number of disks to query in parallel (default: 8)')
+    parser.add_argument('--per-controller', type=int, default=2,
+        help='Max parallel queries against a single HBA or RAID controller (default: 2)')
+    parser.add_argument('--megaraid-per-controller', type=int, default=1,
+        help='Max parallel queries of disks behind a single MegaRAID controller (default: 1)')
+    parser.add_argument('--megaraid-ttl', type=float, default=900,
+        help='Seconds to reuse what a disk behind a MegaRAID controller answered before querying it again, 0 to always query (default: 900)')
+    parser.add_argument('--megaraid-cache', default='/var/tmp/smartinfo-megaraid.json',
+        help='File to keep the answers of disks behind MegaRAID controllers in for --megaraid-ttl (default: /var/tmp/smartinfo-megaraid.json)')
+    parser.add_argument('--timeout', type=float, default=60,
+        help='Seconds allowed for a single smartctl call before the disk is reported as timed out (default: 60)')
+    parser.add_argument('--budget', type=float, default=240,
+        help='Seconds allowed for the whole run, disks not queried in time are reported as timed out (default: 240)')
+    parser.add_argument('--topology-cache', default='/var/tmp/smartinfo-topology.json',
+        help='File to keep the device scan in between runs, empty string to always scan (default: /var/tmp/smartinfo-topology.json)')
+    parser.add_argument('--topology-max-age', type=float, default=86400,
+        help='Rescan devices after this many seconds even if sysfs looks unchanged (default: 86400)')
+    parser.add_argument('--full-interval', type=float, default=3600,
+        help='Seconds between full --all queries which read the error and self-test logs, runs in between only ask for '
+            'health and attributes and reuse the log data from --full-cache.  0 to always run --all (default: 3600)')
+    parser.add_argument('--full-cache', default='/var/tmp/smartinfo-full.json',
+        help='File to keep log data from the last full query of each disk (default: /var/tmp/smartinfo-full.json)')
+    parser.add_argument('--history', default='/var/tmp/smartinfo-history.json',
+        help='File to keep counter history in for the derived increase, rate and lifetime series, '
+            'empty string to not keep history (default: /var/tmp/smartinfo-history.json)')
+    parser.add_argument('--history-interval', type=float, default=3600,
+        help='Seconds between history samples of a counter that is not changing (default: 3600)')
+    parser.add_argument('--history-samples', type=int, default=192,
+        help='Number of history samples kept per counter (default: 192, 8 days at the default interval)')
+    parser.add_argument('--no-nvme-native', action='store_true',
+        help='Query NVMe devices with smartctl instead of reading the health log page directly')
+    add_snapshot_args(parser, 'smartinfo')
+    parser.add_argument('--sysfs-root', help=argparse.SUPPRESS)
+    add_summary_args(parser)
+    add_output_args(parser)
+    add_replay_args(parser)
+    add_profile_args(parser)
+    return parser
+
+# the collector can't do anything without the CLI tool
+def available():
+    return os.path.isfile(cli)
 
 mapcmd = {
-    'list': '--scan-open',
-    'disk': '--all'
+    'list': ['--scan-open'],
+    'megaraid': ['--scan-open', '-d', 'megaraid'],
+    'disk': ['--all'],
+    'health': ['--info', '--health', '--attributes']
 }
 
+# 'health' is the fast query.  It does not read the error counter or self-test logs, those parts of the
+# last 'disk' (--all) output are kept and merged in until the next full query is due.
+# the exit status bits for the error log (6) and self-test log (7) are kept the same way
+full_only_keys = ('scsi_error_counter_log', 'scsi_grown_defect_list')
+full_only_bits = 2**6 | 2**7
+# exit status bits of a query that didn't get to the disk at all: command line error (0), device open failed (1)
+failed_bits = 2**0 | 2**1
+
 
 return_mask_bits = {
     1: 2,  # device open failed, or command failed, status returned disk failing
@@ -56,51 +169,240 @@ return_mask_bits = {
     7: 2,  # DST log contains record of errors
 }
 
-# fetch data using command from cli var and return an array of dictionaries as decoded from the JSON results
-def fetch_data(query,disk=None, type=None):
-    cmd = [cli, '--json', mapcmd[query]]
-    if query == 'disk':
-        cmd = cmd + [ disk ]
-    if type:
-        cmd = cmd + [ '-d', type ]
+# the parts of the smartctl output probe_disk uses, all that is kept of a megaraid disk in --megaraid-cache
+probe_keys = ('smartctl', 'serial_number', 'device', 'product', 'model_name', 'revision', 'firmware_version',
+    'ata_smart_attributes', 'temperature', 'scsi_grown_defect_list', 'scsi_error_counter_log',
+    'nvme_smart_health_information_log', 'nvme_namespaces')
+
+# output metric families, probe_disk refers to them by the key
+families = {
+    'status': ('smart_disk_status', 'Disk status mapped from smart return value.  0 = OK, 1 = WARN, 2=FAIL'),
+    'info': ('smart_disk_info', 'Disk model, serial, etc as series labels'),
+    'life': ('smart_disk_lifetime_percent', 'Lifetime remaining for SSD or NVMe devices as percentage from 100 to 0'),
+    'raw': ('smart_disk_attr_total', 'Raw values for attributes which may indicate disk pre-failure if non-zero or increasing rapidly'),
+    'temp': ('smart_disk_temperature_celsius', 'Disk temperatures'),
+    'fresh': ('smart_disk_data_timestamp_seconds', 'When the full data (error and self-test logs) for the disk was last read'),
+    'timeout': ('smart_disk_scrape_timeout', 'Disk did not answer smartctl within the timeout or run budget, other series for it are missing'),
+    'increase': ('smart_disk_attr_increase', 'Increase of smart_disk_attr_total over the window, from the local history kept by the collector'),
+    'rate': ('smart_disk_attr_rate_per_day', 'Average increase per day of smart_disk_attr_total over the local history kept by the collector'),
+    'eta': ('smart_disk_lifetime_days_remaining', 'Days until smart_disk_lifetime_percent reaches 0 at the rate it went down over the local history'),
+}
 
-    p = subprocess.run(cmd,stdout=subprocess.PIPE,stderr=subprocess.DEVNULL)
-    output = p.stdout
- 
-    # smartctl will return exit status and error message as json and we'll handle it appropriately
-    return json.loads(output)
-  
+# per host summaries, see summary.py
+summary_families = {
+    'disks': ('smart_summary_disks', 'Number of disks by smart_disk_status'),
+    'timeout': ('smart_summary_disks_timeout', 'Number of disks that did not answer smartctl in time'),
+    'temp': ('smart_summary_temperature_celsius_max', 'Highest disk temperature'),
+    'life': ('smart_summary_lifetime_percent_min', 'Lowest lifetime remaining of any SSD or NVMe device'),
+}
+
+# every per-device series goes with --detail unhealthy unless the device has a status or timed out
+detail_groups = [
+    (('smart_disk_status', 'smart_disk_scrape_timeout'), ('device',), [ name for name, _ in families.values() ]),
+]
 
-# collect serials and avoid duplicate outputs (multipath devices)
-serials = []
+# windows for smart_disk_attr_increase
+history_windows = (('1d', 86400), ('7d', 7 * 86400))
 
 # collect ssd life counters and pick preferred one to use for lifetime metric
 # the two brands I looked at (Intel, Samsung) both have the unused_rsvd counter but have one of the preceding ones as well
 # my guess is that many brands will have the unused_rsvd attribute at least, but we'd prefer the others if available
 life_counters = ('Percent_Life_Remaining', 'Media_Wearout_Indicator', 'Wear_Leveling_Count', 'Unused_Rsvd_Blk_Cnt_Tot')
-# to be used to collect counters found on a given device
-device_life_counters = {}
-
-
-# output series
-series = {}
-series['info'] = ['# HELP smart_disk_info Disk model, serial, etc as series labels']
-series['life'] = ['# HELP smart_disk_lifetime_percent Lifetime remaining for SSD or NVMe devices as percentage from 100 to 0']
-series['raw'] = ['# HELP smart_disk_attr_total Raw values for attributes which may indicate disk pre-failure if non-zero or increasing rapidly']
-series['temp'] = ['# HELP smart_disk_temperature_celsius Disk temperatures']
-series['status'] = ['# HELP smart_disk_status Disk status mapped from smart return value.  0 = OK, 1 = WARN, 2=FAIL']
-
-disks = fetch_data('list')
 
-for disk in disks['devices']:
+# fetch data using command from cli var and return an array of dictionaries as decoded from the JSON results
+def fetch_data(runner, query, disk=None, type=None):
+    cmd = [cli, '--json'] + mapcmd[query]
+    if query in ('disk', 'health'):
+        cmd = cmd + [ disk ]
+    if type:
+        cmd = cmd + [ '-d', type ]
 
-    # virtual disk open will fail and the error will say something like 'try -d sat+megaraid,24'
-    # I'm assuming that other hybrid types may generate the same issue
-    # If this is some other disk that should work but somehow fails to open we'd like to catch that and output a critical status
-    if 'open_error' in disk.keys() and '-d' in disk['open_error']:
-        continue
-        
-    sminfo = fetch_data('disk', disk['name'], disk['type'])
+    # raises CommandTimeout if smartctl hangs, the caller decides what to do about it
+    rc, output = runner.run(cmd, kind=query)
+ 
+    # smartctl will return exit status and error message as json and we'll handle it appropriately
+    # (with a non-zero exit status, so this can't go through runner.check_json)
+    return loads(output)
+
+# nvme devices are read natively if there is a reader, or with smartctl if that doesn't work out
+# the native read gets everything either query would, so it serves both tiers
+def fetch_disk(runner, query, disk, nvme=None):
+    if nvme is not None and disk['type'] == 'nvme':
+        cmd = ['nvme-log-page', disk['name']]
+        timeout = runner.next_timeout()
+        if timeout is not None and timeout <= 0:
+            raise CommandTimeout(cmd, 0)
+        start = time.monotonic()
+        try:
+            sminfo = nvme.read(disk['name'], timeout)
+        except NvmeUnavailable:
+            pass
+        else:
+            if runner.stats:
+                runner.stats.command(cmd, 'nvme', time.monotonic() - start, 0)
+            return sminfo
+
+    return fetch_data(runner, query, disk['name'], disk['type'])
+
+# reader for the native nvme path, None to always use smartctl
+def nvme_reader(args, sysfs):
+    if args.no_nvme_native or args.record or is_remote(args):
+        return None
+    if args.replay:
+        path = os.path.join(args.replay, 'nvme')
+        return NvmeReader(FileBackend(path), sysfs) if os.path.isdir(path) else None
+    return NvmeReader(IoctlBackend(), sysfs)
+
+# figure out which controller a disk sits behind so we can limit concurrent queries per HBA
+# megaraid devices are all addressed through the controller node (/dev/bus/0 -d megaraid,N)
+# everything else is resolved through sysfs to the scsi host or nvme controller it hangs off
+# without sysfs (another host) every disk counts as its own controller
+def controller_of(disk, sysfs='/sys'):
+    if ',' in disk['type'] or sysfs is None:
+        return disk['name']
+
+    sysdev = '{}/block/{}/device'.format(sysfs, os.path.basename(disk['name']))
+    try:
+        parts = os.path.realpath(sysdev).split('/')
+    except OSError:
+        return disk['name']
+
+    # first hostN component is the HBA, nvme devices have no scsi host and are their own controller
+    for part in parts:
+        if part.startswith('host') and part[4:].isdigit():
+            return part
+    return disk['name']
+
+# device topology cache
+# The list from --scan-open and what we derive from each disk (output device name, nvme namespaces) is saved 
+# and reused while sysfs looks the same.  A disk added, removed or replaced changes the entries under /sys/block 
+# or /sys/class/scsi_device (or the dev numbers) and invalidates the whole cache.
+# Disks hidden behind a RAID controller don't always show up in sysfs so the serial from each run is also
+# checked against the cache, and the cache is thrown away after --topology-max-age regardless.
+# { 'fingerprint': str, 'scanned': timestamp, 'devices': [ scan entries ], 'probes': { 'name type': { serial, device, namespaces } } }
+
+# sysfs entries that change when disks come and go
+# None without sysfs, there is nothing to compare against and the cache is not used
+def topology_fingerprint(sysfs='/sys'):
+    if sysfs is None:
+        return None
+    entries = []
+    for sysdir in ['block', 'class/scsi_device', 'class/nvme']:
+        try:
+            names = sorted(os.listdir(os.path.join(sysfs, sysdir)))
+        except OSError:
+            continue
+        for name in names:
+            dev = ''
+            if sysdir == 'block':
+                try:
+                    with open(os.path.join(sysfs, sysdir, name, 'dev')) as fh:
+                        dev = fh.read().strip()
+                except OSError:
+                    pass
+            entries.append('{}/{}={}'.format(sysdir, name, dev))
+    return hashlib.sha1('\n'.join(entries).encode()).hexdigest()
+
+# returns the cached topology or None if there isn't a usable one
+def load_topology(path, fingerprint, max_age):
+    if not path or fingerprint is None:
+        return None
+    try:
+        with open(path) as fh:
+            topo = json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+    if topo.get('fingerprint') != fingerprint:
+        return None
+    if time.time() - topo.get('scanned', 0) > max_age:
+        return None
+    return topo
+
+def save_topology(path, topo):
+    if not path or topo['fingerprint'] is None:
+        return
+    tmp = '{}.{}'.format(path, os.getpid())
+    try:
+        with open(tmp, 'w') as fh:
+            json.dump(topo, fh)
+        os.replace(tmp, path)
+    except OSError:
+        # not being able to cache only costs a rescan next time
+        pass
+
+def probe_key(disk):
+    return '{} {}'.format(disk['name'], disk['type'])
+
+# the full query cache is a dictionary keyed like the topology probes:
+# { 'name type': { 'serial': str, 'time': timestamp, 'bits': exit status bits, 'data': { full_only_keys } } }
+def load_full_cache(path):
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+def save_full_cache(path, cache):
+    tmp = '{}.{}'.format(path, os.getpid())
+    try:
+        with open(tmp, 'w') as fh:
+            json.dump(cache, fh)
+        os.replace(tmp, path)
+    except OSError:
+        # next run will just do full queries again
+        pass
+
+# --megaraid-cache is kept the same way, with what probe_disk used of the last answer of each disk:
+# { 'name type': { 'time': timestamp, 'full_time': timestamp of the full data in it, 'data': { probe_keys } } }
+
+# run the fast or the full query depending on when this disk last had a full one
+# returns (smartctl output, new full cache entry or None if the cached one was used)
+def fetch_tiered(runner, disk, cached, full_interval, nvme=None):
+    now = time.time()
+    if cached and full_interval > 0 and now - cached['time'] < full_interval:
+        sminfo = fetch_disk(runner, 'health', disk, nvme)
+        # a fast query that failed is reported as it is, the cached bits would turn its exit status 1 into
+        # something probe_disk takes for an answer
+        if sminfo['smartctl']['exit_status'] & failed_bits:
+            return sminfo, None
+        # somebody swapped the disk since the last full query, the cached logs are not for this one
+        if sminfo.get('serial_number') == cached['serial']:
+            for key, value in cached['data'].items():
+                sminfo.setdefault(key, value)
+            sminfo['smartctl']['exit_status'] |= cached['bits']
+            return sminfo, None
+
+    sminfo = fetch_disk(runner, 'disk', disk, nvme)
+    entry = {
+        'serial': sminfo.get('serial_number'),
+        'time': now,
+        'bits': sminfo['smartctl']['exit_status'] & full_only_bits,
+        'data': { key: sminfo[key] for key in full_only_keys if key in sminfo }
+    }
+    return sminfo, entry
+
+# query one disk and build the series for it
+# returns a dictionary with the serial number and a list of (family key, Labels, value) samples
+# or with 'error' set to the smartctl messages if the query failed outright
+# or with 'timeout' set if smartctl did not answer in time
+# returns None if the disk should be skipped
+# known is what the topology cache has for this disk from a previous run, or None
+# result['topology'] is what should be cached for the next run
+# cached is the full query cache entry for this disk, result['full'] is set when a full query replaced it
+# recent is the --megaraid-cache entry, used instead of querying the disk if it is less than ttl seconds old
+# (result['reused'] is set then), result['recent'] is set to a new entry for a megaraid disk that was queried
+def probe_disk(runner, disk, known=None, cached=None, full_interval=0, nvme=None, recent=None, ttl=0):
+    now = time.time()
+    reused = recent is not None and now - recent['time'] < ttl
+    if reused:
+        sminfo, full, full_time = recent['data'], None, recent['full_time']
+    else:
+        try:
+            sminfo, full = fetch_tiered(runner, disk, cached, full_interval, nvme)
+        except CommandTimeout:
+            return { 'timeout': True }
+        full_time = (full or cached)['time']
 
     # this applies only to nvme devices, others are empty string
     namespaces = [ '' ]
@@ -114,16 +416,21 @@ for disk in disks['devices']:
     # at least one SATA device out there does not define the temperature attribute so we won't output in that case 
     temperature = None
 
-    # multipath devices will occur twice
-    if sminfo['serial_number'] in serials:
-        continue
-    serials.append(sminfo['serial_number'])
-    
+    # to be used to collect counters found on a given device
+    device_life_counters = {}
+
+    result = { 'serial': sminfo.get('serial_number') }
+    out = result['samples'] = []
+
+    if full is not None:
+        result['full'] = full
+    if reused:
+        result['reused'] = True
+
     rc = sminfo['smartctl']['exit_status']
     if rc == 1:
-        for msg in sminfo['smartctl']['messages']:
-            print("Error in CLI {}: {}".format(msg['severity'], msg['string']))
-        sys.exit(1)
+        result['error'] = sminfo['smartctl']['messages']
+        return result
 
     status = 0 
     for bit in range(1,8):
@@ -141,16 +448,20 @@ for disk in disks['devices']:
 
     # problem with SMART output, skip this disk (on my device it means that SMART is unsupported, this may not be universally true)
     if status == 99:
-        continue
+        return None
 
-    if ',' in disk['type']:
+    serial = sminfo['serial_number']
+
+    # the same disk behind the same path, reuse what we worked out before
+    if known and known['serial'] == serial:
+        device = known['device']
+        namespaces = known['namespaces']
+    elif ',' in disk['type']:
         # looking for types like megaraid,1 or sat+megaraid,1.  Convention may not work universally.    
         # (2nd field is the controller disk identifier like [megaraid_disk_23], then strip off the brackets)
         device = sminfo['device']['info_name'].split()[1][1:-1]
     else:
         device = sminfo['device']['name'].replace('/dev/', '')
-                
-    serial = sminfo['serial_number']
 
     # fields may vary by device type
     model = ''
@@ -163,6 +474,9 @@ for disk in disks['devices']:
         if fw in sminfo:
             firmware = sminfo[fw]
 
+    # labels are escaped once per device and shared by all of its series
+    devlabels = Labels(device=device)
+
     # sata SSD or HDD
     if ('sat' in disk['type']):
         for attr in sminfo['ata_smart_attributes']['table']:
@@ -171,8 +485,7 @@ for disk in disks['devices']:
                         'Current_Pending_Sector_Count', 
                         'Command_Timeout', 
                         'Reported_Uncorrectable_Errors'):
-                series['raw'].append('smart_disk_attr_total{{name="{}", device="{}"}} {}'
-                    .format(attr['name'].lower(), device, attr['raw']['value']))
+                out.append(('raw', devlabels.prefixed(name=attr['name'].lower()), attr['raw']['value']))
             
             # set a var for consistency with other device types which we map onto the same name
             if attr['name'] == 'Uncorrectable_Error_Cnt':
@@ -193,14 +506,14 @@ for disk in disks['devices']:
     if disk['type'] == 'scsi':
         temperature = sminfo['temperature']['current']
         # map grown defects to similar ATA attribute 
-        series['raw'].append('smart_disk_attr_total{{name="{}", device="{}"}} {}'.format('reallocated_sector_count', device, sminfo['scsi_grown_defect_list']))
+        out.append(('raw', devlabels.prefixed(name='reallocated_sector_count'), sminfo['scsi_grown_defect_list']))
         # troubleshooting
         # print("{}, {}".format(device, model))
 
         # sum all these into the same attribute used for SATA disks, seems spiritually the same thing
         for eclog in ['read', 'write', 'verify']:
             # not all of these are assured to be in the data structure (SEAGATE ST8000NM0185 doesn't have it, but other Seagate and HGST do have it)
-            if eclog in sminfo['scsi_error_counter_log']:
+            if eclog in sminfo.get('scsi_error_counter_log', {}):
                 value = sminfo['scsi_error_counter_log'][eclog]['total_uncorrected_errors']
                 total_unc = value + total_unc
             
@@ -210,7 +523,8 @@ for disk in disks['devices']:
         total_unc = nvmelog['media_errors']
         lifetime = nvmelog['available_spare']
 
-        namespaces = map(lambda x: 'n{}'.format(x['id']), sminfo['nvme_namespaces'])
+        if not (known and known['serial'] == serial):
+            namespaces = [ 'n{}'.format(x['id']) for x in sminfo['nvme_namespaces'] ]
         # nvme devices can have multiple namespaces - we would like to have a metric for each one so it can be correlated to
         # other metrics which use the full /dev/nvme0n1 addressing (pretty much everything else)
         # it doesn't make sense to scan each namespace separately - they all refer to the same hardware
@@ -221,21 +535,282 @@ for disk in disks['devices']:
     # smart_disk_attr_total is also appended to output separately for some ATA and SCSI stats
     # for everything else this is the only place it is appended
     for ns in namespaces:
-        nsdevice = device + ns
+        nslabels = Labels(device=device + ns) if ns else devlabels
 
         if lifetime:
-            series['life'].append('smart_disk_lifetime_percent{{device="{}"}} {}'.format(nsdevice, lifetime))
-        series['raw'].append('smart_disk_attr_total{{name="{}", device="{}"}} {}'.format('uncorrectable_error_cnt', nsdevice, total_unc)) 
-        series['status'].append('smart_disk_status{{device="{}"}} {}'.format(nsdevice,status))
-        series['info'].append('smart_disk_info{{device="{}", serial="{}", model="{}", firmware="{}"}} 1'
-            .format(nsdevice,serial,model,firmware))
+            out.append(('life', nslabels, lifetime))
+        out.append(('raw', nslabels.prefixed(name='uncorrectable_error_cnt'), total_unc))
+        out.append(('status', nslabels, status))
+        out.append(('info', Labels(device=device + ns, serial=serial, model=model, firmware=firmware), 1))
         if temperature:
-            series['temp'].append('smart_disk_temperature_celsius{{device="{}"}} {}'.format(nsdevice,temperature))
-    
-for s in ['status', 'info', 'life', 'raw', 'temp']:
-    series[s].sort()
-    for v in series[s]:
-        print(v)
+            out.append(('temp', nslabels, temperature))
+        out.append(('fresh', nslabels.prefixed(tier='full'), int(full_time)))
+
+    result['topology'] = { 'serial': serial, 'device': device, 'namespaces': list(namespaces) }
+    if ttl > 0 and not reused and is_megaraid(disk):
+        result['recent'] = { 'time': now, 'full_time': full_time, 'data': { key: sminfo[key] for key in probe_keys if key in sminfo } }
+    return result
+
+# update the history of a counter or lifetime sample and add the series derived from it
+def add_derived(series, history, now, serial, key, labels, value):
+    name = labels.get('name', 'lifetime')
+    ring = history.update('{} {}'.format(serial, name), now, value)
+    if key == 'raw':
+        for window, seconds in history_windows:
+            inc = increase(ring, seconds)
+            if inc is not None:
+                series['increase'].add(labels.prefixed(window=window), inc)
+        rate = rate_per_day(ring)
+        if rate is not None:
+            series['rate'].add(labels, round(rate, 3))
+    else:
+        days = days_remaining(ring)
+        if days is not None:
+            series['eta'].add(labels, int(days))
+
+def add_summary(registry):
+    summary = { key: registry.family(name, help) for key, (name, help) in summary_families.items() }
+
+    # nvme namespaces and the like share a serial, count the disk once with its worst status
+    serials = { labels.get('device'): labels.get('serial') for labels, _ in samples(registry, 'smart_disk_info') }
+    status = {}
+    for labels, value in samples(registry, 'smart_disk_status'):
+        disk = serials.get(labels.get('device'), labels.get('device'))
+        status[disk] = max(status.get(disk, 0), value)
+
+    add_status_counts(summary['disks'], status.values())
+    summary['timeout'].add(None, len(samples(registry, 'smart_disk_scrape_timeout')))
+    add_max(summary['temp'], [ v for _, v in samples(registry, 'smart_disk_temperature_celsius') ])
+    add_min(summary['life'], [ v for _, v in samples(registry, 'smart_disk_lifetime_percent') ])
+
+def is_megaraid(disk):
+    return 'megaraid' in disk['type']
+
+# a virtual disk of a MegaRAID controller, smartctl can't open it and says to try -d megaraid,N
+def megaraid_error(disk):
+    return 'megaraid' in disk.get('open_error', '').lower()
+
+# disks grouped into lanes, each lane is queried one disk after the other by one task in the pool
+# a controller gets at most --per-controller lanes (--megaraid-per-controller for a MegaRAID one) and its disks
+# are dealt out over them, so no worker in the pool sits waiting for a controller while there are other disks to do
+# lanes with the most disks go first so a busy controller doesn't end up the only thing still running
+# returns [ (controller, [ disk indexes ]) ]
+def probe_lanes(disks, sysfs, per_controller, megaraid_per_controller):
+    controllers = {}
+    for i, disk in enumerate(disks):
+        controllers.setdefault(controller_of(disk, sysfs), []).append(i)
+
+    lanes = []
+    for ctrl, indexes in controllers.items():
+        limit = megaraid_per_controller if is_megaraid(disks[indexes[0]]) else per_controller
+        n = max(1, min(limit, len(indexes)))
+        lanes += [ (ctrl, indexes[k::n]) for k in range(n) ]
+    lanes.sort(key=lambda lane: len(lane[1]), reverse=True)
+    return lanes
+
+# query the disks of one lane in turn, returns [ (probe_disk result, seconds) ]
+def probe_lane(runner, disks, indexes, probes, full_cache, recent_cache, args, nvme):
+    results = []
+    for i in indexes:
+        disk = disks[i]
+        key = probe_key(disk)
+        start = time.monotonic()
+        result = probe_disk(runner, disk, probes.get(key), full_cache.get(key), args.full_interval, nvme,
+            recent_cache.get(key), args.megaraid_ttl)
+        results.append((result, time.monotonic() - start))
+    return results
+
+# time spent per controller and how many disks were queried or answered from --megaraid-cache, for RunStats.extra
+def add_probe_cost(registry, lanes, timings, results):
+    seconds = registry.family('smart_controller_probe_seconds', 'Time spent querying the disks behind the controller in the last run')
+    counts = registry.family('smart_controller_probe_disks', 'Disks behind the controller queried with smartctl or answered from the cache in the last run')
+    cost = {}
+    for ctrl, indexes in lanes:
+        total, queried, reused = cost.get(ctrl, (0.0, 0, 0))
+        for i in indexes:
+            total += timings[i]
+            if results[i] is not None and results[i].get('reused'):
+                reused += 1
+            else:
+                queried += 1
+        cost[ctrl] = (total, queried, reused)
+    for ctrl, (total, queried, reused) in cost.items():
+        labels = Labels(controller=ctrl)
+        seconds.add(labels, round(total, 3))
+        counts.add(labels.prefixed(source='smartctl'), queried)
+        counts.add(labels.prefixed(source='cache'), reused)
+
+# label for a disk that timed out, we never got the real device name from smartctl
+# so use the name from the scan plus the type for megaraid devices which all share the controller node
+def timeout_labels(disk):
+    device = disk['name'].replace('/dev/', '')
+    if ',' in disk['type']:
+        return Labels(device=device, type=disk['type'])
+    return Labels(device=device)
+
+# run a full collection and return a Registry with the output
+# raises CollectorError with the smartctl messages if smartctl itself reports a failure
+# every smartctl call is recorded in stats if given
+def collect(args, stats=None):
+    runner = CommandRunner(timeout=args.timeout, budget=args.budget, transport=transport_from_args(args), stats=stats)
+    sysfs = sysfs_root(args)
+
+    # output series
+    registry = Registry()
+    series = { key: registry.family(name, help) for key, (name, help) in families.items() }
+
+    fingerprint = topology_fingerprint(sysfs)
+    topo = load_topology(args.topology_cache, fingerprint, args.topology_max_age)
+
+    if topo is None:
+        try:
+            disks = fetch_data(runner, 'list')
+        except CommandTimeout:
+            # nothing else to do without a device list, but still say why the output is empty
+            series['timeout'].add(Labels(device='scan'), 1)
+            return registry
+
+        # virtual disk open will fail and the error will say something like 'try -d sat+megaraid,24'
+        # I'm assuming that other hybrid types may generate the same issue
+        # If this is some other disk that should work but somehow fails to open we'd like to catch that and output a critical status
+        scanned = disks['devices']
+        disks = [ disk for disk in scanned if not ('open_error' in disk.keys() and '-d' in disk['open_error']) ]
+        topo = { 'fingerprint': fingerprint, 'scanned': time.time(), 'devices': disks, 'probes': {} }
+
+        # the physical disks behind MegaRAID virtual disks, one listing for all controllers
+        if any(megaraid_error(disk) for disk in scanned):
+            try:
+                found = fetch_data(runner, 'megaraid')['devices']
+            except CommandTimeout:
+                series['timeout'].add(Labels(device='scan', type='megaraid'), 1)
+                # try again next run instead of going without them until the cache expires
+                topo['scanned'] = 0
+                found = []
+            listed = { probe_key(disk) for disk in disks }
+            disks += [ disk for disk in found if 'open_error' not in disk and probe_key(disk) not in listed ]
+
+    disks = topo['devices']
+    probes = topo['probes']
+    full_cache = load_full_cache(args.full_cache) if args.full_interval > 0 else {}
+    use_recent = args.megaraid_ttl > 0 and args.megaraid_cache and any(is_megaraid(disk) for disk in disks)
+    recent_cache = load_full_cache(args.megaraid_cache) if use_recent else {}
+    nvme = nvme_reader(args, sysfs)
+
+    # smartctl spends nearly all of its time waiting on the disk so threads are enough here
+    # results are kept in scan order so the multipath de-duplication below picks the same path every run
+    lanes = probe_lanes(disks, sysfs, args.per_controller, args.megaraid_per_controller)
+    results = [ None ] * len(disks)
+    timings = [ 0.0 ] * len(disks)
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = [ pool.submit(probe_lane, runner, disks, indexes, probes, full_cache, recent_cache, args, nvme) for _, indexes in lanes ]
+        for (_, indexes), future in zip(lanes, futures):
+            for i, (result, seconds) in zip(indexes, future.result()):
+                results[i] = result
+                timings[i] = seconds
+
+    if stats is not None:
+        add_probe_cost(stats.extra, lanes, timings, results)
+
+    # a disk that was swapped behind a path sysfs doesn't know about (megaraid) means the scan is out of date
+    # keep what we found this time for the next run but make it rescan
+    changed = False
+    for disk, result in zip(disks, results):
+        if result is None or 'topology' not in result:
+            continue
+        key = probe_key(disk)
+        known = probes.get(key)
+        if known and known['serial'] != result['topology']['serial']:
+            topo['scanned'] = 0
+        if known != result['topology']:
+            probes[key] = result['topology']
+            changed = True
+
+    if changed or topo['scanned'] == 0:
+        save_topology(args.topology_cache, topo)
+
+    # drop disks which are gone so the cache doesn't grow forever
+    current = { probe_key(disk): full_cache[probe_key(disk)] for disk in disks if probe_key(disk) in full_cache }
+    full_changed = len(current) != len(full_cache)
+    full_cache = current
+    for disk, result in zip(disks, results):
+        if result is not None and 'full' in result:
+            full_cache[probe_key(disk)] = result['full']
+            full_changed = True
+
+    if full_changed and args.full_interval > 0:
+        save_full_cache(args.full_cache, full_cache)
+
+    if use_recent:
+        current = { probe_key(disk): recent_cache[probe_key(disk)] for disk in disks if probe_key(disk) in recent_cache }
+        recent_changed = len(current) != len(recent_cache)
+        recent_cache = current
+        for disk, result in zip(disks, results):
+            if result is not None and 'recent' in result:
+                recent_cache[probe_key(disk)] = result['recent']
+                recent_changed = True
+        if recent_changed:
+            save_full_cache(args.megaraid_cache, recent_cache)
+
+    for disk, result in zip(disks, results):
+        if result is not None and 'timeout' in result:
+            series['timeout'].add(timeout_labels(disk), 1)
+
+    history = History.load(args.history, args.history_interval, args.history_samples) if args.history else None
+    now = time.time()
+
+    # collect serials and avoid duplicate outputs (multipath devices)
+    serials = []
+
+    for result in results:
+        if result is None or 'timeout' in result:
+            continue
+
+        # multipath devices will occur twice
+        if result['serial'] in serials:
+            continue
+        serials.append(result['serial'])
+
+        if 'error' in result:
+            raise CollectorError([ "Error in CLI {}: {}".format(msg['severity'], msg['string']) for msg in result['error'] ])
+
+        for key, labels, value in result['samples']:
+            series[key].add(labels, value)
+            if history is not None and key in ('raw', 'life'):
+                add_derived(series, history, now, result['serial'], key, labels, value)
+
+    if history is not None:
+        history.prune(now)
+        history.save(args.history)
+
+    # device -> serial for the snapshot, disks that timed out keep what they had
+    # the real device name of a megaraid disk is only known from its answer, if one of those timed out keep them all
+    timed_out = { labels.get('device') for labels, _ in series['timeout'].samples }
+    keep_all = any(labels.get('type') for labels, _ in series['timeout'].samples)
+    rows = { labels.get('device'): labels.get('serial') for labels, _ in series['info'].samples }
+    record(args, registry, 'smartinfo', rows, lambda key: keep_all or key in timed_out, now)
+
+    if wants_summary(args):
+        add_summary(registry)
+    if args.detail == 'unhealthy':
+        drop_healthy(registry, detail_groups)
+
+    return registry
+
+def main():
+    args = build_parser().parse_args()
+
+    if not available() and not args.replay:
+        sys.exit(1)
 
+    stats = RunStats('smartinfo')
+    try:
+        registry = profiled(args, lambda: collect(args, stats), stats)
+    except CollectorError as err:
+        for msg in err.messages:
+            print(msg)
+        sys.exit(1)
 
+    emit(args, 'smartinfo', registry, stats)
 
+if __name__ == '__main__':
+    main()
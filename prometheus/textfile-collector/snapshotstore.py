@@ -0,0 +1,250 @@
+# Append-only store of what the storage collectors found on every run, for spotting disk replacements and
+# OSD remaps without going through prometheus history (see diskhistory.py for the command line side).
+#
+# Each collector keeps its own file (--snapshots) of key -> value rows:
+# smartinfo.py      'sdc' -> serial of the disk behind the device
+# osdinfo.py        'osd.12 block' -> devices of the OSD, comma separated
+# enclosureinfo.py  '<enclosure wwn> <slot>' -> WWN of the drive in the slot, empty if there is none
+#
+# Most runs find exactly what the last one did and don't write anything.  A run that finds something different
+# appends one record with only the changes, so the file grows with hardware changes and not with time.
+# Strings are stored once per file and rows refer to them by number, so a record is a few bytes per change:
+#
+#   header   b'SNAPSTORE1\n'
+#   record   <I body length> <d timestamp> <I new strings> (<H length> utf-8)... <I set rows> <I removed rows>
+#            set keys, set values, removed keys: columns of <I string ids>
+#
+# The first record has every row, the state at any later point is the first record with the ones after it applied.
+# A record cut short by a crash is dropped when the file is read and cut off before the next append.
+#
+# Keys that couldn't be queried this run (a disk that timed out, the slots of an enclosure whose listing did)
+# keep their last value instead of counting as removed and added again.
+#
+# Changes between records are classified by what happened to the value of a key:
+# added     the key is new or had an empty value (a drive in an empty slot)
+# removed   the key is gone or its value is now empty
+# replaced  the value changed (another serial behind the device, the OSD on other devices)
+
+import array
+import struct
+import sys
+import time
+
+from exposition import Labels
+
+magic = b'SNAPSTORE1\n'
+record_header = struct.Struct('<IdI')
+string_length = struct.Struct('<H')
+row_counts = struct.Struct('<II')
+
+changes = ('added', 'removed', 'replaced')
+
+
+def change_of(old, new):
+    if not old:
+        return 'added' if new else None
+    if not new:
+        return 'removed'
+    return 'replaced' if old != new else None
+
+# columns of string ids as bytes, always little endian like the rest of the record
+def pack_ids(ids):
+    column = array.array('I', ids)
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column.tobytes()
+
+def unpack_ids(data, offset, count):
+    column = array.array('I')
+    column.frombytes(data[offset:offset + 4 * count])
+    if sys.byteorder != 'little':
+        column.byteswap()
+    return column, offset + 4 * count
+
+
+class Record:
+    __slots__ = ('time', 'set_keys', 'set_values', 'removed')
+
+    def __init__(self, time, set_keys, set_values, removed):
+        self.time = time
+        self.set_keys = set_keys
+        self.set_values = set_values
+        self.removed = removed
+
+
+class SnapshotStore:
+    def __init__(self):
+        # string id -> string, and back
+        self.strings = []
+        self.ids = {}
+        self.records = []
+        # key id -> value id after the last record
+        self.state = {}
+        # size of the file up to the last complete record, where the next one goes
+        self.size = 0
+        # strings added since the file was read, they go in the next record
+        self.new_strings = 0
+        self.pending = None
+        self.pending_strings = []
+
+    # an empty store if the file isn't there or isn't one of ours, it starts over with the next save()
+    @classmethod
+    def load(cls, path):
+        store = cls()
+        try:
+            with open(path, 'rb') as fh:
+                data = fh.read()
+        except OSError:
+            return store
+        if not data.startswith(magic):
+            return store
+
+        offset = len(magic)
+        while offset + record_header.size <= len(data):
+            length, when, nstrings = record_header.unpack_from(data, offset)
+            end = offset + 4 + length
+            if end > len(data):
+                break
+            pos = offset + record_header.size
+            for _ in range(nstrings):
+                n, = string_length.unpack_from(data, pos)
+                store.intern(data[pos + 2:pos + 2 + n].decode('utf-8'))
+                pos += 2 + n
+            nset, nremoved = row_counts.unpack_from(data, pos)
+            pos += row_counts.size
+            set_keys, pos = unpack_ids(data, pos, nset)
+            set_values, pos = unpack_ids(data, pos, nset)
+            removed, pos = unpack_ids(data, pos, nremoved)
+            store.apply(Record(when, set_keys, set_values, removed))
+            offset = end
+        store.size = offset
+        store.new_strings = 0
+        return store
+
+    def intern(self, text):
+        i = self.ids.get(text)
+        if i is None:
+            i = self.ids[text] = len(self.strings)
+            self.strings.append(text)
+            self.new_strings += 1
+        return i
+
+    def apply(self, record):
+        self.records.append(record)
+        self.state.update(zip(record.set_keys, record.set_values))
+        for key in record.removed:
+            self.state.pop(key, None)
+
+    # rows of this run { key: value }, keep(key) is true for keys that couldn't be queried and stay as they were
+    # returns the changes [ (key, old value, new value, change) ], a record with them is written by save()
+    def update(self, rows, now, keep=None):
+        ids = { self.intern(key): self.intern(value) for key, value in rows.items() }
+        set_keys, set_values, removed = [], [], []
+        for key, value in ids.items():
+            if self.state.get(key) != value:
+                set_keys.append(key)
+                set_values.append(value)
+        for key in self.state:
+            if key not in ids and not (keep and keep(self.strings[key])):
+                removed.append(key)
+        if not set_keys and not removed:
+            return []
+
+        found = []
+        first = not self.records
+        for key, value in zip(set_keys, set_values):
+            change = change_of(self.value(self.state.get(key)), self.strings[value])
+            if change and not first:
+                found.append((self.strings[key], self.value(self.state.get(key)), self.strings[value], change))
+        for key in removed:
+            if self.strings[self.state[key]]:
+                found.append((self.strings[key], self.strings[self.state[key]], '', 'removed'))
+
+        self.pending = Record(now, array.array('I', set_keys), array.array('I', set_values), array.array('I', removed))
+        self.pending_strings = self.strings[len(self.strings) - self.new_strings:]
+        self.apply(self.pending)
+        return found
+
+    def value(self, i):
+        return '' if i is None else self.strings[i]
+
+    # append the record of the last update(), if it changed anything
+    def save(self, path):
+        if self.pending is None:
+            return
+        record = self.pending
+        body = [ struct.pack('<dI', record.time, len(self.pending_strings)) ]
+        for text in self.pending_strings:
+            data = text.encode('utf-8')
+            body.append(string_length.pack(len(data)) + data)
+        body.append(row_counts.pack(len(record.set_keys), len(record.removed)))
+        body += [ pack_ids(record.set_keys), pack_ids(record.set_values), pack_ids(record.removed) ]
+        body = b''.join(body)
+
+        try:
+            with open(path, 'ab') as fh:
+                if fh.tell() == 0 or self.size == 0:
+                    fh.truncate(0)
+                    fh.write(magic)
+                elif fh.tell() != self.size:
+                    # a torn record from a crash, or the file didn't start with our header
+                    fh.truncate(self.size)
+                fh.write(struct.pack('<I', len(body)) + body)
+                self.size = fh.tell()
+        except OSError:
+            # the changes are counted again from the next run that can write, nothing else depends on it
+            return
+        self.pending = None
+        self.new_strings = 0
+
+    # every change in the store, [ (time, key, old value, new value, change) ] oldest first
+    # the first record is where the store starts and doesn't count as a change
+    def history(self):
+        state = {}
+        found = []
+        for n, record in enumerate(self.records):
+            for key, value in zip(record.set_keys, record.set_values):
+                change = change_of(self.value(state.get(key)), self.strings[value])
+                if change and n:
+                    found.append((record.time, self.strings[key], self.value(state.get(key)), self.strings[value], change))
+                state[key] = value
+            for key in record.removed:
+                old = self.value(state.pop(key, None))
+                if old and n:
+                    found.append((record.time, self.strings[key], old, '', 'removed'))
+        return found
+
+    # the rows at a point in time { key: value }, the latest if at is None
+    def rows_at(self, at=None):
+        state = {}
+        for record in self.records:
+            if at is not None and record.time > at:
+                break
+            state.update(zip(record.set_keys, record.set_values))
+            for key in record.removed:
+                state.pop(key, None)
+        return { self.strings[key]: self.strings[value] for key, value in state.items() }
+
+
+def add_snapshot_args(parser, collector):
+    parser.add_argument('--snapshots', default='/var/tmp/{}-snapshots.bin'.format(collector),
+        help='File to keep the history of what the collector found in, for storage_disk_changed_total and diskhistory.py, '
+            'empty string to not keep it (default: /var/tmp/{}-snapshots.bin)'.format(collector))
+
+# record the rows of a run in --snapshots and add storage_disk_changed_total for the collector
+# returns the store, or None without --snapshots
+def record(args, registry, collector, rows, keep=None, now=None):
+    if not args.snapshots:
+        return None
+    store = SnapshotStore.load(args.snapshots)
+    store.update(rows, time.time() if now is None else now, keep)
+    store.save(args.snapshots)
+
+    counts = dict.fromkeys(changes, 0)
+    for _, _, _, _, change in store.history():
+        counts[change] += 1
+    family = registry.family('storage_disk_changed_total',
+        'Devices added, removed or replaced since the collector started keeping --snapshots', 'counter')
+    for change in changes:
+        family.add(Labels(collector=collector, change=change), counts[change])
+    return store
@@ -0,0 +1,63 @@
+# Per host summaries of collector output and dropping the detail series of healthy devices
+#
+# Answering "how many disks are failing per cluster" from the per-disk series means every node sending
+# every disk.  With --summary a collector also emits a handful of per host series (counts by status, worst
+# and extreme values), and with --detail unhealthy it only keeps the per-device series of devices that have
+# a non-zero status.  The summaries are always emitted in that mode, they are all that's left for healthy devices.
+#
+# Collectors describe their devices as groups of (status families, key labels, detail families):
+# a device is unhealthy if any of its status families has a value > 0 for its key, the detail families
+# of healthy devices are emptied.  Families not in any group are left alone.
+
+from exposition import Labels
+
+statuses = (0, 1, 2)
+
+def add_summary_args(parser):
+    parser.add_argument('--summary', action='store_true', help='Also emit per host summary series')
+    parser.add_argument('--detail', choices=['all', 'unhealthy'], default='all',
+        help='Per device series to keep, unhealthy drops the ones of devices with status 0 and implies --summary (default: all)')
+
+def samples(registry, name):
+    fam = registry.families.get(name)
+    return fam.samples if fam else []
+
+def key_of(labels, key_labels):
+    return tuple(labels.get(name) for name in key_labels)
+
+# keep detail series only for devices with a non-zero status in one of the status families
+def drop_healthy(registry, groups):
+    for status_names, key_labels, detail_names in groups:
+        unhealthy = set()
+        for name in status_names:
+            for labels, value in samples(registry, name):
+                if float(value) > 0:
+                    unhealthy.add(key_of(labels, key_labels))
+
+        for name in detail_names:
+            fam = registry.families.get(name)
+            if fam is not None:
+                fam.samples = [ s for s in fam.samples if key_of(s[0], key_labels) in unhealthy ]
+
+# number of distinct keys by status, 0, 1 and 2 are always there so sums over hosts work without 'or vector(0)'
+def add_status_counts(family, values, labels=None):
+    counts = { status: 0 for status in statuses }
+    for value in values:
+        counts[int(value)] = counts.get(int(value), 0) + 1
+    base = labels or Labels()
+    for status, count in sorted(counts.items()):
+        family.add(base.prefixed(status=status), count)
+
+def add_max(family, values):
+    values = [ float(v) for v in values ]
+    if values:
+        family.add(None, max(values))
+
+def add_min(family, values):
+    values = [ float(v) for v in values ]
+    if values:
+        family.add(None, min(values))
+
+# --detail unhealthy implies --summary
+def wants_summary(args):
+    return args.summary or args.detail != 'all'
@@ -0,0 +1,153 @@
+# Index of the block device holder/slave graph from /sys/block, shared by the textfile collectors
+#
+# /sys/block/<dev>/slaves lists the devices <dev> is built on (an LV on a multipath device on two sd paths).
+# Walking that with a glob per device repeats the same dm/mpath subtrees for every OSD on a busy host,
+# so the whole tree is read once here and the list of everything below a device is memoized.
+#
+# sysfs root can be pointed somewhere else to read a synthetic tree (benchmark.py does that)
+#
+# With details the walk also picks up partitions, dev numbers and empty devices (diskinfo.py needs them).
+# For another host (remotepoll.py) the same graph is made from 'lsblk --json --inverse --output NAME,KNAME',
+# which lists every device with the devices it is built on as children.
+#
+# shared_graph() keeps the last walk of a root for a little while so collectors running in the same
+# process (collectord.py) don't each walk /sys/block again.
+
+import os
+import threading
+import time
+
+
+class BlockGraph:
+    def __init__(self):
+        # kernel name -> list of slave kernel names
+        self.slaves = {}
+        # device mapper name (vg-lv, mpatha) -> kernel name (dm-3)
+        self.dm_names = {}
+        # kernel name -> kernel name and every device below it
+        self._below = {}
+        # only with details: kernel name -> 'major:minor', for partitions too
+        self.devnums = {}
+        # only with details: kernel name -> list of partition kernel names
+        self.partitions = {}
+        # only with details: kernel names of devices with no media or backing file (size 0)
+        self.empty = set()
+        # dm kernel name -> device mapper name, made from dm_names when first needed
+        self._dm_kernel = None
+        self.details = False
+
+    @classmethod
+    def from_sysfs(cls, root='/sys', details=False):
+        graph = cls()
+        block = os.path.join(root, 'block')
+        try:
+            names = os.listdir(block)
+        except OSError:
+            return graph
+
+        # plain string joins, os.path.join is a noticeable part of the time with thousands of devices
+        for name in names:
+            devdir = block + '/' + name
+            try:
+                graph.slaves[name] = sorted(os.listdir(devdir + '/slaves'))
+            except OSError:
+                graph.slaves[name] = []
+
+            if name.startswith('dm-'):
+                try:
+                    with open(devdir + '/dm/name') as fh:
+                        graph.dm_names[fh.read().strip()] = name
+                except OSError:
+                    pass
+
+            if details:
+                graph.read_details(devdir, name)
+        graph.details = details
+        return graph
+
+    # graph from the output of 'lsblk --json --inverse --output NAME,KNAME', without details
+    # lsblk names dm devices by their device mapper name like /sys/block/dm-*/dm/name has it
+    @classmethod
+    def from_lsblk(cls, data):
+        graph = cls()
+        stack = list(data.get('blockdevices') or [])
+        while stack:
+            dev = stack.pop()
+            name = dev['kname']
+            children = dev.get('children') or []
+            graph.slaves[name] = sorted(set(graph.slaves.get(name, [])) | { child['kname'] for child in children })
+            if name.startswith('dm-') and dev.get('name'):
+                graph.dm_names[dev['name']] = name
+            stack.extend(children)
+        return graph
+
+    # partitions are the directories under the device named after it, sda/sda1 or nvme0n1/nvme0n1p1
+    def read_details(self, devdir, name):
+        parts = []
+        try:
+            entries = os.listdir(devdir)
+        except OSError:
+            entries = []
+        for entry in entries:
+            if entry.startswith(name) and entry != name:
+                parts.append(entry)
+        self.partitions[name] = sorted(parts)
+
+        for kname, path in [(name, devdir)] + [ (p, devdir + '/' + p) for p in parts ]:
+            try:
+                with open(path + '/dev') as fh:
+                    self.devnums[kname] = fh.read().strip()
+                with open(path + '/size') as fh:
+                    if fh.read().strip() == '0':
+                        self.empty.add(kname)
+            except OSError:
+                pass
+
+    # device mapper name of a dm- device, None for anything else
+    def dm_name(self, kname):
+        if self._dm_kernel is None:
+            self._dm_kernel = { k: n for n, k in self.dm_names.items() }
+        return self._dm_kernel.get(kname)
+
+    # the device itself followed by all devices below it, depth first
+    # devices reached twice (two LVs on one mpath under the same top device) are only listed once
+    def below(self, name):
+        if name in self._below:
+            return self._below[name]
+
+        devs = [name]
+        seen = {name}
+        for slave in self.slaves.get(name, []):
+            for dev in self.below(slave):
+                if dev not in seen:
+                    seen.add(dev)
+                    devs.append(dev)
+
+        self._below[name] = devs
+        return devs
+
+    # kernel name (dm-3) for an LV path like /dev/vg/lv or /dev/mapper/vg-lv
+    # device mapper doubles dashes inside the vg and lv names and joins them with a single dash
+    # returns None if the path doesn't look like an LV we know about
+    def lv_kernel_name(self, path):
+        parts = path.rstrip('/').split('/')
+        if len(parts) >= 3 and parts[-2] == 'mapper':
+            return self.dm_names.get(parts[-1])
+        if len(parts) >= 4:
+            vg, lv = parts[-2], parts[-1]
+            return self.dm_names.get('{}-{}'.format(vg.replace('-', '--'), lv.replace('-', '--')))
+        return None
+
+
+# root -> (time, BlockGraph) of the last walk
+_shared = {}
+_shared_lock = threading.Lock()
+
+# graph of root, walked again if the last one is more than max_age seconds old or doesn't have the details asked for
+def shared_graph(root='/sys', max_age=30, details=False):
+    with _shared_lock:
+        now = time.monotonic()
+        cached = _shared.get(root)
+        if cached is None or now - cached[0] > max_age or (details and not cached[1].details):
+            cached = _shared[root] = (now, BlockGraph.from_sysfs(root, details))
+        return cached[1]
@@ -0,0 +1,66 @@
+# collectord.py /metrics output for collectors run against the benchmark.py fixtures.
+# Run from the textfile-collector directory:  python3 -m unittest discover tests
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import collectord
+from exposition import parse
+
+# all three add storage_disk_changed_total with --snapshots
+names = ('smartinfo', 'osdinfo', 'enclosureinfo')
+
+
+class RenderTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test-collectord-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def collector(self, name):
+        replay = os.path.join(self.dir, name)
+        scratch = os.path.join(self.dir, name + '-state')
+        os.makedirs(scratch)
+        benchmark.write_fixture(replay, name, 2)
+        argv = benchmark.replay_argv(name, replay, scratch, argparse.Namespace(smartctl_nvme=False))
+        c = collectord.Collector(name, 300, argv)
+        c.run_once()
+        self.assertEqual(c.success, 1, name)
+        return c
+
+    def test_one_family_per_name(self):
+        text = collectord.render([ self.collector(name) for name in names ])
+
+        helps = [ line.split()[2] for line in text.splitlines() if line.startswith('# HELP ') ]
+        self.assertEqual(len(helps), len(set(helps)), sorted(h for h in helps if helps.count(h) > 1))
+
+        registry = parse(text)
+        changed = registry.families['storage_disk_changed_total']
+        self.assertEqual(set(labels.get('collector') for labels, _ in changed.samples), set(names))
+        # and nothing came out twice
+        series = [ (name, labels.text) for name, fam in registry.families.items() for labels, _ in fam.samples ]
+        self.assertEqual(len(series), len(set(series)))
+
+    def test_failed_collector_keeps_its_status(self):
+        # lvs has no answer
+        empty = os.path.join(self.dir, 'empty')
+        benchmark.write_fixture(empty, 'diskinfo', 0)
+        c = collectord.Collector('osdinfo', 300, ['ceph', '--replay', empty])
+        with self.assertLogs('collectord', 'ERROR'):
+            c.run_once()
+        registry = parse(collectord.render([ self.collector('enclosureinfo'), c ]))
+        success = dict((labels.get('collector'), value) for labels, value in registry.families['collectord_collector_success'].samples)
+        self.assertEqual(success, { 'enclosureinfo': 1, 'osdinfo': 0 })
+        self.assertNotIn('ceph_osd_device_info', registry.families)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# collectorlib.py helpers.  Run from the textfile-collector directory:  python3 -m unittest discover tests
+
+import os
+import signal
+import subprocess
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collectorlib import CommandAbandoned, CommandTimeout, LocalTransport, RunStats
+from exposition import Labels
+
+
+class LocalTransportTest(unittest.TestCase):
+    def test_output(self):
+        self.assertEqual(LocalTransport().run(['sh', '-c', 'echo hello; exit 3']), (3, b'hello\n'))
+
+    def test_timeout_kills(self):
+        start = time.monotonic()
+        with self.assertRaises(CommandTimeout) as raised:
+            LocalTransport().run(['sleep', '30'], timeout=0.2)
+        self.assertNotIsInstance(raised.exception, CommandAbandoned)
+        self.assertLess(time.monotonic() - start, 5)
+
+    # a process in D state doesn't go away on SIGKILL, a kill that does nothing looks the same from here
+    def test_unkillable_is_left_behind(self):
+        transport = LocalTransport()
+        transport.kill_wait = 0.2
+        start = time.monotonic()
+        with mock.patch.object(subprocess.Popen, 'kill'):
+            with self.assertRaises(CommandAbandoned) as raised:
+                transport.run(['sleep', '30'], timeout=0.2)
+        self.assertLess(time.monotonic() - start, 5)
+        pid = raised.exception.pid
+        self.assertIn('pid {} left behind'.format(pid), str(raised.exception))
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+
+class RunStatsTest(unittest.TestCase):
+    def run_stats(self, host, seconds):
+        stats = RunStats('smartinfo')
+        stats.command(['smartctl', '-a', '/dev/sda'], 'smartctl', seconds, 0)
+        stats.command(['smartctl', '-a', '/dev/sdb'], 'smartctl', 0.01, 4)
+        stats.cache_hit('lsblk')
+        stats.extra.family('smart_controller_probe_seconds', 'Time per controller').add(Labels(host=host, controller='0'), seconds)
+        return stats
+
+    def test_merge(self):
+        stats = RunStats('remotepoll')
+        stats.merge(self.run_stats('head1', 2.0))
+        stats.merge(self.run_stats('head2', 0.5))
+
+        counts, count, total = stats.latency['smartctl']
+        self.assertEqual(count, 4)
+        self.assertAlmostEqual(total, 2.52)
+        self.assertEqual(counts[-1], 4)
+        self.assertEqual(stats.exits, { ('smartctl', '0'): 2, ('smartctl', '4'): 2 })
+        self.assertEqual(stats.cached, { 'lsblk': 2 })
+        self.assertEqual([ seconds for seconds, _ in stats.slowest ], [2.0, 0.5, 0.01, 0.01])
+        probes = stats.extra.families['smart_controller_probe_seconds'].samples
+        self.assertEqual([ (labels.get('host'), value) for labels, value in probes ], [ ('head1', 2.0), ('head2', 0.5) ])
+
+    # collectord.py keeps adding up the command counts but shows the latest run
+    def test_add_takes_over_the_run(self):
+        stats = RunStats('smartinfo')
+        stats.add(self.run_stats('head1', 2.0))
+        stats.add(self.run_stats('head1', 0.5))
+        self.assertEqual(stats.latency['smartctl'][1], 4)
+        self.assertEqual([ seconds for seconds, _ in stats.slowest ], [0.5, 0.01])
+        self.assertEqual(len(stats.extra.families['smart_controller_probe_seconds'].samples), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+# diskidentity.py joining smartinfo output and lsblk.  Run from the textfile-collector directory:  python3 -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from diskidentity import DiskIndex
+from exposition import Labels, Registry
+
+
+class DiskIndexTest(unittest.TestCase):
+    def identity(self, index):
+        registry = Registry()
+        index.add_to(registry.family('storage_disk_identity', 'identity'))
+        return { labels.get('serial'): labels for labels, _ in registry.families['storage_disk_identity'].samples }
+
+    def smart(self, *disks):
+        registry = Registry()
+        fam = registry.family('smart_disk_info', 'info')
+        for device, serial, model in disks:
+            fam.add(Labels(device=device, serial=serial, model=model, firmware='1'), 1)
+        return registry
+
+    def test_model_from_lsblk_if_smartctl_had_none(self):
+        index = DiskIndex()
+        index.add_smart(self.smart(('sda', 'Z1', ''), ('sdb', 'Z2', 'ST8000NM0075')))
+        index.add_lsblk({ 'sda': ('Z1', '5000c500a1b2c3d4', 'HGST HUH721010AL'), 'sdb': ('Z2', '', 'ST8000NM') })
+        disks = self.identity(index)
+        self.assertEqual(disks['Z1'].get('model'), 'HGST HUH721010AL')
+        self.assertEqual(disks['Z1'].get('wwn'), '5000c500a1b2c3d4')
+        self.assertEqual(disks['Z2'].get('model'), 'ST8000NM0075')
+
+    def test_megaraid_disks_kept_apart_from_kernel_names(self):
+        index = DiskIndex()
+        index.add_smart(self.smart(('megaraid_disk_0', 'M1', 'ST4000'), ('sda', 'Z1', 'ST8000')))
+        # the virtual disk of the controller, with a serial of its own
+        index.add_lsblk({ 'sda': ('Z1', '', ''), 'sdb': ('VD0', '', 'PERC H730P Mini') })
+        self.assertEqual(sorted(index.by_kname), ['sda', 'sdb'])
+        self.assertEqual(sorted(index.by_megaraid), ['megaraid_disk_0'])
+
+        disks = self.identity(index)
+        self.assertEqual(disks['M1'].get('device'), 'megaraid_disk_0')
+        self.assertEqual(disks['M1'].get('paths'), '')
+        self.assertEqual(disks['Z1'].get('paths'), 'sda')
+        self.assertEqual(disks['VD0'].get('device'), 'sdb')
+
+
+if __name__ == '__main__':
+    unittest.main()
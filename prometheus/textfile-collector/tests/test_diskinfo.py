@@ -0,0 +1,80 @@
+# diskinfo.py against a made up sysfs and /proc.  Run from the textfile-collector directory:  python3 -m unittest discover tests
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import diskinfo
+
+mountinfo = '''22 1 0:21 / /proc rw,nosuid - proc proc rw
+30 1 8:2 / / rw,relatime - ext4 /dev/sda2 rw
+31 30 65:161 /backup /srv/backup rw,relatime - xfs /dev/sdaa1 rw
+32 30 65:161 / /mnt/backup\\040disk rw,relatime - xfs /dev/sdaa1 rw
+33 30 8:2 /var/tmp /tmp rw,relatime - ext4 /dev/sda2 rw
+'''
+
+swaps = '''Filename				Type		Size		Used		Priority
+/dev/sda1                               partition	8388604		0		-2
+/dev/dm-0                               partition	4194300		0		-3
+'''
+
+
+class CollectTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test-diskinfo-')
+        self.sysfs = os.path.join(self.dir, 'sys')
+        self.proc = os.path.join(self.dir, 'proc')
+        self.device('sda', '8:0', parts={ 'sda1': '8:1', 'sda2': '8:2' })
+        self.device('sdaa', '65:160', parts={ 'sdaa1': '65:161' })
+        self.device('dm-0', '253:0', dm_name='vg0-swap', slaves=['sdaa'])
+        self.device('loop0', '7:0', size='0')
+        self.device('loop1', '7:1')
+        os.makedirs(os.path.join(self.proc, 'self'))
+        with open(os.path.join(self.proc, 'self', 'mountinfo'), 'w') as fh:
+            fh.write(mountinfo)
+        with open(os.path.join(self.proc, 'swaps'), 'w') as fh:
+            fh.write(swaps)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path, name, value):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, name), 'w') as fh:
+            fh.write(value + '\n')
+
+    def device(self, name, devnum, parts=None, dm_name=None, slaves=(), size='1000'):
+        devdir = os.path.join(self.sysfs, 'block', name)
+        self.write(devdir, 'dev', devnum)
+        self.write(devdir, 'size', size)
+        os.makedirs(os.path.join(devdir, 'slaves'))
+        for slave in slaves:
+            open(os.path.join(devdir, 'slaves', slave), 'w').close()
+        if dm_name:
+            self.write(os.path.join(devdir, 'dm'), 'name', dm_name)
+        for part, partnum in (parts or {}).items():
+            self.write(os.path.join(devdir, part), 'dev', partnum)
+            self.write(os.path.join(devdir, part), 'size', size)
+
+    def test_devices_and_mountpoints(self):
+        args = diskinfo.build_parser().parse_args(['ceph', '--sysfs-root', self.sysfs, '--proc-root', self.proc, '--sysfs-max-age', '0'])
+        samples = diskinfo.collect(args).families['node_disk_info'].samples
+        found = [ (labels.get('device'), labels.get('devname'), labels.get('mountpoint')) for labels, _ in samples ]
+        self.assertEqual(found, [
+            ('dm-0', 'vg0-swap', '[SWAP]'),
+            ('loop1', 'loop1', ''),
+            ('sda', 'sda', ''),
+            ('sda1', 'sda1', '[SWAP]'),
+            ('sda2', 'sda2', '/'),
+            ('sdaa', 'sdaa', ''),
+            # the whole filesystem wins over a bind mount of a part of it that came first
+            ('sdaa1', 'sdaa1', '/mnt/backup disk'),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
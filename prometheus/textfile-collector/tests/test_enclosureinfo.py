@@ -0,0 +1,51 @@
+# enclosureinfo.py against the benchmark.py secli fixtures, with component listings that don't come back in time.
+# Run from the textfile-collector directory:  python3 -m unittest discover tests
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import enclosureinfo
+
+
+class TimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test-enclosureinfo-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # enclosure_status by enclosure wwn, with the listings in slow taking longer than --timeout
+    def collect(self, *slow):
+        commands = benchmark.enclosureinfo_fixture(2, slots=4)
+        for key in slow:
+            commands[key]['delay'] = 1
+        with open(os.path.join(self.dir, 'commands.json'), 'w') as fh:
+            json.dump(commands, fh)
+        args = enclosureinfo.build_parser().parse_args(['--replay', self.dir, '--timeout', '0.1', '--snapshots', ''])
+        registry = enclosureinfo.collect(args)
+        return { labels.get('enclosure_wwn'): value for labels, value in registry.families['enclosure_status'].samples }, registry
+
+    def test_all_answered(self):
+        status, registry = self.collect()
+        self.assertEqual(status, { '500C0FF000000000': 0, '500C0FF000000001': 0 })
+        self.assertNotIn('enclosure_scrape_timeout', registry.families)
+
+    def test_timed_out_fans_are_not_ok(self):
+        status, registry = self.collect('secli list fans -outputformat=json -enc=500C0FF000000000')
+        self.assertEqual(status, { '500C0FF000000000': 1, '500C0FF000000001': 0 })
+        timeouts = [ (labels.get('enclosure_wwn'), labels.get('component')) for labels, _ in registry.families['enclosure_scrape_timeout'].samples ]
+        self.assertEqual(timeouts, [ ('500C0FF000000000', 'fan') ])
+        # the fans that did answer are still there
+        fans = set(labels.get('enclosure_wwn') for labels, _ in registry.families['enclosure_fan_status'].samples)
+        self.assertEqual(fans, { '500C0FF000000001' })
+
+
+if __name__ == '__main__':
+    unittest.main()
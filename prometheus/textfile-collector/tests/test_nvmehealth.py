@@ -0,0 +1,142 @@
+# Native NVMe health reading (nvmehealth.py) against fake log pages and a fake sysfs, and what smartinfo.py
+# makes of it.  Run from the textfile-collector directory:  python3 -m unittest discover tests
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import smartinfo
+from nvmehealth import FAILSTATUS, FileBackend, NvmeReader, NvmeUnavailable, pack_smart_log
+
+
+class NvmeFixture(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test-nvmehealth-')
+        self.logs = os.path.join(self.dir, 'nvme')
+        self.sysfs = os.path.join(self.dir, 'sys')
+        os.makedirs(self.logs)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # a controller with its sysfs attributes, namespaces and log page
+    def controller(self, name, namespaces=(1,), attrs=None, **log):
+        ctrl = os.path.join(self.sysfs, 'class', 'nvme', name)
+        os.makedirs(ctrl)
+        for ns in namespaces:
+            os.makedirs(os.path.join(ctrl, '{}n{}'.format(name, ns)))
+        if attrs is None:
+            attrs = { 'serial': 'S4ABC{}'.format(name), 'model': 'Dell Express Flash NVMe P4610', 'firmware_rev': 'VDV1DP23' }
+        for attr, value in attrs.items():
+            with open(os.path.join(ctrl, attr), 'w') as fh:
+                fh.write(value + '\n')
+        with open(os.path.join(self.logs, name + '.smart-log'), 'wb') as fh:
+            fh.write(pack_smart_log(**log))
+
+    def reader(self):
+        return NvmeReader(FileBackend(self.logs), self.sysfs)
+
+
+class ReaderTest(NvmeFixture):
+    def test_log_page_values(self):
+        self.controller('nvme0', temperature=41, available_spare=97, available_spare_threshold=10,
+            percentage_used=3, media_errors=2**64 + 5, num_err_log_entries=12)
+        info = self.reader().read('/dev/nvme0')
+
+        log = info['nvme_smart_health_information_log']
+        self.assertEqual(log['critical_warning'], 0)
+        self.assertEqual(log['temperature'], 41)
+        self.assertEqual(log['available_spare'], 97)
+        self.assertEqual(log['available_spare_threshold'], 10)
+        self.assertEqual(log['percentage_used'], 3)
+        # 128 bit counters
+        self.assertEqual(log['media_errors'], 2**64 + 5)
+        self.assertEqual(log['num_err_log_entries'], 12)
+
+        self.assertEqual(info['smartctl']['exit_status'], 0)
+        self.assertEqual(info['temperature']['current'], 41)
+        self.assertEqual(info['serial_number'], 'S4ABCnvme0')
+        self.assertEqual(info['model_name'], 'Dell Express Flash NVMe P4610')
+        self.assertEqual(info['firmware_version'], 'VDV1DP23')
+        self.assertEqual(info['device']['name'], '/dev/nvme0')
+
+    def test_critical_warning_fails_health(self):
+        self.controller('nvme0', critical_warning=0x04)
+        self.assertEqual(self.reader().read('/dev/nvme0')['smartctl']['exit_status'], FAILSTATUS)
+
+    def test_namespaces(self):
+        # nvme0c0n1 is how native multipath names the path of a namespace, it is the same namespace 1
+        self.controller('nvme0', namespaces=(2, 1, 10))
+        os.makedirs(os.path.join(self.sysfs, 'class', 'nvme', 'nvme0', 'nvme0c0n1'))
+        self.assertEqual(self.reader().read('/dev/nvme0')['nvme_namespaces'], [ { 'id': 1 }, { 'id': 2 }, { 'id': 10 } ])
+
+    def test_missing_sysfs_attribute(self):
+        self.controller('nvme0', attrs={ 'serial': 'S4ABC', 'model': 'P4610' })
+        with self.assertRaises(NvmeUnavailable):
+            self.reader().read('/dev/nvme0')
+
+    def test_no_namespaces(self):
+        self.controller('nvme0', namespaces=())
+        with self.assertRaises(NvmeUnavailable):
+            self.reader().read('/dev/nvme0')
+
+    def test_short_log_page(self):
+        self.controller('nvme0')
+        with open(os.path.join(self.logs, 'nvme0.smart-log'), 'wb') as fh:
+            fh.write(b'\0' * 100)
+        with self.assertRaises(NvmeUnavailable):
+            self.reader().read('/dev/nvme0')
+
+
+# smartinfo.py --replay with the log pages in DIR/nvme and the sysfs in DIR/sys
+class SmartinfoTest(NvmeFixture):
+    def collect(self, commands):
+        with open(os.path.join(self.dir, 'commands.json'), 'w') as fh:
+            json.dump(commands, fh)
+        args = smartinfo.build_parser().parse_args(['--replay', self.dir, '--topology-cache', '', '--full-cache',
+            os.path.join(self.dir, 'full.json'), '--history', '', '--megaraid-cache', '', '--snapshots', ''])
+        registry = smartinfo.collect(args)
+        return { name: { tuple(sorted(labels.pairs)): value for labels, value in fam.samples } for name, fam in registry.families.items() }
+
+    def scan(self, *names):
+        devices = [ { 'name': '/dev/' + name, 'type': 'nvme' } for name in names ]
+        return { 'smartctl --json --scan-open': { 'rc': 0, 'stdout': json.dumps({ 'devices': devices }) } }
+
+    def test_series_per_namespace(self):
+        self.controller('nvme0', namespaces=(1, 2), temperature=38, available_spare=95, media_errors=7)
+        series = self.collect(self.scan('nvme0'))
+
+        for device in ('nvme0n1', 'nvme0n2'):
+            self.assertEqual(series['smart_disk_temperature_celsius'][(('device', device),)], 38)
+            self.assertEqual(series['smart_disk_lifetime_percent'][(('device', device),)], 95)
+            self.assertEqual(series['smart_disk_status'][(('device', device),)], 0)
+            self.assertEqual(series['smart_disk_attr_total'][(('device', device), ('name', 'uncorrectable_error_cnt'))], 7)
+            info = (('device', device), ('firmware', 'VDV1DP23'), ('model', 'Dell Express Flash NVMe P4610'), ('serial', 'S4ABCnvme0'))
+            self.assertEqual(series['smart_disk_info'][info], 1)
+        self.assertEqual(len(series['smart_disk_info']), 2)
+
+    # a controller the reader can't make sense of goes to smartctl, the others are still read natively
+    def test_missing_attribute_falls_back_to_smartctl(self):
+        self.controller('nvme0', temperature=38)
+        self.controller('nvme1', attrs={ 'serial': 'S4ABCnvme1' }, temperature=38)
+        smartctl = { 'smartctl': { 'exit_status': 0 }, 'serial_number': 'S4ABCnvme1', 'model_name': 'P4610',
+            'firmware_version': 'VDV1DP23', 'device': { 'name': '/dev/nvme1', 'info_name': '/dev/nvme1' },
+            'temperature': { 'current': 52 }, 'nvme_namespaces': [ { 'id': 1 } ],
+            'nvme_smart_health_information_log': { 'critical_warning': 0, 'available_spare': 100,
+                'available_spare_threshold': 10, 'percentage_used': 0, 'media_errors': 0 } }
+        commands = self.scan('nvme0', 'nvme1')
+        for query in ('--all', '--info --health --attributes'):
+            commands['smartctl --json {} /dev/nvme1 -d nvme'.format(query)] = { 'rc': 0, 'stdout': json.dumps(smartctl) }
+        series = self.collect(commands)
+
+        self.assertEqual(series['smart_disk_temperature_celsius'][(('device', 'nvme0n1'),)], 38)
+        self.assertEqual(series['smart_disk_temperature_celsius'][(('device', 'nvme1n1'),)], 52)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+# remotepoll.py against replayed hosts (the benchmark.py fixtures) and a fake ssh that can't get anywhere.
+# Run from the textfile-collector directory:  python3 -m unittest discover tests
+
+import contextlib
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import remotepoll
+from exposition import Labels, Registry, parse
+
+# enclosureinfo first, so an unreachable host shows osdinfo being skipped after it
+poll_collectors = ['--collector', 'enclosureinfo', '--collector', 'osdinfo']
+
+# ssh that fails like it does for a host that is down
+fake_ssh = '''#!/bin/sh
+echo "ssh: connect to host $1 port 22: No route to host" >&2
+exit 255
+'''
+
+
+class RemotepollTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test-remotepoll-')
+        self.replay = os.path.join(self.dir, 'replay')
+        self.state = os.path.join(self.dir, 'state')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # replay directory of a host with the answers of the given collectors, osdinfo brings its sysfs
+    def host(self, name, *collectors):
+        path = os.path.join(self.replay, name)
+        commands = {}
+        for collector in collectors:
+            benchmark.write_fixture(path, collector, 2)
+            with open(os.path.join(path, 'commands.json')) as fh:
+                commands.update(json.load(fh))
+        with open(os.path.join(path, 'commands.json'), 'w') as fh:
+            json.dump(commands, fh)
+
+    # remotepoll.py output parsed back, and what it logged as errors
+    def poll(self, *argv):
+        out = io.StringIO()
+        argv = ['remotepoll.py', '--state-dir', self.state] + poll_collectors + list(argv)
+        with mock.patch.object(sys, 'argv', argv), contextlib.redirect_stdout(out):
+            # every collector run logs at debug level, so there is always something
+            with self.assertLogs('remotepoll', 'DEBUG') as logs:
+                remotepoll.main()
+        return parse(out.getvalue()), [ r.getMessage() for r in logs.records if r.levelno >= logging.ERROR ]
+
+    def up(self, registry):
+        return { (labels.get('host'), labels.get('collector')): value for labels, value in registry.families['remotepoll_up'].samples }
+
+    def hosts(self, registry, name):
+        return set(labels.get('host') for labels, _ in registry.families[name].samples)
+
+    def test_good_and_failing_collector(self):
+        self.host('head1', 'enclosureinfo', 'osdinfo')
+        # no secli answers for head2, osdinfo still runs there
+        self.host('head2', 'osdinfo')
+        registry, logs = self.poll('--replay', self.replay, '--host', 'head1', '--host', 'head2')
+
+        self.assertEqual(self.up(registry), { ('head1', 'enclosureinfo'): 1, ('head1', 'osdinfo'): 1,
+            ('head2', 'enclosureinfo'): 0, ('head2', 'osdinfo'): 1 })
+        self.assertEqual(self.hosts(registry, 'enclosure_slot_status'), { 'head1' })
+        self.assertEqual(self.hosts(registry, 'ceph_osd_device_info'), { 'head1', 'head2' })
+        # only head2 enclosureinfo logged anything
+        self.assertTrue(logs)
+        self.assertTrue(all(line.startswith('head2 enclosureinfo') for line in logs), logs)
+
+    def test_host_label_goes_first(self):
+        self.host('head1', 'enclosureinfo', 'osdinfo')
+        registry, logs = self.poll('--replay', self.replay, '--host', 'head1')
+        self.assertEqual(logs, [])
+        for name in ('ceph_osd_device_info', 'enclosure_slot_status', 'enclosure_fan_status'):
+            for labels, _ in registry.families[name].samples:
+                self.assertEqual(labels.pairs[0], ('host', 'head1'))
+
+    def test_unreachable_host(self):
+        bin = os.path.join(self.dir, 'bin')
+        os.makedirs(bin)
+        with open(os.path.join(bin, 'ssh'), 'w') as fh:
+            fh.write(fake_ssh)
+        os.chmod(os.path.join(bin, 'ssh'), 0o755)
+
+        with mock.patch.dict(os.environ, { 'PATH': bin + os.pathsep + os.environ.get('PATH', '') }):
+            registry, logs = self.poll('--host', 'down1')
+
+        self.assertEqual(self.up(registry), { ('down1', 'enclosureinfo'): 0, ('down1', 'osdinfo'): 0 })
+        # the first collector found out, osdinfo wasn't run at all
+        self.assertEqual(len(logs), 1, logs)
+        self.assertIn('No route to host', logs[0])
+        # nothing from the collectors, only remotepoll_* and the textfile_collector_* of the poll
+        self.assertEqual([ name for name in registry.families if not name.startswith(('remotepoll_', 'textfile_collector_')) ], [])
+
+
+class AddHostTest(unittest.TestCase):
+    def test_prefix_and_comments(self):
+        registry = Registry()
+        registry.family('smart_disk_status', 'Disk health').add(Labels(device='sda'), 0)
+        registry.comment('Bad JSON from secli')
+        output = Registry()
+        output.family('smart_disk_status', 'Disk health').add(Labels(host='head1', device='sdb'), 2)
+
+        remotepoll.add_host(output, 'head2', registry)
+        samples = [ (labels.pairs, value) for labels, value in output.families['smart_disk_status'].samples ]
+        self.assertEqual(samples, [ ((('host', 'head1'), ('device', 'sdb')), 2), ((('host', 'head2'), ('device', 'sda')), 0) ])
+        self.assertEqual(output.comments, ['head2: Bad JSON from secli'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+# runcollectors.py jobs running stand-in collector scripts.  Run from the textfile-collector directory:  python3 -m unittest discover tests
+
+import argparse
+import fcntl
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import runcollectors
+from runcollectors import Job
+
+# writes its output file like a collector with --output, after sleeping as long as the cluster argument says
+collector_script = '''import sys, time
+time.sleep(float(sys.argv[1]))
+with open(sys.argv[3], 'w') as fh:
+    fh.write('done\\n')
+'''
+
+# starts a child that would outlive it and hangs, the child pid goes in its output file
+hanging_script = '''import subprocess, sys, time
+child = subprocess.Popen(['sleep', '30'])
+with open(sys.argv[3], 'w') as fh:
+    fh.write('{}\\n'.format(child.pid))
+time.sleep(30)
+'''
+
+# says whether the smartinfo output was there when it started
+joining_script = '''import os, sys
+found = os.path.exists(os.path.join(sys.argv[5], 'smartinfo.py.prom'))
+with open(sys.argv[3], 'w') as fh:
+    fh.write('{}\\n'.format(found))
+'''
+
+
+class JobTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test-runcollectors-')
+        self.args = argparse.Namespace(scripts_dir=os.path.join(self.dir, 'scripts'), metrics_dir=os.path.join(self.dir, 'metrics'), cluster='0')
+        os.makedirs(self.args.scripts_dir)
+        os.makedirs(self.args.metrics_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def job(self, name, script=collector_script, interval=300, timeout=10):
+        with open(os.path.join(self.args.scripts_dir, name + '.py'), 'w') as fh:
+            fh.write(script)
+        return Job(name, interval, timeout, self.args)
+
+    def output(self, job):
+        try:
+            with open(job.output) as fh:
+                return fh.read().strip()
+        except OSError:
+            return None
+
+    def last_started(self, job, ago):
+        with open(job.lockfile, 'w') as fh:
+            fh.write('{}\n'.format(time.time() - ago))
+
+    def test_skipped_while_running(self):
+        job = self.job('smartinfo')
+        with open(job.lockfile, 'a+') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            with self.assertLogs('runcollectors', 'INFO') as logs:
+                self.assertFalse(job.run())
+        self.assertIn('previous run still going', logs.output[0])
+        self.assertIsNone(self.output(job))
+        # and runs once the other one let go
+        self.assertTrue(job.run())
+        self.assertEqual(self.output(job), 'done')
+
+    def test_interval_slack(self):
+        job = self.job('osdinfo', interval=100)
+        # cron a bit early, within the slack
+        self.last_started(job, 100 * (1 - runcollectors.slack) + 1)
+        self.assertTrue(job.run())
+        self.assertEqual(self.output(job), 'done')
+
+        os.remove(job.output)
+        self.last_started(job, 100 * (1 - runcollectors.slack) - 1)
+        self.assertFalse(job.run())
+        self.assertIsNone(self.output(job))
+        # --loop doesn't care
+        self.assertTrue(job.run(force=True))
+
+    def test_timeout_kills_the_session(self):
+        job = self.job('smartinfo', hanging_script, timeout=1)
+        start = time.monotonic()
+        with self.assertLogs('runcollectors', 'ERROR') as logs:
+            self.assertFalse(job.run())
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertIn('killed after', logs.output[0])
+
+        # the child went too, it is gone or a zombie waiting for init
+        child = int(self.output(job))
+        for _ in range(50):
+            try:
+                with open('/proc/{}/stat'.format(child)) as fh:
+                    state = fh.read().rsplit(')', 1)[1].split()[0]
+            except OSError:
+                break
+            if state == 'Z':
+                break
+            time.sleep(0.1)
+        else:
+            self.fail('child {} still running'.format(child))
+
+    def test_diskidentity_waits_for_its_inputs(self):
+        # smartinfo takes a while, diskidentity is started first
+        self.args.cluster = '0.5'
+        jobs = { 'smartinfo': self.job('smartinfo'), 'diskidentity': self.job('diskidentity', joining_script) }
+        jobs['diskidentity'].inputs = ('smartinfo', 'osdinfo')
+
+        threads = [ threading.Thread(target=job.cycle, args=(jobs,)) for job in reversed(list(jobs.values())) ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+        self.assertEqual(self.output(jobs['diskidentity']), 'True')
+
+    def test_input_failing_still_lets_it_run(self):
+        jobs = { 'smartinfo': self.job('smartinfo', 'import sys; sys.exit(2)'), 'diskidentity': self.job('diskidentity', joining_script) }
+        jobs['diskidentity'].inputs = ('smartinfo',)
+        with self.assertLogs('runcollectors', 'ERROR'):
+            threads = [ threading.Thread(target=job.cycle, args=(jobs,)) for job in jobs.values() ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(30)
+        self.assertEqual(self.output(jobs['diskidentity']), 'False')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# smarthistory.py rings and the values derived from them.  Run from the textfile-collector directory:  python3 -m unittest discover tests
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from smarthistory import History, days_remaining, increase, rate_per_day
+
+day = 86400
+
+
+class RingTest(unittest.TestCase):
+    def test_sample_on_change_or_interval(self):
+        history = History(interval=3600, samples=4)
+        history.update('Z1 reallocated_sector_count', 1000, 0)
+        # same value before the interval is up
+        history.update('Z1 reallocated_sector_count', 1600, 0)
+        # changed value
+        history.update('Z1 reallocated_sector_count', 1700, 2)
+        # second update of the same key in a run (nvme namespaces)
+        history.update('Z1 reallocated_sector_count', 1700, 3)
+        ring = history.update('Z1 reallocated_sector_count', 5300, 2)
+        self.assertEqual(ring, [ [1000, 0], [1700, 2], [5300, 2] ])
+
+    def test_keeps_newest_samples(self):
+        history = History(interval=3600, samples=3)
+        for hour in range(5):
+            ring = history.update('Z1 lifetime', hour * 3600, 100 - hour)
+        self.assertEqual(ring, [ [7200, 98], [10800, 97], [14400, 96] ])
+
+    def test_prune(self):
+        history = History(interval=3600, samples=2)
+        history.update('Z1 lifetime', 0, 100)
+        history.update('Z2 lifetime', 7000, 100)
+        history.prune(7300)
+        self.assertEqual(sorted(history.rings), [ 'Z2 lifetime' ])
+
+    def test_save_and_load(self):
+        dir = tempfile.mkdtemp(prefix='test-smarthistory-')
+        try:
+            path = os.path.join(dir, 'history.json')
+            history = History()
+            history.update('Z1 lifetime', 1000, 99)
+            history.save(path)
+            self.assertEqual(History.load(path).rings, { 'Z1 lifetime': [ [1000, 99] ] })
+            # a missing or broken file starts over
+            with open(path, 'w') as fh:
+                fh.write('{"Z1 life')
+            self.assertEqual(History.load(path).rings, {})
+            self.assertEqual(History.load(os.path.join(dir, 'missing')).rings, {})
+        finally:
+            shutil.rmtree(dir)
+
+
+class DerivedTest(unittest.TestCase):
+    def test_increase(self):
+        ring = [ [0, 1], [day, 3], [2 * day, 4], [2 * day + 3600, 10] ]
+        # from the sample at or before the window
+        self.assertEqual(increase(ring, 3600), 6)
+        self.assertEqual(increase(ring, day), 7)
+        self.assertEqual(increase(ring, day + 1800), 7)
+        # the oldest one if the ring is shorter than the window
+        self.assertEqual(increase(ring, 7 * day), 9)
+
+    def test_increase_counter_going_backwards(self):
+        self.assertEqual(increase([ [0, 5], [day, 2] ], day), 0)
+
+    def test_increase_flat(self):
+        self.assertEqual(increase([ [0, 7], [day, 7], [2 * day, 7] ], day), 0)
+
+    def test_rate_per_day(self):
+        self.assertEqual(rate_per_day([ [0, 0], [day / 2, 1], [2 * day, 8] ]), 4)
+        self.assertEqual(rate_per_day([ [0, 3], [day, 3] ]), 0)
+        # not enough of a span yet
+        self.assertIsNone(rate_per_day([ [0, 0], [600, 5] ]))
+
+    def test_days_remaining(self):
+        # one percent a day, 50 left
+        ring = [ [t * day, 60 - t] for t in range(11) ]
+        self.assertAlmostEqual(days_remaining(ring), 50)
+        # an odd sample in the middle of the ring doesn't tilt the fit, only the newest value counts down
+        ring[5][1] = 45
+        self.assertAlmostEqual(days_remaining(ring), 50)
+
+    def test_days_remaining_flat_or_rising(self):
+        self.assertIsNone(days_remaining([ [t * day, 80] for t in range(5) ]))
+        self.assertIsNone(days_remaining([ [t * day, 80 + t] for t in range(5) ]))
+
+    def test_days_remaining_short_span(self):
+        self.assertIsNone(days_remaining([ [0, 80], [3600, 79] ]))
+
+
+class TooFewSamplesTest(unittest.TestCase):
+    def test_none(self):
+        for ring in ([], [ [0, 5] ]):
+            self.assertIsNone(increase(ring, day))
+            self.assertIsNone(rate_per_day(ring))
+            self.assertIsNone(days_remaining(ring))
+
+
+if __name__ == '__main__':
+    unittest.main()
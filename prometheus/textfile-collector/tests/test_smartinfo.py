@@ -0,0 +1,132 @@
+# smartinfo.py against replayed smartctl output.  Run from the textfile-collector directory:  python3 -m unittest discover tests
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import smartinfo
+from collectorlib import CommandRunner, ReplayTransport, RunStats
+
+disk = { 'name': '/dev/sdb', 'type': 'sat' }
+health_query = 'smartctl --json --info --health --attributes /dev/sdb -d sat'
+
+
+class ReplayFixture(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test-smartinfo-')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def runner(self, commands):
+        with open(os.path.join(self.dir, 'commands.json'), 'w') as fh:
+            json.dump(commands, fh)
+        return CommandRunner(transport=ReplayTransport(self.dir))
+
+
+# the fast query between full ones, with the logs and exit status bits of the last full query merged in
+class TieredTest(ReplayFixture):
+    def cached(self):
+        return { 'serial': 'Z1', 'time': time.time() - 60, 'bits': 2**6, 'data': { 'scsi_error_counter_log': { 'read': {} } } }
+
+    def health(self, exit_status, **sminfo):
+        sminfo['smartctl'] = { 'exit_status': exit_status, 'messages': [ { 'string': 'failed', 'severity': 'error' } ] }
+        return { health_query: { 'rc': exit_status, 'stdout': json.dumps(sminfo) } }
+
+    def test_cached_bits_merged(self):
+        runner = self.runner(self.health(0, serial_number='Z1'))
+        sminfo, full = smartinfo.fetch_tiered(runner, disk, self.cached(), 3600)
+        self.assertIsNone(full)
+        self.assertEqual(sminfo['smartctl']['exit_status'], 2**6)
+        self.assertIn('scsi_error_counter_log', sminfo)
+
+    def test_failed_fast_query_kept_as_it_is(self):
+        runner = self.runner(self.health(1))
+        sminfo, full = smartinfo.fetch_tiered(runner, disk, self.cached(), 3600)
+        self.assertIsNone(full)
+        self.assertEqual(sminfo['smartctl']['exit_status'], 1)
+        self.assertNotIn('scsi_error_counter_log', sminfo)
+
+        result = smartinfo.probe_disk(runner, disk, cached=self.cached(), full_interval=3600)
+        self.assertEqual(result['error'], [ { 'string': 'failed', 'severity': 'error' } ])
+
+
+# the device scan cached in --topology-cache against the benchmark.py fixture with a sysfs that can change under it
+class TopologyTest(ReplayFixture):
+    def setUp(self):
+        super().setUp()
+        self.replay = os.path.join(self.dir, 'replay')
+        self.sysfs = os.path.join(self.replay, 'sys')
+        self.cache = os.path.join(self.dir, 'topology.json')
+        benchmark.write_fixture(self.replay, 'smartinfo', 3)
+        for name in ('nvme0n1', 'sdb', 'sdc'):
+            benchmark.add_block(self.sysfs, name)
+
+    # number of device scans a run did
+    def scans(self, *argv):
+        argv = benchmark.replay_argv('smartinfo', self.replay, self.dir, argparse.Namespace(smartctl_nvme=False)) + list(argv)
+        stats = RunStats('smartinfo')
+        registry = smartinfo.collect(smartinfo.build_parser().parse_args(argv), stats)
+        self.assertEqual(len(registry.families['smart_disk_status'].samples), 3)
+        return stats.exits.get(('list', '0'), 0)
+
+    def test_reused_while_sysfs_is_the_same(self):
+        self.assertEqual(self.scans(), 1)
+        self.assertEqual(self.scans(), 0)
+        topo = smartinfo.load_topology(self.cache, smartinfo.topology_fingerprint(self.sysfs), 86400)
+        self.assertEqual(len(topo['devices']), 3)
+        self.assertEqual(sorted(probe['serial'] for probe in topo['probes'].values()), ['SN000000', 'SN000001', 'SN000002'])
+
+    def test_rescan_after_disk_added_or_removed(self):
+        self.assertEqual(self.scans(), 1)
+        benchmark.add_block(self.sysfs, 'sdd')
+        self.assertEqual(self.scans(), 1)
+        self.assertEqual(self.scans(), 0)
+        shutil.rmtree(os.path.join(self.sysfs, 'block', 'sdc'))
+        self.assertEqual(self.scans(), 1)
+
+    def test_rescan_when_too_old(self):
+        self.assertEqual(self.scans('--topology-max-age', '60'), 1)
+        self.assertEqual(self.scans('--topology-max-age', '60'), 0)
+        with open(self.cache) as fh:
+            topo = json.load(fh)
+        topo['scanned'] -= 120
+        with open(self.cache, 'w') as fh:
+            json.dump(topo, fh)
+        self.assertEqual(self.scans('--topology-max-age', '60'), 1)
+
+    def test_fingerprint(self):
+        self.assertIsNone(smartinfo.topology_fingerprint(None))
+        fingerprint = smartinfo.topology_fingerprint(self.sysfs)
+        self.assertEqual(smartinfo.topology_fingerprint(self.sysfs), fingerprint)
+        # another disk behind the same name comes with another dev number
+        with open(os.path.join(self.sysfs, 'block', 'sdb', 'dev'), 'w') as fh:
+            fh.write('8:16\n')
+        self.assertNotEqual(smartinfo.topology_fingerprint(self.sysfs), fingerprint)
+
+    def test_no_usable_cache(self):
+        fingerprint = smartinfo.topology_fingerprint(self.sysfs)
+        self.assertIsNone(smartinfo.load_topology(self.cache, fingerprint, 86400))
+        with open(self.cache, 'w') as fh:
+            fh.write('{"fingerprint": ')
+        self.assertIsNone(smartinfo.load_topology(self.cache, fingerprint, 86400))
+        # nothing to compare against
+        os.remove(self.cache)
+        smartinfo.save_topology(self.cache, { 'fingerprint': None, 'scanned': time.time(), 'devices': [], 'probes': {} })
+        self.assertFalse(os.path.exists(self.cache))
+        smartinfo.save_topology(self.cache, { 'fingerprint': fingerprint, 'scanned': time.time(), 'devices': [], 'probes': {} })
+        self.assertIsNone(smartinfo.load_topology(self.cache, None, 86400))
+        self.assertIsNone(smartinfo.load_topology('', fingerprint, 86400))
+        self.assertIsNotNone(smartinfo.load_topology(self.cache, fingerprint, 86400))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# snapshotstore.py files written and read back.  Run from the textfile-collector directory:  python3 -m unittest discover tests
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import snapshotstore
+from exposition import Registry
+from snapshotstore import SnapshotStore, magic
+
+
+class StoreFixture(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test-snapshotstore-')
+        self.path = os.path.join(self.dir, 'smartinfo-snapshots.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # a run of a collector that found rows, as record() does it
+    def collect(self, now, rows, keep=None):
+        store = SnapshotStore.load(self.path)
+        found = store.update(rows, now, keep)
+        store.save(self.path)
+        return found
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+
+class StoreTest(StoreFixture):
+    def test_unchanged_run_writes_nothing(self):
+        self.assertEqual(self.collect(100, { 'sda': 'Z1', 'sdb': 'Z2' }), [])
+        size = self.size()
+        self.assertEqual(self.collect(200, { 'sdb': 'Z2', 'sda': 'Z1' }), [])
+        self.assertEqual(self.size(), size)
+        self.assertEqual(len(SnapshotStore.load(self.path).records), 1)
+
+    def test_changes(self):
+        self.collect(100, { 'sda': 'Z1', 'sdb': 'Z2', 'sdc': 'Z3', 'slot 1': '' })
+        found = self.collect(200, { 'sda': 'Z1', 'sdb': 'Z9', 'slot 1': '5000c500a1b2c3d4', 'sdd': 'Z4' })
+        self.assertEqual(sorted(found), [
+            ('sdb', 'Z2', 'Z9', 'replaced'),
+            ('sdc', 'Z3', '', 'removed'),
+            ('sdd', '', 'Z4', 'added'),
+            ('slot 1', '', '5000c500a1b2c3d4', 'added'),
+        ])
+        found = self.collect(300, { 'sda': 'Z1', 'sdb': 'Z9', 'slot 1': '', 'sdd': 'Z4' })
+        self.assertEqual(found, [ ('slot 1', '5000c500a1b2c3d4', '', 'removed') ])
+
+    def test_keep(self):
+        self.collect(100, { 'sda': 'Z1', 'sdb': 'Z2' })
+        # sdb timed out
+        self.assertEqual(self.collect(200, { 'sda': 'Z1' }, keep=lambda key: key == 'sdb'), [])
+        self.assertEqual(SnapshotStore.load(self.path).rows_at(), { 'sda': 'Z1', 'sdb': 'Z2' })
+        # and answered again with the same disk
+        self.assertEqual(self.collect(300, { 'sda': 'Z1', 'sdb': 'Z2' }), [])
+        # a timeout of sda doesn't keep sdb
+        self.assertEqual(self.collect(400, {}, keep=lambda key: key == 'sda'), [ ('sdb', 'Z2', '', 'removed') ])
+        self.assertEqual(SnapshotStore.load(self.path).rows_at(), { 'sda': 'Z1' })
+
+    def test_history_and_rows_at(self):
+        self.collect(100, { 'sda': 'Z1', 'sdb': 'Z2' })
+        self.collect(200, { 'sda': 'Z1', 'sdb': 'Z3' })
+        self.collect(300, { 'sda': 'Z1', 'sdb': 'Z3', 'sdc': 'Z4' })
+        self.collect(400, { 'sdb': 'Z3', 'sdc': 'Z4' })
+
+        store = SnapshotStore.load(self.path)
+        self.assertEqual(store.history(), [
+            (200, 'sdb', 'Z2', 'Z3', 'replaced'),
+            (300, 'sdc', '', 'Z4', 'added'),
+            (400, 'sda', 'Z1', '', 'removed'),
+        ])
+        self.assertEqual(store.rows_at(50), {})
+        self.assertEqual(store.rows_at(100), { 'sda': 'Z1', 'sdb': 'Z2' })
+        self.assertEqual(store.rows_at(250), { 'sda': 'Z1', 'sdb': 'Z3' })
+        self.assertEqual(store.rows_at(), { 'sdb': 'Z3', 'sdc': 'Z4' })
+
+    def test_torn_tail(self):
+        self.collect(100, { 'sda': 'Z1' })
+        self.collect(200, { 'sda': 'Z2' })
+        size = self.size()
+        self.collect(300, { 'sda': 'Z3', 'sdb': 'Z4' })
+        # crash in the middle of the last append
+        with open(self.path, 'r+b') as fh:
+            fh.truncate(self.size() - 3)
+
+        store = SnapshotStore.load(self.path)
+        self.assertEqual(store.size, size)
+        self.assertEqual(store.rows_at(), { 'sda': 'Z2' })
+        self.assertEqual([ change[:4] for change in store.history() ], [ (200, 'sda', 'Z1', 'Z2') ])
+
+        # the next append goes where the torn record started, with the strings it took along
+        self.assertEqual(sorted(self.collect(400, { 'sda': 'Z3', 'sdb': 'Z4' })), [ ('sda', 'Z2', 'Z3', 'replaced'), ('sdb', '', 'Z4', 'added') ])
+        store = SnapshotStore.load(self.path)
+        self.assertEqual(store.size, self.size())
+        self.assertEqual(store.rows_at(), { 'sda': 'Z3', 'sdb': 'Z4' })
+        self.assertEqual(len(store.records), 3)
+
+    def test_not_a_store(self):
+        with open(self.path, 'wb') as fh:
+            fh.write(b'something else entirely')
+        self.assertEqual(SnapshotStore.load(self.path).rows_at(), {})
+        self.collect(100, { 'sda': 'Z1' })
+        with open(self.path, 'rb') as fh:
+            self.assertTrue(fh.read().startswith(magic))
+        self.assertEqual(SnapshotStore.load(self.path).rows_at(), { 'sda': 'Z1' })
+
+
+class RecordTest(StoreFixture):
+    def counts(self, registry):
+        return { labels.get('change'): value for labels, value in registry.families['storage_disk_changed_total'].samples }
+
+    def test_counts(self):
+        args = argparse.Namespace(snapshots=self.path)
+        snapshotstore.record(args, Registry(), 'smartinfo', { 'sda': 'Z1', 'sdb': 'Z2' }, now=100)
+        snapshotstore.record(args, Registry(), 'smartinfo', { 'sda': 'Z9', 'sdb': 'Z2' }, now=200)
+        registry = Registry()
+        snapshotstore.record(args, registry, 'smartinfo', { 'sda': 'Z9', 'sdc': 'Z3' }, now=300)
+        self.assertEqual(self.counts(registry), { 'added': 1, 'removed': 1, 'replaced': 1 })
+        self.assertEqual(set(labels.get('collector') for labels, _ in registry.families['storage_disk_changed_total'].samples), { 'smartinfo' })
+
+    def test_without_snapshots(self):
+        registry = Registry()
+        self.assertIsNone(snapshotstore.record(argparse.Namespace(snapshots=''), registry, 'smartinfo', { 'sda': 'Z1' }))
+        self.assertNotIn('storage_disk_changed_total', registry.families)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,477 @@
+# Small PromQL parser for the offline query tools (querycost.py)
+#
+# Enough of the language for what our rules files and dashboards use: selectors with matchers, range
+# selectors and subqueries, offset, function calls, aggregations with by/without before or after the
+# arguments, binary operators with bool, on/ignoring and group_left/group_right.  Grafana variables
+# ($host, ${host}, [[host]]) are kept as they are, in label values and durations they stay part of the
+# string, anywhere else they are a Variable node.
+#
+# Every node keeps the span of its source text (start, end) so an expression can be rewritten in place.
+
+import re
+
+class ParseError(Exception):
+    pass
+
+aggregations = { 'sum', 'min', 'max', 'avg', 'group', 'stddev', 'stdvar', 'count', 'count_values',
+    'bottomk', 'topk', 'quantile' }
+
+# functions taking a range vector, the ones that make an aggregation over time out of a range selector
+range_functions = { 'rate', 'irate', 'increase', 'delta', 'idelta', 'deriv', 'changes', 'resets',
+    'predict_linear', 'holt_winters', 'avg_over_time', 'min_over_time', 'max_over_time', 'sum_over_time',
+    'count_over_time', 'quantile_over_time', 'stddev_over_time', 'stdvar_over_time', 'last_over_time',
+    'present_over_time', 'absent_over_time' }
+
+# binary operators by precedence, lowest first, ^ is right associative
+precedence = [
+    ('or',),
+    ('and', 'unless'),
+    ('==', '!=', '<=', '<', '>=', '>'),
+    ('+', '-'),
+    ('*', '/', '%', 'atan2'),
+    ('^',),
+]
+comparisons = set(precedence[2])
+set_operators = set(precedence[0] + precedence[1])
+
+duration_re = re.compile(r'^(\d+(ms|[smhdwy]))+$')
+duration_part_re = re.compile(r'(\d+)(ms|[smhdwy])')
+units = { 'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800, 'y': 31536000 }
+
+# seconds of a duration like 1h30m, None if it isn't one (a grafana variable)
+def seconds(duration):
+    if not duration or not duration_re.match(duration):
+        return None
+    return sum(int(n) * units[unit] for n, unit in duration_part_re.findall(duration))
+
+# shortest way to write a number of seconds as a duration
+def duration(secs):
+    for unit in ('w', 'd', 'h', 'm', 's'):
+        if secs >= units[unit] and secs % units[unit] == 0:
+            return '{}{}'.format(int(secs // units[unit]), unit)
+    return '{}ms'.format(int(secs * 1000))
+
+variable_re = re.compile(r'\$\{?\w+\}?|\[\[\w+\]\]')
+
+def has_variable(text):
+    return bool(variable_re.search(text))
+
+token_re = re.compile(r'''
+    (?P<space>\s+|\#[^\n]*)
+  | (?P<number>0[xX][0-9a-fA-F]+|(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?(?![\w:])|[iI][nN][fF](?!\w)|[nN][aA][nN](?!\w))
+  | (?P<duration>(\d+(ms|[smhdwy]))+(?!\w))
+  | (?P<string>"(\\.|[^"\\])*"|'(\\.|[^'\\])*'|`[^`]*`)
+  | (?P<variable>\$\{\w+\}|\$\w+|\[\[\w+\]\])
+  | (?P<ident>[a-zA-Z_:][\w:]*)
+  | (?P<op>==|!=|<=|>=|=~|!~|[-+*/%^<>=(){}\[\],:@])
+''', re.VERBOSE)
+
+class Token:
+    def __init__(self, kind, text, start, end):
+        self.kind = kind
+        self.text = text
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return '{}({!r})'.format(self.kind, self.text)
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        m = token_re.match(text, pos)
+        if not m:
+            raise ParseError('unexpected {!r} at {}'.format(text[pos:pos + 10], pos))
+        if m.lastgroup != 'space':
+            tokens.append(Token(m.lastgroup, m.group(), m.start(), m.end()))
+        pos = m.end()
+    tokens.append(Token('end', '', len(text), len(text)))
+    return tokens
+
+def unquote(text):
+    if text[0] == '`':
+        return text[1:-1]
+    return re.sub(r'\\(.)', lambda m: { 'n': '\n', 't': '\t' }.get(m.group(1), m.group(1)), text[1:-1])
+
+def quote(value):
+    return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+
+class Node:
+    start = end = 0
+
+    def children(self):
+        return []
+
+    # this node and everything below it, parents first
+    def walk(self):
+        yield self
+        for child in self.children():
+            for node in child.walk():
+                yield node
+
+class Number(Node):
+    def __init__(self, value):
+        self.value = value
+
+class String(Node):
+    def __init__(self, value):
+        self.value = value
+
+class Variable(Node):
+    def __init__(self, name):
+        self.name = name
+
+class Matcher:
+    def __init__(self, label, op, value):
+        self.label = label
+        self.op = op
+        self.value = value
+
+    def __str__(self):
+        return '{}{}{}'.format(self.label, self.op, quote(self.value))
+
+class Selector(Node):
+    def __init__(self, name, matchers):
+        self.name = name
+        self.matchers = matchers
+        self.range = None
+        self.offset = None
+
+class Subquery(Node):
+    def __init__(self, expr, range, step):
+        self.expr = expr
+        self.range = range
+        self.step = step
+        self.offset = None
+
+    def children(self):
+        return [self.expr]
+
+class Call(Node):
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+
+    def children(self):
+        return self.args
+
+class Aggregation(Node):
+    def __init__(self, op, expr, param=None, grouping=None, without=False):
+        self.op = op
+        self.expr = expr
+        self.param = param
+        self.grouping = grouping
+        self.without = without
+
+    def children(self):
+        return [self.param, self.expr] if self.param else [self.expr]
+
+class Binary(Node):
+    def __init__(self, op, lhs, rhs):
+        self.op = op
+        self.lhs = lhs
+        self.rhs = rhs
+        self.bool = False
+        # on/ignoring labels, None without either
+        self.matching = None
+        self.ignoring = False
+        # 'left' or 'right' with the labels to copy over
+        self.group = None
+        self.include = []
+
+    def children(self):
+        return [self.lhs, self.rhs]
+
+class Unary(Node):
+    def __init__(self, op, expr):
+        self.op = op
+        self.expr = expr
+
+    def children(self):
+        return [self.expr]
+
+class Paren(Node):
+    def __init__(self, expr):
+        self.expr = expr
+
+    def children(self):
+        return [self.expr]
+
+
+class Parser:
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self, ahead=0):
+        return self.tokens[min(self.pos + ahead, len(self.tokens) - 1)]
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def keyword(self, token):
+        return token.text.lower() if token.kind == 'ident' else token.text
+
+    def expect(self, text):
+        token = self.next()
+        if self.keyword(token) != text:
+            raise ParseError('expected {!r} at {}, got {!r}'.format(text, token.start, token.text))
+        return token
+
+    def error(self, token):
+        raise ParseError('unexpected {!r} at {}'.format(token.text or 'end of expression', token.start))
+
+    def parse(self):
+        node = self.expr(0)
+        if self.peek().kind != 'end':
+            self.error(self.peek())
+        return node
+
+    def expr(self, level):
+        if level == len(precedence):
+            return self.unary()
+        lhs = self.expr(level + 1)
+        while self.keyword(self.peek()) in precedence[level] and self.peek().kind in ('op', 'ident'):
+            op = self.keyword(self.next())
+            node = Binary(op, lhs, None)
+            self.modifiers(node)
+            # ^ is right associative
+            node.rhs = self.expr(level if op == '^' else level + 1)
+            node.start, node.end = lhs.start, node.rhs.end
+            lhs = node
+        return lhs
+
+    # bool, on/ignoring, group_left/group_right after a binary operator
+    def modifiers(self, node):
+        if self.keyword(self.peek()) == 'bool':
+            self.next()
+            node.bool = True
+        if self.keyword(self.peek()) in ('on', 'ignoring'):
+            node.ignoring = self.keyword(self.next()) == 'ignoring'
+            node.matching = self.labels()
+        if self.keyword(self.peek()) in ('group_left', 'group_right'):
+            node.group = self.keyword(self.next())[len('group_'):]
+            if self.peek().text == '(':
+                node.include = self.labels()
+
+    def labels(self):
+        self.expect('(')
+        labels = []
+        while self.peek().text != ')':
+            token = self.next()
+            if token.kind != 'ident':
+                self.error(token)
+            labels.append(token.text)
+            if self.peek().text == ',':
+                self.next()
+        self.expect(')')
+        return labels
+
+    def unary(self):
+        if self.peek().text in ('-', '+'):
+            token = self.next()
+            expr = self.unary()
+            node = Unary(token.text, expr)
+            node.start, node.end = token.start, expr.end
+            return node
+        return self.postfix(self.primary())
+
+    # range, subquery and offset after a primary expression
+    def postfix(self, node):
+        while True:
+            token = self.peek()
+            if token.text == '[':
+                node = self.range(node)
+            elif self.keyword(token) == 'offset':
+                if not isinstance(node, (Selector, Subquery)):
+                    self.error(token)
+                self.next()
+                negative = self.peek().text == '-'
+                if negative:
+                    self.next()
+                value = self.next()
+                if value.kind not in ('duration', 'variable', 'number'):
+                    self.error(value)
+                node.offset = ('-' if negative else '') + value.text
+                node.end = value.end
+            elif token.text == '@':
+                # @ start() / @ end() / @ timestamp, doesn't matter for what we do with it
+                self.next()
+                value = self.next()
+                if value.kind == 'ident':
+                    self.expect('(')
+                    value = self.expect(')')
+                node.end = value.end
+            else:
+                return node
+
+    def range(self, node):
+        start = self.expect('[').end
+        # durations may be grafana variables, the source text up to ] split at :
+        # (the tokens don't help, :5m is a valid metric name)
+        while self.peek().text != ']':
+            if self.next().kind == 'end':
+                self.error(self.peek())
+        closing = self.next()
+        end = closing.end
+        parts = [ part.strip() for part in self.text[start:closing.start].split(':', 1) ]
+        if len(parts) == 1:
+            if not isinstance(node, Selector) or node.range is not None:
+                raise ParseError('range on something that is not a selector at {}'.format(node.start))
+            node.range = parts[0]
+            node.end = end
+            return node
+        sub = Subquery(node, parts[0], parts[1] or None)
+        sub.start, sub.end = node.start, end
+        return sub
+
+    def primary(self):
+        token = self.peek()
+        if token.kind == 'number':
+            self.next()
+            node = Number(float(token.text) if not token.text.lower().startswith('0x') else int(token.text, 16))
+        elif token.kind == 'duration':
+            # 5m written where a number is expected (predict_linear(x[1h], 4h)) is not PromQL, but a plain
+            # number like 3600 is lexed as number above, so this is an error
+            self.error(token)
+        elif token.kind == 'string':
+            self.next()
+            node = String(unquote(token.text))
+        elif token.kind == 'variable':
+            self.next()
+            node = Variable(token.text)
+        elif token.text == '(':
+            self.next()
+            expr = self.expr(0)
+            end = self.expect(')')
+            node = Paren(expr)
+            node.end = end.end
+        elif token.text == '{':
+            node = Selector(None, self.matchers())
+        elif token.kind == 'ident':
+            node = self.ident()
+        else:
+            self.error(token)
+        node.start = token.start
+        if not node.end:
+            node.end = self.tokens[self.pos - 1].end
+        return node
+
+    def ident(self):
+        token = self.next()
+        name = token.text
+        lower = name.lower()
+        following = self.peek()
+        if lower in aggregations and (following.text == '(' or self.keyword(following) in ('by', 'without')):
+            return self.aggregation(lower)
+        if following.text == '(':
+            self.next()
+            args = []
+            while self.peek().text != ')':
+                args.append(self.expr(0))
+                if self.peek().text == ',':
+                    self.next()
+                elif self.peek().text != ')':
+                    self.error(self.peek())
+            self.expect(')')
+            return Call(name, args)
+        matchers = self.matchers() if following.text == '{' else []
+        return Selector(name, matchers)
+
+    def aggregation(self, op):
+        grouping, without = None, False
+        if self.keyword(self.peek()) in ('by', 'without'):
+            without = self.keyword(self.next()) == 'without'
+            grouping = self.labels()
+        self.expect('(')
+        args = [self.expr(0)]
+        while self.peek().text == ',':
+            self.next()
+            args.append(self.expr(0))
+        end = self.expect(')')
+        # count(x) BY (instance) has the grouping after the arguments
+        if grouping is None and self.keyword(self.peek()) in ('by', 'without'):
+            without = self.keyword(self.next()) == 'without'
+            grouping = self.labels()
+            end = self.tokens[self.pos - 1]
+        node = Aggregation(op, args[-1], args[0] if len(args) > 1 else None, grouping, without)
+        node.end = end.end
+        return node
+
+    def matchers(self):
+        self.expect('{')
+        matchers = []
+        while self.peek().text != '}':
+            label = self.next()
+            if label.kind != 'ident':
+                self.error(label)
+            op = self.next()
+            if op.text not in ('=', '!=', '=~', '!~'):
+                self.error(op)
+            value = self.next()
+            if value.kind != 'string':
+                self.error(value)
+            matchers.append(Matcher(label.text, op.text, unquote(value.text)))
+            if self.peek().text == ',':
+                self.next()
+        self.expect('}')
+        return matchers
+
+def parse(text):
+    return Parser(text).parse()
+
+
+# PromQL text of a node, normalized: keywords lower case, by/without in front, double quotes
+def format(node):
+    if isinstance(node, Number):
+        value = node.value
+        return str(int(value)) if value == int(value) and abs(value) < 1e15 else repr(value)
+    if isinstance(node, String):
+        return quote(node.value)
+    if isinstance(node, Variable):
+        return node.name
+    if isinstance(node, Selector):
+        text = node.name or ''
+        if node.matchers or not node.name:
+            text += '{' + ', '.join(str(m) for m in node.matchers) + '}'
+        if node.range is not None:
+            text += '[{}]'.format(node.range)
+        if node.offset:
+            text += ' offset {}'.format(node.offset)
+        return text
+    if isinstance(node, Subquery):
+        text = '{}[{}:{}]'.format(format(node.expr), node.range, node.step or '')
+        if node.offset:
+            text += ' offset {}'.format(node.offset)
+        return text
+    if isinstance(node, Call):
+        return '{}({})'.format(node.func, ', '.join(format(a) for a in node.args))
+    if isinstance(node, Aggregation):
+        text = node.op
+        if node.grouping is not None:
+            text += ' {} ({})'.format('without' if node.without else 'by', ', '.join(node.grouping))
+        args = ([format(node.param)] if node.param else []) + [format(node.expr)]
+        return '{}({})'.format(text, ', '.join(args))
+    if isinstance(node, Binary):
+        text = '{} {}'.format(format(node.lhs), node.op)
+        if node.bool:
+            text += ' bool'
+        if node.matching is not None:
+            text += ' {}({})'.format('ignoring' if node.ignoring else 'on', ', '.join(node.matching))
+        if node.group:
+            text += ' group_{}({})'.format(node.group, ', '.join(node.include))
+        return '{} {}'.format(text, format(node.rhs))
+    if isinstance(node, Unary):
+        return node.op + format(node.expr)
+    if isinstance(node, Paren):
+        return '({})'.format(format(node.expr))
+    raise TypeError(node)
+
+# selectors of an expression
+def selectors(node):
+    return [ n for n in node.walk() if isinstance(n, Selector) ]
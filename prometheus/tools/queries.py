@@ -0,0 +1,166 @@
+# The PromQL queries in our rules files and Grafana dashboards, for the offline query tools (querycost.py)
+#
+# Rules files are read with PyYAML if it is installed.  Without it a small reader takes what the rules
+# format needs line by line: groups with name and interval, rules with alert or record, expr (also as a
+# | or > block) and for.  That is all our *.rules files use.
+#
+# Dashboards: every target with an expr in panels, rows and collapsed rows, hidden targets are left out
+# like Grafana does.  Template variables defined with query_result() run a query too, label_values()
+# is a series lookup and doesn't count.
+
+import glob
+import json
+import os
+import re
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+import promql
+
+class Query:
+    # kind is alert, record, panel or variable
+    # interval: seconds between evaluations, range: seconds covered by a dashboard range query (0 for instant)
+    def __init__(self, source, kind, name, expr, interval, range=0):
+        self.source = source
+        self.kind = kind
+        self.name = name
+        self.expr = expr
+        self.interval = interval
+        self.range = range
+        self.node = None
+        self.error = None
+        # the dashboard file contents and the target in it the expression is from, to write it back
+        self.dashboard = None
+        self.target = None
+
+    def __str__(self):
+        return '{}:{}'.format(os.path.basename(self.source), self.name)
+
+    def parse(self):
+        try:
+            self.node = promql.parse(self.expr)
+        except promql.ParseError as err:
+            self.error = str(err)
+        return self.node
+
+# expand directories to the files in them with one of the given extensions
+def expand(paths, extensions):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(f for f in glob.glob(os.path.join(path, '*')) if f.endswith(tuple(extensions))))
+        else:
+            files.append(path)
+    return files
+
+
+key_re = re.compile(r'^(\s*)(- )?(\w+):\s*(.*)$')
+
+def scalar(text):
+    text = text.strip()
+    if text[:1] in ('"', "'"):
+        quote = text[0]
+        end = text.rfind(quote)
+        text = text[1:end if end > 0 else None]
+        return text.replace("''", "'") if quote == "'" else json.loads('"{}"'.format(text))
+    # trailing comment
+    return re.sub(r'\s+#.*$', '', text)
+
+# groups with their rules from a rules file without PyYAML, same structure yaml.safe_load returns
+def read_rules_text(text):
+    groups = []
+    group = rule = None
+    lines = text.splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        m = key_re.match(line)
+        if not m or line.lstrip().startswith('#'):
+            continue
+        indent, item, key, value = len(m.group(1)), m.group(2), m.group(3), m.group(4)
+        # | and > blocks: the following lines indented deeper than the key
+        if value.strip()[:1] in ('|', '>'):
+            block = []
+            while i < len(lines) and (not lines[i].strip() or len(lines[i]) - len(lines[i].lstrip()) > indent):
+                block.append(lines[i].strip())
+                i += 1
+            value = ('\n' if value.strip()[0] == '|' else ' ').join(block).strip()
+        else:
+            value = scalar(value)
+
+        if key == 'name' and item:
+            group = { 'name': value, 'rules': [] }
+            groups.append(group)
+        elif key == 'interval' and group is not None and rule is None:
+            group['interval'] = value
+        elif key in ('alert', 'record') and item and group is not None:
+            rule = { key: value }
+            group['rules'].append(rule)
+        elif key in ('expr', 'for') and rule is not None:
+            rule[key] = value
+        if key == 'rules':
+            rule = None
+    return { 'groups': groups }
+
+def read_rules(path, interval=60):
+    with open(path) as fh:
+        text = fh.read()
+    data = yaml.safe_load(text) if yaml else read_rules_text(text)
+    queries = []
+    for group in (data or {}).get('groups') or []:
+        every = promql.seconds(str(group.get('interval', ''))) or interval
+        for rule in group.get('rules') or []:
+            kind = 'alert' if 'alert' in rule else 'record'
+            queries.append(Query(path, kind, rule.get(kind), str(rule.get('expr', '')).strip(), every))
+    return queries
+
+
+# now-6h -> 21600, anything that isn't relative to now counts as the default
+def time_range(dashboard, default=21600):
+    start = str((dashboard.get('time') or {}).get('from', ''))
+    if start.startswith('now-'):
+        return promql.seconds(start[4:].split('/')[0]) or default
+    return default
+
+def panels(container):
+    for panel in container.get('panels') or []:
+        yield panel
+        for inner in panels(panel):
+            yield inner
+    # old dashboards have rows with the panels in them
+    for row in container.get('rows') or []:
+        for inner in panels(row):
+            yield inner
+
+variable_query_re = re.compile(r'^\s*query_result\((.*)\)\s*$', re.S)
+
+def read_dashboard(path, interval=3600):
+    with open(path) as fh:
+        document = json.load(fh)
+    # the API wraps dashboards as { dashboard: ..., meta: ... }
+    dashboard = document.get('dashboard', document)
+    # no auto refresh counts as one load per interval
+    every = promql.seconds(str(dashboard.get('refresh') or '')) or interval
+    span = time_range(dashboard)
+    queries = []
+    for panel in panels(dashboard):
+        for n, target in enumerate(panel.get('targets') or []):
+            if target.get('expr') and not target.get('hide'):
+                name = '{} [{}]'.format(panel.get('title') or 'panel {}'.format(panel.get('id')), target.get('refId') or n)
+                # table and singlestat panels with instant set only ask for the last value
+                query = Query(path, 'panel', name, target['expr'].strip(), every, 0 if target.get('instant') else span)
+                query.dashboard, query.target = document, target
+                queries.append(query)
+
+    for variable in (dashboard.get('templating') or {}).get('list') or []:
+        query = variable.get('query')
+        if isinstance(query, dict):
+            query = query.get('query')
+        m = variable_query_re.match(query or '') if variable.get('type') == 'query' else None
+        if m:
+            queries.append(Query(path, 'variable', '${}'.format(variable.get('name')), m.group(1).strip(), every))
+    return queries
@@ -0,0 +1,748 @@
+#!/usr/bin/env python3
+#
+# Offline cost estimate of the PromQL in our alert rules and Grafana dashboards, and recording rules for
+# the most expensive parts of it
+#
+# Every rule and panel target is parsed (promql.py) and its series are worked out against a snapshot of the
+# series in Prometheus, without running anything on the server.  For each query that gives:
+#
+#   series   series read from the TSDB, the fan-out of its selectors
+#   samples  samples read per evaluation: a selector reads one sample per series, a range selector or a
+#            dashboard range query one per scrape interval of the range (and offset 1w reads week old blocks)
+#   output   series in the result, after aggregations and joins
+#   per hour samples times evaluations per hour: every group interval for rules, every dashboard refresh
+#            for each of --viewers for dashboards
+#
+# Aggregations, range functions and group_left joins inside the queries are candidates for recording rules.
+# Grafana variables in their matchers are moved out of the recorded expression if the label survives it
+# (added to the by() of an aggregation that can be aggregated again) so one rule serves every choice of the
+# variable, and an offset moves to the recorded series: count(x offset 1w) by (instance) reads one series per
+# instance a week back instead of every x.  Candidates are ranked by samples per hour saved over all queries
+# using them, minus what evaluating the rule costs.
+#
+# The snapshot is what Prometheus has now, either the text format from /federate or the JSON of /api/v1/series:
+#   curl -sG http://prometheus:9090/federate --data-urlencode 'match[]={__name__=~".+"}' > series.prom
+#   curl -sG http://prometheus:9090/api/v1/series --data-urlencode 'match[]={__name__=~".+"}' > series.json
+# or the .prom files of textfile collectors.  --scale copies every series with an instance label that many
+# times to see what the same queries cost with a bigger fleet.
+#
+# Example:  querycost.py --snapshot series.prom prometheus/alerts grafana/dashboards
+#           querycost.py --snapshot series.prom --var cluster=ceph --rules-out proposed.rules ...
+
+import argparse
+import copy
+import json
+import os
+import re
+import sys
+
+import promql
+from queries import expand, read_dashboard, read_rules
+
+# matchers with grafana variables nobody gave a value for match anything, as if 'All' was selected
+wildcard = object()
+
+
+class Snapshot:
+    def __init__(self):
+        # metric name -> list of label dictionaries with __name__
+        self.metrics = {}
+
+    def add(self, labels):
+        self.metrics.setdefault(labels['__name__'], []).append(labels)
+
+    def count(self):
+        return sum(len(series) for series in self.metrics.values())
+
+    def load(self, path):
+        with open(path) as fh:
+            text = fh.read()
+        if text.lstrip().startswith('{'):
+            for labels in json.loads(text).get('data') or []:
+                self.add(dict(labels))
+        else:
+            self.load_text(text)
+
+    def load_text(self, text):
+        seen = set()
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, _, rest = line.partition('{')
+            if rest:
+                labels = dict((n, promql.unquote(v)) for n, v in label_re.findall(rest.rpartition('}')[0]))
+            else:
+                name = line.split()[0]
+                labels = {}
+            labels['__name__'] = name.strip()
+            key = tuple(sorted(labels.items()))
+            if key not in seen:
+                seen.add(key)
+                self.add(labels)
+
+    # copies of every series with an instance label, instance gets #1, #2, ... added
+    def scale(self, factor):
+        for name, series in self.metrics.items():
+            copies = []
+            for labels in series:
+                if 'instance' in labels:
+                    copies.extend(dict(labels, instance='{}#{}'.format(labels['instance'], n)) for n in range(1, factor))
+            series.extend(copies)
+
+label_re = re.compile(r'([a-zA-Z_]\w*)\s*=\s*("(?:\\.|[^"\\])*")')
+
+
+# values for grafana variables and the times a query is evaluated at
+class Context:
+    def __init__(self, snapshot, scrape_interval=60, variables=None, range=0, step=60):
+        self.snapshot = snapshot
+        self.scrape_interval = scrape_interval
+        self.variables = variables or {}
+        self.range = range
+        self.step = step
+        # node -> Estimate of everything evaluated with this context
+        self.estimates = {}
+        self.regex_cache = {}
+
+    def at(self, range, step):
+        ctx = Context(self.snapshot, self.scrape_interval, self.variables, range, step)
+        ctx.estimates = self.estimates
+        ctx.regex_cache = self.regex_cache
+        return ctx
+
+    # grafana variables in a label value or duration, wildcard if one of them has no value
+    # $__interval and friends are worked out from the query like grafana does
+    def substitute(self, text):
+        builtin = {
+            '__interval': promql.duration(self.step),
+            '__rate_interval': promql.duration(max(self.step + self.scrape_interval, 4 * self.scrape_interval)),
+            '__range': promql.duration(max(self.range, 1)),
+        }
+        missing = []
+        def replace(m):
+            name = m.group().strip('${}[]')
+            if name in self.variables:
+                return self.variables[name]
+            if name in builtin:
+                return builtin[name]
+            missing.append(name)
+            return ''
+        text = promql.variable_re.sub(replace, text)
+        return wildcard if missing else text
+
+    def regex(self, pattern):
+        if pattern not in self.regex_cache:
+            try:
+                self.regex_cache[pattern] = re.compile('(?:{})$'.format(pattern))
+            except re.error:
+                self.regex_cache[pattern] = None
+        return self.regex_cache[pattern]
+
+    def matches(self, matcher, labels):
+        value = self.substitute(matcher.value)
+        if value is wildcard:
+            return True
+        actual = labels.get(matcher.label, '')
+        if matcher.op == '=':
+            return actual == value
+        if matcher.op == '!=':
+            return actual != value
+        regex = self.regex(value)
+        if regex is None:
+            return True
+        return bool(regex.match(actual)) == (matcher.op == '=~')
+
+    def select(self, selector):
+        if selector.name:
+            candidates = self.snapshot.metrics.get(selector.name, [])
+        else:
+            candidates = [ labels for series in self.snapshot.metrics.values() for labels in series ]
+        return [ labels for labels in candidates if all(self.matches(m, labels) for m in selector.matchers) ]
+
+    # seconds of a duration which may be a grafana variable
+    def seconds(self, duration, default=None):
+        value = self.substitute(duration or '')
+        if value is wildcard:
+            return default if default is not None else 4 * self.scrape_interval
+        return promql.seconds(value) or default or 0
+
+    # samples of one series read for a window of this many seconds, over the range of the query
+    def samples(self, window):
+        if not self.range:
+            return max(1, window / self.scrape_interval)
+        # windows of the steps overlap, everything from start - window to the end is read once
+        if window >= self.step:
+            return (self.range + window) / self.scrape_interval
+        return (self.range / self.step + 1) * max(1, window / self.scrape_interval)
+
+
+class Estimate:
+    # series: label dictionaries of the result, None for a scalar or string
+    def __init__(self, series=None, samples=0, touched=0, oldest=0):
+        self.series = series
+        self.samples = samples
+        self.touched = touched
+        # furthest back a selector reads, offset plus range
+        self.oldest = oldest
+
+    @property
+    def output(self):
+        return len(self.series) if self.series is not None else 0
+
+    def add_cost(self, other):
+        self.samples += other.samples
+        self.touched += other.touched
+        self.oldest = max(self.oldest, other.oldest)
+        return self
+
+def without_name(series):
+    return [ dict((k, v) for k, v in labels.items() if k != '__name__') for labels in series ]
+
+def distinct(series):
+    seen = {}
+    for labels in series:
+        seen.setdefault(tuple(sorted(labels.items())), labels)
+    return list(seen.values())
+
+def signature(labels, matching, ignoring):
+    if matching is not None and not ignoring:
+        return tuple(labels.get(name, '') for name in matching)
+    dropped = set(matching or ()) | { '__name__' }
+    return tuple(sorted((k, v) for k, v in labels.items() if k not in dropped))
+
+# estimate of node with series and cost of its subtree, also kept in ctx.estimates for every node below
+def estimate(node, ctx):
+    result = evaluate(node, ctx)
+    ctx.estimates[node] = result
+    return result
+
+def evaluate(node, ctx):
+    if isinstance(node, (promql.Number, promql.String, promql.Variable)):
+        return Estimate()
+
+    if isinstance(node, (promql.Paren, promql.Unary)):
+        inner = estimate(node.expr, ctx)
+        if isinstance(node, promql.Unary) and node.op == '-' and inner.series is not None:
+            return Estimate(without_name(inner.series)).add_cost(inner)
+        return Estimate(inner.series).add_cost(inner)
+
+    if isinstance(node, promql.Selector):
+        series = ctx.select(node)
+        window = ctx.seconds(node.range) if node.range is not None else 0
+        offset = ctx.seconds(node.offset, 0) if node.offset else 0
+        samples = len(series) * ctx.samples(window)
+        return Estimate(series, samples, len(series), offset + window + ctx.range)
+
+    if isinstance(node, promql.Subquery):
+        window = ctx.seconds(node.range)
+        step = ctx.seconds(node.step, ctx.step) if node.step else ctx.step
+        # the inner expression is a range query over the window of every outer step
+        inner = estimate(node.expr, ctx.at(window + ctx.range, step))
+        offset = ctx.seconds(node.offset, 0) if node.offset else 0
+        return Estimate(inner.series).add_cost(inner).add_cost(Estimate(oldest=inner.oldest + offset))
+
+    if isinstance(node, promql.Call):
+        return evaluate_call(node, ctx)
+    if isinstance(node, promql.Aggregation):
+        return evaluate_aggregation(node, ctx)
+    if isinstance(node, promql.Binary):
+        return evaluate_binary(node, ctx)
+    raise TypeError(node)
+
+# $1 or $name in the replacement of label_replace
+def group(match, name):
+    try:
+        return match.group(int(name) if name.isdigit() else name) or ''
+    except IndexError:
+        return ''
+
+def evaluate_call(node, ctx):
+    args = [ estimate(arg, ctx) for arg in node.args ]
+    cost = Estimate()
+    for arg in args:
+        cost.add_cost(arg)
+    vectors = [ arg.series for arg in args if arg.series is not None ]
+    func = node.func
+
+    # time(), scalar() and friends and the date functions without arguments are scalars
+    if func == 'scalar' or not vectors and func != 'vector' and func not in ('absent', 'absent_over_time'):
+        series = None
+    elif func == 'vector':
+        series = [{}]
+    elif func in ('absent', 'absent_over_time'):
+        series = [] if vectors and vectors[0] else [{}]
+    elif func == 'histogram_quantile':
+        series = distinct([ dict((k, v) for k, v in labels.items() if k != 'le') for labels in without_name(vectors[0]) ])
+    elif func == 'label_replace' and len(node.args) == 5 and all(isinstance(a, promql.String) for a in node.args[1:]):
+        dst, replacement, src, regex = [ a.value for a in node.args[1:] ]
+        pattern = ctx.regex(regex)
+        series = []
+        for labels in vectors[0]:
+            labels = dict(labels)
+            m = pattern.match(labels.get(src, '')) if pattern else None
+            if m:
+                value = re.sub(r'\$\{?(\w+)\}?', lambda g: group(m, g.group(1)), replacement)
+                if value:
+                    labels[dst] = value
+                else:
+                    labels.pop(dst, None)
+            series.append(labels)
+    elif func == 'label_join' and len(node.args) >= 3 and all(isinstance(a, promql.String) for a in node.args[1:]):
+        dst, separator = node.args[1].value, node.args[2].value
+        sources = [ a.value for a in node.args[3:] ]
+        series = [ dict(labels, **{ dst: separator.join(labels.get(s, '') for s in sources) }) for labels in vectors[0] ]
+    elif func in ('sort', 'sort_desc', 'last_over_time'):
+        series = vectors[0]
+    else:
+        series = without_name(vectors[0])
+    cost.series = series
+    return cost
+
+def evaluate_aggregation(node, ctx):
+    inner = estimate(node.expr, ctx)
+    if node.param is not None:
+        estimate(node.param, ctx)
+    series = inner.series or []
+
+    groups = {}
+    for labels in series:
+        if node.grouping is None:
+            key = ()
+        elif node.without:
+            key = tuple(sorted((k, v) for k, v in labels.items() if k not in node.grouping and k != '__name__'))
+        else:
+            key = tuple((name, labels.get(name, '')) for name in node.grouping)
+        groups.setdefault(key, []).append(labels)
+
+    if node.op in ('topk', 'bottomk'):
+        k = int(node.param.value) if isinstance(node.param, promql.Number) else None
+        out = [ labels for members in groups.values() for labels in (members[:k] if k is not None else members) ]
+    else:
+        out = [ dict((k, v) for k, v in key if v) for key in groups ]
+    return Estimate(out).add_cost(inner)
+
+def evaluate_binary(node, ctx):
+    lhs = estimate(node.lhs, ctx)
+    rhs = estimate(node.rhs, ctx)
+    result = Estimate().add_cost(lhs).add_cost(rhs)
+    keep_name = node.op in promql.comparisons and not node.bool
+
+    if lhs.series is None or rhs.series is None:
+        series = lhs.series if lhs.series is not None else rhs.series
+        if series is not None and not keep_name:
+            series = without_name(series)
+        result.series = series
+        return result
+
+    matching, ignoring = node.matching, node.ignoring
+    left = dict((signature(labels, matching, ignoring), labels) for labels in lhs.series)
+    right = dict((signature(labels, matching, ignoring), labels) for labels in rhs.series)
+
+    if node.op in promql.set_operators:
+        if node.op == 'and':
+            series = [ labels for labels in lhs.series if signature(labels, matching, ignoring) in right ]
+        elif node.op == 'unless':
+            series = [ labels for labels in lhs.series if signature(labels, matching, ignoring) not in right ]
+        else:
+            series = lhs.series + [ labels for labels in rhs.series if signature(labels, matching, ignoring) not in left ]
+        result.series = series
+        return result
+
+    if node.group:
+        many, one = (lhs.series, right) if node.group == 'left' else (rhs.series, left)
+        series = []
+        for labels in many:
+            match = one.get(signature(labels, matching, ignoring))
+            if match is None:
+                continue
+            labels = dict(labels) if keep_name else without_name([labels])[0]
+            for name in node.include:
+                if match.get(name):
+                    labels[name] = match[name]
+            series.append(labels)
+    else:
+        series = []
+        for sig, labels in left.items():
+            if sig not in right:
+                continue
+            if matching is not None and not ignoring:
+                labels = dict((name, labels[name]) for name in matching if labels.get(name))
+            elif not keep_name:
+                labels = without_name([labels])[0]
+            if ignoring:
+                labels = dict((k, v) for k, v in labels.items() if k not in matching)
+            series.append(labels)
+    result.series = series
+    return result
+
+
+# a query with its estimate
+class Cost:
+    def __init__(self, query, ctx, viewers=1):
+        self.query = query
+        self.ctx = ctx
+        self.estimate = estimate(query.node, ctx)
+        self.per_hour = 3600 / query.interval * (viewers if query.kind in ('panel', 'variable') else 1)
+
+    @property
+    def samples_per_hour(self):
+        return self.estimate.samples * self.per_hour
+
+def query_context(query, base, max_points=1000):
+    if query.range:
+        step = max(base.scrape_interval, query.range / max_points)
+        return base.at(query.range, step)
+    return base.at(0, base.step)
+
+
+# does the result of node still have label, coming from child
+def keeps(node, label, child):
+    if isinstance(node, promql.Aggregation):
+        if node.op in ('topk', 'bottomk') or child is node.param:
+            return True
+        if node.grouping is None:
+            return False
+        return label not in node.grouping if node.without else label in node.grouping
+    if isinstance(node, promql.Binary):
+        if node.op in promql.set_operators:
+            return True
+        if node.group:
+            if (node.group == 'left') == (child is node.lhs):
+                return not node.ignoring or label not in node.matching
+            return label in node.include or (node.matching is not None and not node.ignoring and label in node.matching)
+        if node.matching is None:
+            return True
+        return label not in node.matching if node.ignoring else label in node.matching
+    if isinstance(node, promql.Call):
+        return not (node.func == 'histogram_quantile' and label == 'le') and node.func not in ('scalar', 'vector', 'absent')
+    return True
+
+def parents(root):
+    found = {}
+    for node in root.walk():
+        for child in node.children():
+            found[child] = node
+    return found
+
+# aggregations which give the same result when run again over their own output
+reaggregate = { 'sum': 'sum', 'min': 'min', 'max': 'max', 'group': 'group', 'count': 'sum' }
+
+class Candidate:
+    def __init__(self, node, record, replacement, name):
+        self.node = node
+        # the expression to record and how the query reads it back
+        self.record = record
+        self.replacement = replacement
+        self.name = name
+
+def recordable(node):
+    if isinstance(node, promql.Aggregation):
+        return node.op not in ('topk', 'bottomk', 'count_values')
+    if isinstance(node, promql.Call):
+        return node.func in promql.range_functions and node.args and isinstance(node.args[0], promql.Selector)
+    if isinstance(node, promql.Binary):
+        return node.group is not None and bool(promql.selectors(node.lhs)) and bool(promql.selectors(node.rhs))
+    return False
+
+# the matcher m below the one side of a group_left/group_right join is also on the many side, so the result
+# has the label with the same value
+def joined_on_both_sides(join, m, child):
+    if not isinstance(join, promql.Binary) or not join.group or join.matching is None or join.ignoring:
+        return False
+    many = join.lhs if join.group == 'left' else join.rhs
+    if child is many:
+        return False
+    return any(str(x) == str(m) for s in promql.selectors(many) for x in s.matchers)
+
+# recording rule for node if it has one: grafana variables in matchers are lifted out, offsets move to the
+# recorded series, None if that's not possible
+def candidate(node, parent_of):
+    nodes = list(node.walk())
+    if any(isinstance(n, (promql.Variable, promql.Subquery)) for n in nodes):
+        return None
+    selectors = promql.selectors(node)
+    if any(s.range is not None and promql.seconds(s.range) is None for s in selectors):
+        return None
+    offsets = set(s.offset for s in selectors)
+    if len(offsets) != 1:
+        return None
+    offset = offsets.pop()
+    if offset and promql.seconds(offset) is None:
+        return None
+
+    # labels of matchers with variables have to get through to the result
+    lifted = []
+    added = []
+    # joins to match on the label as well: x{cluster="$cluster"} * on (ceph_daemon) group_left(hostname) (meta{cluster="$cluster"})
+    # is the same as x * on (ceph_daemon, cluster) group_left(hostname) (meta) with cluster="$cluster" afterwards
+    widened = {}
+    for s in selectors:
+        for m in s.matchers:
+            if not promql.has_variable(m.value):
+                continue
+            child, up = s, parent_of.get(s)
+            while child is not node:
+                if not keeps(up, m.label, child):
+                    if up is node and isinstance(node, promql.Aggregation) and not node.without and node.op in reaggregate:
+                        added.append(m.label)
+                        break
+                    if joined_on_both_sides(up, m, child):
+                        widened.setdefault(up, []).append(m.label)
+                        break
+                    return None
+                child, up = up, parent_of.get(up)
+            else:
+                lifted.append(m)
+
+    recorded = copy.deepcopy(node)
+    copies = dict(zip(node.walk(), recorded.walk()))
+    for s in promql.selectors(recorded):
+        s.matchers = [ m for m in s.matchers if not promql.has_variable(m.value) ]
+        s.offset = None
+    for join, labels in widened.items():
+        copies[join].matching = copies[join].matching + [ l for l in dict.fromkeys(labels) if l not in copies[join].matching ]
+    if added:
+        recorded.grouping = (recorded.grouping or []) + [ l for l in dict.fromkeys(added) if l not in (recorded.grouping or []) ]
+        lifted += [ m for s in selectors for m in s.matchers if m.label in added and promql.has_variable(m.value) ]
+    # the same by() in another order is the same record
+    if isinstance(recorded, promql.Aggregation) and not recorded.without and recorded.grouping:
+        recorded.grouping = sorted(recorded.grouping)
+
+    name = record_name(recorded)
+    # same label with different variables ($node:$port) can't be lifted into one matcher
+    matchers = []
+    for m in lifted:
+        if str(m) not in [ str(x) for x in matchers ]:
+            matchers.append(m)
+    read = promql.format(promql.Selector(name, matchers))
+    if offset:
+        read += ' offset {}'.format(offset)
+    if added:
+        grouping = ' by ({})'.format(', '.join(node.grouping)) if node.grouping else ''
+        read = '{}{}({})'.format(reaggregate[node.op], grouping, read)
+    return Candidate(node, promql.format(recorded), read, name)
+
+# operator names for record names, sum_plus_commit_latency_ms reads better than sum_+
+arithmetic = { '+': 'plus', '-': 'minus', '*': 'times', '/': 'per', '%': 'mod', '^': 'pow' }
+
+# what's left of other once the part it shares with metric is gone, ceph_osd_metadata next to ceph_bluefs_db_used_bytes
+# is osd_metadata
+def short_name(other, metric):
+    common = os.path.commonprefix([other, metric])
+    common = common[:common.rfind('_') + 1]
+    return other[len(common):] or other
+
+# level:metric:operations as in the prometheus naming conventions: the level is the labels of the outermost
+# aggregation or join and the operations are newest first
+# An aggregation below a join only drops labels the join doesn't want, the record is named after the join.
+def record_name(node):
+    operations = []
+    level = None
+    # the metric of the first selector, the left hand side of joins
+    metric = promql.selectors(node)[0].name or 'series'
+    joined = set(m for n in node.walk() if isinstance(n, promql.Binary) and n.group for m in n.walk() if m is not n)
+    # inner operations first
+    for n in reversed(list(node.walk())):
+        if isinstance(n, promql.Call) and n.func in promql.range_functions:
+            window = n.args[0].range if isinstance(n.args[0], promql.Selector) else ''
+            operations.append(n.func + (window or ''))
+        elif isinstance(n, promql.Aggregation) and n not in joined:
+            # sum of a rate is just the rate at a coarser level
+            if not (n.op == 'sum' and operations and operations[-1].startswith(('rate', 'irate', 'increase'))):
+                operations.append(n.op)
+            if not n.without:
+                level = '_'.join(n.grouping or []) or 'global'
+        elif isinstance(n, promql.Binary) and n.group:
+            # joins are named after the metric they take the labels from
+            one = n.rhs if n.group == 'left' else n.lhs
+            names = [ s.name for s in promql.selectors(one) if s.name ]
+            operations.append('join_' + short_name(names[0], metric) if names else 'join')
+            if n.matching and not n.ignoring:
+                level = '_'.join(n.matching)
+        elif isinstance(n, promql.Binary) and n.op in arithmetic:
+            # a + b isn't a, the other metric goes into the name
+            names = [ s.name for s in promql.selectors(n.rhs) if s.name and s.name != metric ]
+            if names:
+                operations.append('{}_{}'.format(arithmetic[n.op], short_name(names[0], metric)))
+    if any(op.startswith(('rate', 'irate', 'increase')) for op in operations) and metric.endswith('_total'):
+        metric = metric[:-len('_total')]
+    return '{}:{}:{}'.format(level or 'instance', metric.replace(':', '_'), '_'.join(reversed(operations)) or 'value')
+
+
+# candidate recording rules of all queries with the samples per hour they save
+class Proposal:
+    def __init__(self, candidate):
+        self.name = candidate.name
+        self.record = candidate.record
+        self.uses = []
+        self.saved = 0
+        self.cost = 0
+
+# candidates for recording rules in an expression, with outer only the outermost ones and nothing inside them
+def candidates(root, outer=False):
+    parent_of = parents(root)
+    found = []
+    inside = set()
+    for node in root.walk():
+        if node in inside or not recordable(node):
+            continue
+        c = candidate(node, parent_of)
+        if c is None:
+            continue
+        found.append(c)
+        if outer:
+            inside.update(node.walk())
+    return found
+
+# (owner, candidate) pairs with the same recorded expression as one Proposal each
+def group(uses):
+    proposals = {}
+    for owner, found in uses:
+        proposals.setdefault(found.record, Proposal(found)).uses.append((owner, found))
+
+    # names have to be unique, the same name for two expressions gets a number
+    names = {}
+    for proposal in sorted(proposals.values(), key=lambda p: p.record):
+        n = names[proposal.name] = names.get(proposal.name, 0) + 1
+        if n > 1:
+            old = proposal.name
+            proposal.name = '{}_{}'.format(proposal.name, n)
+            for owner, found in proposal.uses:
+                found.replacement = found.replacement.replace(old, proposal.name, 1)
+                found.name = proposal.name
+    return list(proposals.values())
+
+def propose(costs, base, interval=60):
+    proposals = group([ (cost, found) for cost in costs for found in candidates(cost.query.node) ])
+
+    for proposal in proposals:
+        # the rule itself is evaluated every interval, what it records is added to the snapshot to see what
+        # reading it back costs
+        recorded = estimate(promql.parse(proposal.record), base.at(0, interval))
+        proposal.cost = recorded.samples * 3600 / interval
+        snapshot = Snapshot()
+        for labels in recorded.series or []:
+            snapshot.add(dict(labels, __name__=proposal.name))
+        for cost, found in proposal.uses:
+            before = cost.ctx.estimates[found.node].samples
+            ctx = Context(snapshot, interval, base.variables, cost.ctx.range, max(cost.ctx.step, interval))
+            after = estimate(promql.parse(found.replacement), ctx).samples
+            proposal.saved += (before - after) * cost.per_hour
+        proposal.saved -= proposal.cost
+    return sorted((p for p in proposals if p.saved > 0), key=lambda p: -p.saved)
+
+# nested candidates are usually better off as one rule, of a candidate inside a better one only the better one stays
+def outermost(proposals, top):
+    chosen = []
+    for proposal in proposals:
+        nodes = set(found.node for _, found in proposal.uses)
+        if any(any(n in set(m for _, f in other.uses for m in f.node.walk()) for n in nodes) for other in chosen):
+            continue
+        chosen.append(proposal)
+        if len(chosen) == top:
+            break
+    return chosen
+
+
+def human(value):
+    for unit in ('', 'k', 'M', 'G', 'T'):
+        if abs(value) < 1000:
+            return '{:.0f}{}'.format(value, unit) if unit == '' else '{:.1f}{}'.format(value, unit)
+        value /= 1000
+    return '{:.1f}P'.format(value)
+
+def rules_text(proposals, interval):
+    lines = ['# recording rules proposed by querycost.py', '---', 'groups:', '- name: querycost.rules',
+        '  interval: {}'.format(promql.duration(interval)), '  rules:']
+    for p in proposals:
+        lines.append('  # saves about {} samples per hour, used by {} queries'.format(human(p.saved), len(p.uses)))
+        lines.append('  - record: {}'.format(p.name))
+        lines.append('    expr: {}'.format(json.dumps(p.record) if ': ' in p.record or p.record.startswith(('{', '"')) else p.record))
+    return '\n'.join(lines) + '\n'
+
+def report(costs, proposals, args, out=sys.stdout):
+    out.write('{:>10} {:>8} {:>8} {:>10} {:>8}  {}\n'.format('samples', 'series', 'output', 'per hour', 'oldest', 'query'))
+    for cost in sorted(costs, key=lambda c: -c.samples_per_hour)[:args.top_queries]:
+        e = cost.estimate
+        out.write('{:>10} {:>8} {:>8} {:>10} {:>8}  {}\n'.format(human(e.samples), human(e.touched), human(e.output),
+            human(cost.samples_per_hour), promql.duration(int(e.oldest)) if e.oldest else '-', cost.query))
+    total = sum(c.samples_per_hour for c in costs)
+    out.write('\n{} queries read about {} samples per hour\n'.format(len(costs), human(total)))
+
+    if not proposals:
+        return
+    out.write('\nRecording rules for the most expensive parts, {} samples per hour less:\n\n'.format(
+        human(sum(p.saved for p in proposals))))
+    for p in proposals:
+        out.write('{}\n    {}\n    saves {} samples/h, evaluating it costs {} samples/h\n'.format(
+            p.name, p.record, human(p.saved), human(p.cost)))
+        for cost, found in p.uses[:args.show_uses]:
+            out.write('    {}: {}\n'.format(cost.query, found.replacement))
+        if len(p.uses) > args.show_uses:
+            out.write('    ... and {} more\n'.format(len(p.uses) - args.show_uses))
+        out.write('\n')
+
+def parse_var(text):
+    name, sep, value = text.partition('=')
+    if not sep:
+        raise argparse.ArgumentTypeError('expected name=value, got {}'.format(text))
+    return name.lstrip('$'), value
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Estimate the cost of the PromQL in rules and dashboards against a series snapshot and propose recording rules')
+    parser.add_argument('paths', nargs='+', help='Rules files (.rules, .yml, .yaml) and Grafana dashboards (.json), or directories with them')
+    parser.add_argument('--snapshot', action='append', required=True,
+        help='Series in Prometheus as /federate text or /api/v1/series JSON, may be repeated')
+    parser.add_argument('--scale', type=int, default=1, help='Copies of every series with an instance label, a fleet this many times bigger (default: 1)')
+    parser.add_argument('--scrape-interval', type=float, default=60, help='Seconds between samples (default: 60)')
+    parser.add_argument('--evaluation-interval', type=float, default=60,
+        help='Seconds between evaluations of rule groups without an interval, also used for the proposed rules (default: 60)')
+    parser.add_argument('--viewers', type=float, default=1, help='Dashboards open at the same time (default: 1)')
+    parser.add_argument('--max-points', type=int, default=1000, help='Points of a dashboard range query, sets the step (default: 1000)')
+    parser.add_argument('--var', type=parse_var, action='append', default=[],
+        help='Value for a grafana variable as name=value, variables without one match everything')
+    parser.add_argument('--top-queries', type=int, default=25, help='Most expensive queries to list (default: 25)')
+    parser.add_argument('--top', type=int, default=10, help='Recording rules to propose (default: 10)')
+    parser.add_argument('--show-uses', type=int, default=5, help='Queries listed per proposed rule (default: 5)')
+    parser.add_argument('--rules-out', help='Write the proposed recording rules to this file')
+    parser.add_argument('--fail-above', type=float,
+        help='Exit with 2 if a single evaluation of any query reads more than this many samples')
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+
+    snapshot = Snapshot()
+    for path in args.snapshot:
+        snapshot.load(path)
+    if args.scale > 1:
+        snapshot.scale(args.scale)
+
+    queries = []
+    for path in expand(args.paths, ('.json', '.rules', '.yml', '.yaml')):
+        if path.endswith('.json'):
+            queries.extend(read_dashboard(path))
+        else:
+            queries.extend(read_rules(path, args.evaluation_interval))
+
+    base = Context(snapshot, args.scrape_interval, dict(args.var), step=args.evaluation_interval)
+    costs = []
+    for query in queries:
+        if query.parse() is None:
+            sys.stderr.write('{}: {}\n'.format(query, query.error))
+            continue
+        costs.append(Cost(query, query_context(query, base, args.max_points), args.viewers))
+    sys.stderr.write('{} series in snapshot, {} queries\n'.format(snapshot.count(), len(costs)))
+
+    proposals = outermost(propose(costs, base, args.evaluation_interval), args.top)
+    report(costs, proposals, args)
+    if args.rules_out:
+        with open(args.rules_out, 'w') as fh:
+            fh.write(rules_text(proposals, args.evaluation_interval))
+
+    if args.fail_above is not None and any(c.estimate.samples > args.fail_above for c in costs):
+        sys.exit(2)
+
+if __name__ == '__main__':
+    main()
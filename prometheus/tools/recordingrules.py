@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+#
+# Generate recording rules for the aggregations in Grafana dashboards, and rewrite the dashboards to read the
+# recorded series
+#
+# Panels like the ones in storage-information.json or ceph-osd-db-wal-space.json run the same aggregations over
+# every disk or OSD on every refresh for every viewer.  This finds the outermost part of every query with an
+# aggregation in it (see querycost.py for how grafana variables are moved out of it), writes one recording rule
+# for each distinct one to --rules-out and, with --rewrite, replaces them in the dashboards with a read of the
+# recorded series:
+#
+#   sum((ceph_bluefs_db_used_bytes{cluster="$cluster"}) *on (ceph_daemon) group_left(hostname)(ceph_osd_metadata{cluster="$cluster"})) by (hostname)
+#   sum by (hostname)(cluster_hostname:ceph_bluefs_db_used_bytes:sum_join_osd_metadata{cluster="$cluster"})
+#
+# Aggregations of the same thing by fewer labels read the one with the most: max by (alias)(x) becomes
+# max by (alias)(alias_enclosure_wwn:x:max) if max by (alias, enclosure_wwn)(x) is recorded as well.
+#
+# What isn't recorded:
+#   - alerts, they stay on the raw series so they don't depend on recording.rules being loaded or lag it by an
+#     evaluation, and what they aggregate is cheap at their interval
+#   - joins and rates without an aggregation, they record as many series as they read, and a
+#     x * on (pool_id) group_left(name) ceph_pool_metadata in a dashboard is cheap enough to do when it's shown
+#   - anything read with an offset, a recorded series only has history from when the rule was loaded, so
+#     count(smart_disk_status offset 1w) would be empty for a week
+#   - queries that already match more than one series on a side of a join on the fixture (below), they need
+#     fixing first, recordingrules.py says which
+#
+# Records that are already in --rules-out are kept and reused, series that are already recorded (names with
+# a colon) aren't recorded again, so running it again over rewritten dashboards finds nothing new.
+#
+# Before anything is rewritten the recorded and the raw queries are compared on a fixture: a few series of every
+# metric the queries use, with the labels each metric has when it's scraped, for two ceph clusters with two hosts
+# each, so a join or aggregation that leaves out cluster or the host comes out wrong.  The series each side
+# returns are worked out here (querycost.py), and --test-out writes the same comparison as a promtool unit test
+# which also compares the values, run with promtool if it's there:  promtool test rules recording.test.yml
+#
+# Example:  recordingrules.py --rules-out prometheus/alerts/recording.rules --test-out prometheus/alerts/recording.test.yml
+#               --rewrite grafana/dashboards/storage-information.json grafana/dashboards/ceph-osd-db-wal-space.json ...
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import promql
+from querycost import Context, Snapshot, candidates, estimate, group, reaggregate, signature
+from queries import expand, read_dashboard, read_rules
+
+# labels of the metrics in the fixture as they are scraped, the first prefix that matches: textfile collector
+# metrics have the labels of the node target, ceph metrics the ones of the mgr of the cluster
+node_target = ('instance', 'job', 'alias', 'site')
+ceph_target = ('instance', 'job', 'cluster', 'site')
+enclosure = ('enclosure_wwn', 'enclosure_serial', 'enclosure_name')
+enclosure_slot = enclosure + ('enclosure_slot', 'drawer', 'drawer_slot')
+metric_labels = [
+    ('smart_disk_info', node_target + ('device', 'serial', 'model', 'firmware')),
+    ('smart_disk_attr', node_target + ('device', 'name')),
+    ('smart_disk_', node_target + ('device',)),
+    ('enclosure_status', node_target + enclosure),
+    ('enclosure_slot_status', node_target + enclosure_slot),
+    ('enclosure_drive_info', node_target + enclosure_slot + ('serial', 'wwn')),
+    ('enclosure_', node_target + enclosure + ('name',)),
+    ('ceph_osd_device_info', node_target + ('device', 'cluster', 'ceph_daemon', 'type')),
+    ('ceph_osd_metadata', ceph_target + ('ceph_daemon', 'hostname')),
+    ('ceph_pool_metadata', ceph_target + ('pool_id', 'name')),
+    ('ceph_pool_', ceph_target + ('pool_id',)),
+    ('ceph_', ceph_target + ('ceph_daemon',)),
+]
+clusters = ('ceph', 'backup')
+
+# a query and the candidates replaced in it
+class Rewrite:
+    def __init__(self, query, found):
+        self.query = query
+        self.found = found
+
+    # expression with the candidates replaced by what reads the recorded series, the rest stays as it was written
+    @property
+    def expr(self):
+        text = self.query.expr
+        for found in sorted(self.found, key=lambda f: -f.node.start):
+            text = text[:found.node.start] + found.replacement + text[found.node.end:]
+        return text
+
+
+def recorded(node):
+    return any(s.name and ':' in s.name for s in promql.selectors(node))
+
+def worth_recording(node):
+    selectors = promql.selectors(node)
+    return (any(isinstance(n, promql.Aggregation) for n in node.walk()) and not any(s.offset for s in selectors)
+        and not recorded(node))
+
+# an aggregation recorded with more labels in by() serves the ones with fewer of them: max by (alias)(x) is
+# max by (alias)(alias_enclosure_wwn:x:max), only the widest is recorded and the others read it
+def subsume(proposals):
+    aggregations = {}
+    for proposal in proposals:
+        node = promql.parse(proposal.record)
+        if isinstance(node, promql.Aggregation) and node.op in reaggregate and not node.without and node.param is None:
+            aggregations[proposal] = node
+    kept = []
+    for proposal in proposals:
+        node = aggregations.get(proposal)
+        wider = None
+        if node is not None:
+            for other, agg in aggregations.items():
+                if (agg.op == node.op and set(node.grouping or []) < set(agg.grouping or [])
+                        and promql.format(agg.expr) == promql.format(node.expr)
+                        and (wider is None or len(agg.grouping) > len(aggregations[wider].grouping))):
+                    wider = other
+        if wider is None:
+            kept.append(proposal)
+            continue
+        for owner, found in proposal.uses:
+            read = promql.parse(found.replacement)
+            # with variables lifted out it is already aggregated again, by what the query had
+            grouping = read.grouping if isinstance(read, promql.Aggregation) else node.grouping
+            selector = read.expr if isinstance(read, promql.Aggregation) else read
+            selector.name = wider.name
+            found.replacement = promql.format(promql.Aggregation(reaggregate[node.op], selector, grouping=grouping or None))
+            found.name = wider.name
+            wider.uses.append((owner, found))
+    return kept
+
+def find(queries, min_uses=1):
+    uses = []
+    for query in queries:
+        if query.node is None and query.parse() is None:
+            sys.stderr.write('{}: {}\n'.format(query, query.error))
+            continue
+        # the outermost of the candidates that are worth it, candidates come parents first
+        inside = set()
+        for found in candidates(query.node):
+            if found.node in inside or not worth_recording(found.node):
+                continue
+            uses.append((query, found))
+            inside.update(found.node.walk())
+    proposals = [ p for p in subsume(group(uses)) if len(p.uses) >= min_uses ]
+    return sorted(proposals, key=lambda p: p.name)
+
+# records in an existing rules file, name -> normalized expression
+def read_records(path):
+    records = {}
+    if os.path.exists(path):
+        for query in read_rules(path):
+            if query.kind == 'record' and query.parse() is not None:
+                records[query.name] = promql.format(query.node)
+    return records
+
+# proposals that are already recorded get the existing name, new ones one that isn't taken yet
+def merge(proposals, records):
+    by_expr = dict((expr, name) for name, expr in records.items())
+    new = []
+    for proposal in proposals:
+        name = by_expr.get(proposal.record)
+        if name is None:
+            name = proposal.name
+            n = 1
+            while name in records:
+                n += 1
+                name = '{}_{}'.format(proposal.name, n)
+            records[name] = proposal.record
+            by_expr[proposal.record] = name
+            new.append(proposal)
+        if name != proposal.name:
+            for _, found in proposal.uses:
+                found.replacement = found.replacement.replace(proposal.name, name, 1)
+                found.name = name
+            proposal.name = name
+    return new
+
+def yaml_string(text):
+    return "'{}'".format(text.replace("'", "''"))
+
+# plain scalar if YAML takes it as it is
+def yaml_value(text):
+    if text[:1] in '{["\'&*!|>%@`-?:,#' or ': ' in text or ' #' in text or text != text.strip():
+        return yaml_string(text)
+    return text
+
+def rules_text(records, sources, interval):
+    lines = [
+        '# recording rules for the aggregations in the dashboards, generated by recordingrules.py',
+        '# from {}'.format(', '.join(sources)),
+        '# series recorded here only exist from when the rule was loaded, reads with an offset stay on the raw series',
+        '---',
+        'groups:',
+        '- name: recording.rules',
+        '  interval: {}'.format(promql.duration(interval)),
+        '  rules:',
+    ]
+    for name, expr in records.items():
+        lines.append('  - record: {}'.format(name))
+        lines.append('    expr: {}'.format(yaml_value(expr)))
+    return '\n'.join(lines) + '\n'
+
+
+class Fixture:
+    def __init__(self, queries, hosts=2, per_host=3):
+        self.hosts = hosts
+        self.per_host = per_host
+        self.metrics = set()
+        self.labels = set()
+        for node in queries:
+            for n in node.walk():
+                if isinstance(n, promql.Selector):
+                    if n.name and ':' not in n.name:
+                        self.metrics.add(n.name)
+                    self.labels.update(m.label for m in n.matchers)
+                elif isinstance(n, promql.Aggregation):
+                    self.labels.update(n.grouping or [])
+                elif isinstance(n, promql.Binary):
+                    self.labels.update(n.matching or [])
+                    self.labels.update(n.include)
+        self.labels.discard('__name__')
+
+    # metrics the table above doesn't know get every label the queries use
+    def labels_of(self, name):
+        for prefix, labels in metric_labels:
+            if name.startswith(prefix):
+                return labels
+        return sorted(self.labels | set(ceph_target))
+
+    # item k of host h in cluster c: devices and OSDs are numbered per host and per cluster like they are
+    # for real, so only the right by() and on() labels keep them apart, serials are unique
+    def value(self, label, name, c, h, k):
+        host = '{}-host{}'.format(clusters[c], h)
+        ceph = name.startswith('ceph_') and name != 'ceph_osd_device_info'
+        if label == 'instance':
+            return 'mgr-{}:9283'.format(clusters[c]) if ceph else host + ':9100'
+        if label in ('alias', 'hostname'):
+            return host
+        if label == 'job':
+            return 'ceph' if ceph else 'node'
+        if label == 'cluster':
+            return clusters[c]
+        if label == 'site':
+            return 'site'
+        if label == 'device':
+            return 'sd' + 'abcdefghijklmnopqrstuvwxyz'[k % 26]
+        if label == 'ceph_daemon':
+            return 'osd.{}'.format(h * self.per_host + k)
+        if label == 'pool_id':
+            return str(h * self.per_host + k + 1)
+        if label == 'serial':
+            return 'S{}{}{}'.format(c, h, k)
+        if label.startswith('enclosure_') and label != 'enclosure_slot':
+            return '{}-{}'.format(label, host)
+        return '{}{}'.format(label, k)
+
+    # the series of every metric, the same series only once
+    def series(self):
+        i = 0
+        for name in sorted(self.metrics):
+            seen = set()
+            for c in range(len(clusters)):
+                for h in range(self.hosts):
+                    for k in range(self.per_host):
+                        labels = dict((label, self.value(label, name, c, h, k)) for label in self.labels_of(name))
+                        key = tuple(sorted(labels.items()))
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                        labels['__name__'] = name
+                        yield i, labels
+                        i += 1
+
+    def snapshot(self):
+        snapshot = Snapshot()
+        for _, labels in self.series():
+            snapshot.add(labels)
+        return snapshot
+
+    # values 'start+increasexN', some series 0 and some growing, big enough for the > 5000 in the alerts
+    def values(self, i, minutes):
+        return '{}+{}x{}'.format((i % 3) * 4000, i % 2, minutes)
+
+    # grafana variables replaced with something that selects series of the fixture, the first cluster and host
+    def expr(self, text):
+        node = promql.parse(text)
+        for s in promql.selectors(node):
+            for m in s.matchers:
+                if promql.has_variable(m.value):
+                    m.value = '.+' if m.op in ('=~', '!~') else self.value(m.label, s.name or '', 0, 0, 0)
+        text = promql.format(node)
+        builtin = { '__interval': '1m', '__rate_interval': '4m', '__range': '1h' }
+        return promql.variable_re.sub(lambda m: builtin.get(m.group().strip('${}[]'), '5'), text)
+
+# joins in node that have more than one series for a match group on the one side, or on either side of a one to
+# one match, which Prometheus refuses (found duplicate series for the match group), after estimate(node, ctx)
+def collisions(node, ctx):
+    found = []
+    for n in node.walk():
+        if not isinstance(n, promql.Binary) or n.op in promql.set_operators:
+            continue
+        lhs, rhs = ctx.estimates.get(n.lhs), ctx.estimates.get(n.rhs)
+        if lhs is None or rhs is None or lhs.series is None or rhs.series is None:
+            continue
+        sides = { 'left': [rhs], 'right': [lhs] }.get(n.group, [lhs, rhs])
+        for side in sides:
+            signatures = [ signature(labels, n.matching, n.ignoring) for labels in side.series ]
+            if len(signatures) != len(set(signatures)):
+                found.append(promql.format(n))
+                break
+    return found
+
+# series of a result without names, to compare them
+def labelsets(series):
+    return set(tuple(sorted((k, v) for k, v in labels.items() if k != '__name__')) for labels in series or [])
+
+# the series the raw and the rewritten queries return on the fixture, list of (query, problem)
+def check(rewrites, records, fixture):
+    snapshot = fixture.snapshot()
+    problems = []
+    for name, expr in records.items():
+        node = promql.parse(fixture.expr(expr))
+        ctx = Context(snapshot)
+        for labels in estimate(node, ctx).series or []:
+            snapshot.add(dict(labels, __name__=name))
+        for join in collisions(node, ctx):
+            problems.append((name, '{} matches more than one series on a side'.format(join)))
+
+    for rewrite in rewrites:
+        pairs = [ (fixture.expr(rewrite.query.expr), fixture.expr(rewrite.expr)) ]
+        pairs += [ (fixture.expr(promql.format(f.node)), fixture.expr(f.replacement)) for f in rewrite.found ]
+        for raw, new in pairs:
+            ctx = Context(snapshot)
+            before = estimate(promql.parse(raw), ctx).series
+            node = promql.parse(new)
+            after = estimate(node, ctx).series
+            if labelsets(before) != labelsets(after):
+                problems.append((rewrite.query, '{} and {} return different series'.format(raw, new)))
+            for join in collisions(node, ctx):
+                problems.append((rewrite.query, '{} matches more than one series on a side'.format(join)))
+    return problems
+
+def offsets(node):
+    return [ promql.seconds(s.offset) or 0 for s in promql.selectors(node) if s.offset ]
+
+# promtool unit test: on the fixture the raw and the rewritten query return the same series with the same values
+# and the part that was replaced isn't empty
+# with header the lines before the list of tests, without it only the test to add to an existing file
+def test_text(rewrites, fixture, rules_file, interval, header=True):
+    eval_time = max([0] + [ o for r in rewrites for o in offsets(r.query.node) ]) + 600
+    minutes = int(eval_time // 60) + 10
+    lines = [
+        '# recorded and raw queries agree, generated by recordingrules.py, run with: promtool test rules <this file>',
+        '# every run of recordingrules.py adds a test with its own fixture for the queries it rewrote',
+        'rule_files:',
+        '- {}'.format(rules_file),
+        'evaluation_interval: {}'.format(promql.duration(interval)),
+        'tests:',
+    ] if header else []
+    lines += [
+        '- interval: 1m',
+        '  input_series:',
+    ]
+    for i, labels in fixture.series():
+        name = labels.pop('__name__')
+        series = '{}{{{}}}'.format(name, ', '.join('{}={}'.format(k, promql.quote(v)) for k, v in sorted(labels.items())))
+        lines.append('  - series: {}'.format(yaml_string(series)))
+        lines.append("    values: '{}'".format(fixture.values(i, minutes)))
+    lines.append('  promql_expr_tests:')
+    for rewrite in rewrites:
+        raw, new = fixture.expr(rewrite.query.expr), fixture.expr(rewrite.expr)
+        lines.append('  # {}'.format(rewrite.query))
+        tests = [ '({}) unless ({})'.format(raw, new), '({}) unless ({})'.format(new, raw), 'abs(({}) - ({})) > 1e-9'.format(raw, new) ]
+        tests += [ 'absent({})'.format(fixture.expr(promql.format(f.node))) for f in rewrite.found ]
+        for expr in tests:
+            lines.append('  - expr: {}'.format(yaml_string(expr)))
+            lines.append('    eval_time: {}'.format(promql.duration(eval_time)))
+            lines.append('    exp_samples: []')
+    return '\n'.join(lines) + '\n'
+
+
+# replace the expressions in the dashboards
+def rewrite_files(rewrites):
+    dashboards = {}
+    for rewrite in rewrites:
+        rewrite.query.target['expr'] = rewrite.expr
+        dashboards[rewrite.query.source] = rewrite.query.dashboard
+
+    for path, document in dashboards.items():
+        # same layout the dashboards are exported with
+        with open(path, 'w') as fh:
+            fh.write(json.dumps(document, indent=2))
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Generate recording rules for the aggregations in Grafana dashboards and rewrite them to use the recorded series')
+    parser.add_argument('paths', nargs='+', help='Grafana dashboards (.json), or directories with them')
+    parser.add_argument('--rules-out', required=True, help='Rules file with the recording rules, records already in it are kept')
+    parser.add_argument('--test-out', help='Write a promtool unit test comparing the recorded and the raw queries on a fixture')
+    parser.add_argument('--rewrite', action='store_true', help='Replace the expressions in the dashboards')
+    parser.add_argument('--min-uses', type=int, default=1, help='Queries that have to use an expression for it to be recorded (default: 1)')
+    parser.add_argument('--evaluation-interval', type=float, default=60, help='Interval of the recording rules group in seconds (default: 60)')
+    return parser
+
+def main():
+    args = build_parser().parse_args()
+
+    queries = []
+    sources = []
+    for path in expand(args.paths, ('.json',)):
+        sources.append(os.path.basename(path))
+        queries.extend(read_dashboard(path))
+
+    parsed = []
+    for query in queries:
+        if query.parse() is None:
+            sys.stderr.write('{}: {}\n'.format(query, query.error))
+        else:
+            parsed.append(query)
+    records = read_records(args.rules_out)
+    fixture = Fixture([ q.node for q in parsed ] + [ promql.parse(expr) for expr in records.values() ])
+
+    # a query that is already wrong on the fixture would be recorded just as wrong
+    snapshot = fixture.snapshot()
+    usable = []
+    for query in parsed:
+        node = promql.parse(fixture.expr(query.expr))
+        ctx = Context(snapshot)
+        estimate(node, ctx)
+        joins = collisions(node, ctx)
+        for join in joins:
+            sys.stderr.write('{}: {} matches more than one series on a side, not recorded\n'.format(query, join))
+        if not joins:
+            usable.append(query)
+
+    proposals = find(usable, args.min_uses)
+    new = merge(proposals, records)
+    if not new:
+        print('nothing new to record')
+        return
+
+    by_query = {}
+    for proposal in proposals:
+        for query, found in proposal.uses:
+            by_query.setdefault(id(query), Rewrite(query, [])).found.append(found)
+    rewrites = list(by_query.values())
+
+    # the test only needs the metrics of the queries it has
+    fixture = Fixture([ r.query.node for r in rewrites ] + [ promql.parse(expr) for expr in records.values() ])
+    problems = check(rewrites, records, fixture)
+    for query, problem in problems:
+        sys.stderr.write('{}: {}\n'.format(query, problem))
+    if problems:
+        sys.exit(1)
+
+    with open(args.rules_out, 'w') as fh:
+        fh.write(rules_text(records, sorted(set(sources)), args.evaluation_interval))
+    print('{} recording rules, {} new, {} queries use them'.format(len(records), len(new), len(rewrites)))
+
+    if args.test_out:
+        rules_file = os.path.relpath(args.rules_out, os.path.dirname(os.path.abspath(args.test_out)))
+        exists = os.path.exists(args.test_out)
+        with open(args.test_out, 'a' if exists else 'w') as fh:
+            fh.write(test_text(rewrites, fixture, rules_file, args.evaluation_interval, header=not exists))
+        promtool = shutil.which('promtool')
+        if promtool:
+            if subprocess.call([promtool, 'test', 'rules', args.test_out]) != 0:
+                sys.exit(1)
+        else:
+            print('promtool not found, values not compared, run: promtool test rules {}'.format(args.test_out))
+
+    if args.rewrite:
+        rewrite_files(rewrites)
+
+if __name__ == '__main__':
+    main()